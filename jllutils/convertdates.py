@@ -0,0 +1,69 @@
+#!/usr/bin/env python
+#
+# convertdates.py - python script that rewrites the dates in some columns of a delimited text file (e.g. CSV or TSV)
+#   from one format to another, streaming through the file so that it can be of any size.
+from __future__ import print_function
+import argparse
+import sys
+
+from jllutils.timeutils import convert_date_columns
+
+def shell_error(msg, exitcode=1):
+    print(msg, file=sys.stderr)
+    exit(exitcode)
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='convert the format of date columns in a delimited text file',
+                                     formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument('-c', '--columns', required=True,
+                        help='Comma separated list of the columns to convert, as 0-based numbers or, with --header,\n'
+                             'column names.')
+    parser.add_argument('-i', '--format-in', default='yyyy-mm-dd',
+                        help='The format of the dates in the file, default %(default)s. Identifiers are:\n'
+                             '  yyyy - four number year OR yy - two number year \n'
+                             '  mm - two number month OR mmm - three letter month abbreviation \n'
+                             '  dd - two number day \n'
+                             '  HH - two number hour \n'
+                             '  MM - two number minute \n'
+                             '  SS - two number second \n'
+                             'AM or PM in a date is recognized whether or not the format includes it.')
+    parser.add_argument('-o', '--format-out', default='yyyy-mm-dd',
+                        help='The format to write the dates in, default %(default)s. Uses the same identifiers, plus\n'
+                             'AM or PM to write the hour in 12 hour format.')
+    parser.add_argument('-d', '--delimiter', default=',',
+                        help='The field delimiter, default "%(default)s". Use "tab" or "\\t" for tab delimited files.')
+    parser.add_argument('--header', action='store_true', help='The first line is a header and is copied unchanged.')
+    parser.add_argument('--errors', default='strict', choices=('strict', 'keep', 'blank'),
+                        help='What to do with dates that cannot be converted: stop with an error (default), keep\n'
+                             'them unchanged, or blank them.')
+    parser.add_argument('-p', '--processes', default=1, type=int,
+                        help='Number of processes to convert with, default %(default)s.')
+    parser.add_argument('--chunk-size', default=16*1024**2, type=int,
+                        help='Approximate number of characters to convert at once, default %(default)s.')
+    parser.add_argument('--encoding', default='utf-8', help='Text encoding of the files, default %(default)s.')
+    parser.add_argument('in_file', help='The file to read, or - for stdin')
+    parser.add_argument('out_file', help='The file to write, or - for stdout')
+    args = parser.parse_args()
+
+    if args.delimiter in ('tab', '\\t'):
+        args.delimiter = '\t'
+    args.columns = [int(c) if c.isdigit() else c for c in args.columns.split(',')]
+    if not args.header and not all(isinstance(c, int) for c in args.columns):
+        shell_error('Columns can only be given by name with --header')
+    if args.processes < 1:
+        shell_error('--processes must be at least 1')
+    if args.chunk_size < 1:
+        shell_error('--chunk-size must be at least 1')
+    return args
+
+def main():
+    args = parse_args()
+    try:
+        convert_date_columns(args.in_file, args.out_file, args.columns, args.format_in, args.format_out,
+                             delimiter=args.delimiter, header=args.header, errors=args.errors,
+                             processes=args.processes, chunk_size=args.chunk_size, encoding=args.encoding)
+    except ValueError as err:
+        shell_error(str(err))
+
+if __name__ == '__main__':
+    main()
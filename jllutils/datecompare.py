@@ -2,17 +2,25 @@
 #
 # datecompare.py - python script that can be used to compare two dates given as strings
 #   Gives exit status of 0 if comparison is true, 1 if false, so can be used in shell if
-#   statements.
+#   statements. With --batch, reads many comparisons, one per line, and writes one result per line.
 from __future__ import print_function
 import argparse
 import datetime as dt
 import re
+import shlex
 import sys
 
 def shell_error(msg, exitcode=2): # use 2 because 1 is used to indicate the comparison was false, not an error
     print(msg,file=sys.stderr);
     exit(exitcode)
 
+class DateCompareError(ValueError):
+    pass
+
+def raise_error(msg):
+    # Used instead of shell_error in batch mode, so that one bad line does not stop the rest
+    raise DateCompareError(msg)
+
 def parse_args():
     parser = argparse.ArgumentParser(description='compare two dates', formatter_class=argparse.RawTextHelpFormatter)
     parser.add_argument('-f', '--datefmt', default='%Y-%m-%d', help='The format that Python\'s datetime module should interprete the dates as.\n'
@@ -35,10 +43,23 @@ def parse_args():
                                     '\n  -12h (subtract two hours from the preceding datetime'
                                     '\n  +30m (add 30 minutes)'
                                     '\n  -40s (subtract 40 seconds)'
-                                    '\n  +1d12h (add 1 day and 12 hours)')
+                                    '\n  +1d12h (add 1 day and 12 hours)\n'
+                                    'With --batch, these are optional and used as a template for each line: {} in any of\n'
+                                    'them is replaced by the whole line, or if there is no {}, the line is put in front.')
+    parser.add_argument('--batch', default=None, metavar='FILE',
+                        help='Read comparisons from FILE (- for stdin), one per line, written the same way as the\n'
+                             'command line arguments (quote dates containing spaces). Writes one result per line to\n'
+                             'stdout, and exits with 0 if all were true, 1 if any were false, or 2 if any were invalid.\n'
+                             'Each invalid line is also reported on stderr. Blank lines are skipped and give no result.')
+    parser.add_argument('--results', default='bool', choices=('bool', 'code'),
+                        help='With --batch, write each result as true/false/error (bool, the default) or as the exit\n'
+                             'status a single comparison would give, 0/1/2 (code).')
+    parser.add_argument('--line-buffered', action='store_true',
+                        help='With --batch, write each result as soon as it is ready, e.g. when another program is\n'
+                             'waiting on them one at a time.')
     return parser.parse_args()
 
-def parse_timedelta(td):
+def parse_timedelta(td, error_fxn=shell_error):
     if td[0] == '+':
         f = 1
     elif td[0] == '-':
@@ -64,11 +85,11 @@ def parse_timedelta(td):
         elif timeseg == 's':
             seconds += f * val
         else:
-            shell_error('Modification operators only recognize d, h, m, s as valid time segments (days, hours, minutes, seconds')
+            error_fxn('Modification operators only recognize d, h, m, s as valid time segments (days, hours, minutes, seconds')
 
     return dt.timedelta(days=days, hours=hours, minutes=minutes, seconds=seconds)
 
-def process_dates_opts(dates_ops, date_fmt):
+def process_dates_opts(dates_ops, date_fmt, error_fxn=shell_error):
     comp_op = ''
     comparison_ops = ['=','==','eq','!=','ne','<','lt','<=','le','>','gt','>=','ge']
     mod_ops = ['+','-']
@@ -78,30 +99,43 @@ def process_dates_opts(dates_ops, date_fmt):
             if len(comp_op) == 0:
                 comp_op = d
             else:
-                shell_error('Cannot specify multiply comparison operators ({0})'.format(', '.join(comparison_ops)))
+                error_fxn('Cannot specify multiply comparison operators ({0})'.format(', '.join(comparison_ops)))
         elif d[0] in mod_ops:
             if len(dates) == 0:
-                shell_error('Modification operators (starting with {0}) must come after a date'.format(', '.join(mod_ops)))
+                error_fxn('Modification operators (starting with {0}) must come after a date'.format(', '.join(mod_ops)))
             else:
                 # Modify the most recent date to be read
-                td = parse_timedelta(d)
+                td = parse_timedelta(d, error_fxn=error_fxn)
                 dates[-1] += td
         else:
             # Must be a date
             if len(dates) < 2:
                 dates.append(convert_date(d, date_fmt))
             else:
-                shell_error('Only 2 dates can be input. Already found two: {0}'.format(', '.join(dates)))
+                error_fxn('Only 2 dates can be input. Already found two: {0}'.format(', '.join(str(x) for x in dates)))
 
     if comp_op == '':
-        shell_error('No comparison operator given')
+        error_fxn('No comparison operator given')
     elif len(dates) < 2:
-        shell_error('Two dates must be given for comparison')
+        error_fxn('Two dates must be given for comparison')
 
     return dates[0], dates[1], comp_op
 
+# Dates already converted. In batch mode the same dates (e.g. a fixed date to compare against) tend to come up over
+# and over, and strptime is by far the slowest part of a comparison.
+_converted_dates = dict()
+_max_converted_dates = 65536
+
 def convert_date(datestr,datefmt):
+    key = (datestr, datefmt)
+    try:
+        return _converted_dates[key]
+    except KeyError:
+        pass
     dateval = dt.datetime.strptime(datestr, datefmt)
+    if len(_converted_dates) >= _max_converted_dates:
+        _converted_dates.clear()
+    _converted_dates[key] = dateval
     return dateval
 
 def compare_dates(d1, d2, op):
@@ -120,8 +154,75 @@ def compare_dates(d1, d2, op):
     else:
         exit(2)
 
+def split_expression(line, template=None):
+    """
+    Split one line of batch input into the arguments process_dates_opts expects. If template (a list of arguments)
+    is given, the whole line replaces {} in each of its arguments, or if there is no {}, the line's arguments are
+    put in front of it.
+    """
+    if '"' in line or "'" in line:
+        tokens = shlex.split(line)
+    else:
+        tokens = line.split()
+    if template:
+        if any('{}' in arg for arg in template):
+            tokens = [arg.replace('{}', line.strip()) for arg in template]
+        else:
+            tokens = tokens + template
+    return tokens
+
+def iter_batch_results(lines, date_fmt, template=None):
+    """
+    Evaluate one comparison per line of input. Each is parsed and compared exactly as a single comparison given on
+    the command line, but in this process, so the cost is only that of parsing the dates.
+    :param lines: iterable of comparisons, written as the command line arguments would be
+    :param date_fmt: the strptime format of the dates
+    :param template: optional list of arguments to fill each line into, see split_expression
+    :return: generator of (line number, result, error) tuples, one per line that is not blank (blank lines are
+     skipped). Line numbers start at 1. result is True or False, or None if the line was invalid, in which case
+     error is the reason.
+    """
+    for i, line in enumerate(lines):
+        if not line.strip():
+            continue
+        try:
+            d1, d2, op = process_dates_opts(split_expression(line, template), date_fmt, error_fxn=raise_error)
+            yield i + 1, compare_dates(d1, d2, op), None
+        except (ValueError, IndexError, OverflowError) as err:
+            # ValueError includes DateCompareError and dates that do not match the format, OverflowError dates
+            # modified past the year 9999
+            yield i + 1, None, str(err) or 'Invalid comparison'
+
+def run_batch(batch_file, date_fmt, template=None, results='bool', line_buffered=False):
+    """
+    Evaluate the comparisons in batch_file (- for stdin), writing one result per non-blank line to stdout.
+    :return: the exit status, 0 if all comparisons were true, 1 if any were false, 2 if any were invalid.
+    """
+    result_strs = {'bool': {True: 'true', False: 'false', None: 'error'},
+                   'code': {True: '0', False: '1', None: '2'}}[results]
+    ecode = 0
+    fobj = sys.stdin if batch_file == '-' else open(batch_file)
+    try:
+        for line_number, result, error in iter_batch_results(fobj, date_fmt, template):
+            if result is None:
+                ecode = 2
+                print('Line {0}: {1}'.format(line_number, error), file=sys.stderr)
+            elif not result and ecode == 0:
+                ecode = 1
+            sys.stdout.write(result_strs[result] + '\n')
+            if line_buffered:
+                sys.stdout.flush()
+    finally:
+        if fobj is not sys.stdin:
+            fobj.close()
+    sys.stdout.flush()
+    return ecode
+
 def main():
     args=parse_args()
+    if args.batch is not None:
+        exit(run_batch(args.batch, args.datefmt, template=args.dates_ops, results=args.results,
+                       line_buffered=args.line_buffered))
     d1, d2, op = process_dates_opts(args.dates_ops, args.datefmt)
     result = compare_dates(d1, d2, op)
     if result:
@@ -2,11 +2,31 @@
 from __future__ import print_function
 
 import argparse
+from bisect import bisect_right
+from collections import deque
+from fnmatch import fnmatch
 from glob import glob
 import hashlib
+import heapq
+import json
+import mmap
+from multiprocessing.pool import ThreadPool
+import os
 import os.path
 import random
+import sqlite3
+import stat
 import sys
+import tempfile
+import threading
+import time
+import zlib
+
+try:
+    from os import scandir
+except ImportError:
+    # Python < 3.5 needs the scandir backport
+    from scandir import scandir
 
 def shell_msg(msg):
     print(msg, file=sys.stderr)
@@ -15,51 +35,1032 @@ def shell_error(msg, exit_code=2):
     print(msg, file=sys.stderr)
     exit(exit_code)
 
-def md5(fname):
+DEFAULT_CHUNK_SIZE = 1024 * 1024
+# Regular files at least this big are memory mapped instead of read, unless told otherwise
+MMAP_THRESHOLD = 64 * 1024 * 1024
+
+# Each thread reuses one read buffer rather than allocating a new bytes object for every chunk. A running
+# iter_file_chunks generator takes the buffer and puts it back when it finishes, so a generator interleaved with it on
+# the same thread allocates its own instead of overwriting its chunks.
+_thread_buffers = threading.local()
+# The IOMonitor, if any, that reads in this thread should be throttled by and counted in. Set by iter_hashes.
+_thread_monitor = threading.local()
+
+def _account_read(nbytes):
+    monitor = getattr(_thread_monitor, 'monitor', None)
+    if monitor is not None:
+        monitor.account_read(nbytes)
+
+def _parse_size(size_str):
+    # Parses sizes like 500, 64K, 100M or 2G (powers of 1024)
+    suffixes = {'K': 1024, 'M': 1024**2, 'G': 1024**3, 'T': 1024**4}
+    size_str = size_str.strip().upper().rstrip('B')
+    if size_str and size_str[-1] in suffixes:
+        return int(float(size_str[:-1]) * suffixes[size_str[-1]])
+    return int(size_str)
+
+class IOMonitor(object):
+    """
+    Throttles and measures the reads made while hashing. Pass one to iter_hashes (or print_hashes, compare_hashed,
+    etc.) and every read in the hashing threads is counted against it.
+        - max_bytes_per_sec and max_iops limit the read bandwidth and the number of read calls per second across all
+          threads, allowing bursts of up to one second's worth.
+        - If report_interval is given, a progress line (bytes/s, files/s, and an ETA if the total number of files
+          was given with set_total_files) is printed to stderr at most that often.
+        - summary() returns totals and per-directory timing for the run, write_summary_json() saves it.
+    """
+    def __init__(self, max_bytes_per_sec=None, max_iops=None, report_interval=None):
+        self.max_bytes_per_sec = max_bytes_per_sec
+        self.max_iops = max_iops
+        self.report_interval = report_interval
+        self.total_files = None
+
+        self._lock = threading.Lock()
+        self._thread_bytes = threading.local()
+        self._start = time.time()
+        self._end = None
+        self._last_report = self._start
+        # Virtual clocks for the rate limits: the time at which the reads so far would be done at the maximum rate
+        self._byte_clock = self._start
+        self._op_clock = self._start
+        self.bytes_read = 0
+        self.read_ops = 0
+        self.files_done = 0
+        self.dir_stats = dict()
+
+    def set_total_files(self, n_files):
+        self.total_files = n_files
+
+    def account_read(self, nbytes):
+        wait = 0.0
+        with self._lock:
+            now = time.time()
+            self.bytes_read += nbytes
+            self.read_ops += 1
+            if self.max_bytes_per_sec:
+                self._byte_clock = max(self._byte_clock, now - 1.0) + nbytes / float(self.max_bytes_per_sec)
+                wait = max(wait, self._byte_clock - now)
+            if self.max_iops:
+                self._op_clock = max(self._op_clock, now - 1.0) + 1.0 / self.max_iops
+                wait = max(wait, self._op_clock - now)
+        self._thread_bytes.n = getattr(self._thread_bytes, 'n', 0) + nbytes
+        if wait > 0:
+            time.sleep(wait)
+
+    def start_file(self):
+        self._thread_bytes.n = 0
+
+    def file_done(self, path, elapsed):
+        nbytes = getattr(self._thread_bytes, 'n', 0)
+        dir_name = os.path.dirname(path)
+        with self._lock:
+            self.files_done += 1
+            stats = self.dir_stats.setdefault(dir_name, {'files': 0, 'bytes': 0, 'seconds': 0.0})
+            stats['files'] += 1
+            stats['bytes'] += nbytes
+            stats['seconds'] += elapsed
+            now = time.time()
+            report = self.report_interval is not None and now - self._last_report >= self.report_interval
+            if report:
+                self._last_report = now
+        if report:
+            shell_msg(self.progress_line())
+
+    def finish(self):
+        self._end = time.time()
+
+    def elapsed(self):
+        return (self._end if self._end is not None else time.time()) - self._start
+
+    def progress_line(self):
+        elapsed = self.elapsed()
+        bytes_rate = self.bytes_read / elapsed if elapsed > 0 else 0.0
+        files_rate = self.files_done / elapsed if elapsed > 0 else 0.0
+        line = '{} files, {:.1f} MB in {:.1f} s: {:.1f} MB/s, {:.1f} files/s'.format(
+            self.files_done, self.bytes_read / 1e6, elapsed, bytes_rate / 1e6, files_rate)
+        if self.total_files is not None and files_rate > 0:
+            eta = max(0, self.total_files - self.files_done) / files_rate
+            line += ', ETA {:.0f} s'.format(eta)
+        return line
+
+    def summary(self):
+        """
+        :return: dict with the totals for the run (files, bytes, read_ops, seconds, bytes_per_sec, files_per_sec, and
+         the limits in effect) and per_directory, a dict of directory to its files, bytes, and seconds spent hashing
+         (summed over threads).
+        """
+        elapsed = self.elapsed()
+        with self._lock:
+            return {'files': self.files_done, 'bytes': self.bytes_read, 'read_ops': self.read_ops,
+                    'seconds': elapsed,
+                    'bytes_per_sec': self.bytes_read / elapsed if elapsed > 0 else None,
+                    'files_per_sec': self.files_done / elapsed if elapsed > 0 else None,
+                    'max_bytes_per_sec': self.max_bytes_per_sec, 'max_iops': self.max_iops,
+                    'per_directory': dict((d, dict(st)) for d, st in self.dir_stats.items())}
+
+    def write_summary_json(self, json_file):
+        with open(json_file, 'w') as fobj:
+            json.dump(self.summary(), fobj, indent=2, sort_keys=True)
+
+    def print_summary(self):
+        shell_msg('Summary: ' + self.progress_line())
+        for dir_name, st in sorted(self.dir_stats.items()):
+            shell_msg('  {}: {} files, {:.1f} MB, {:.2f} s'.format(dir_name or '.', st['files'], st['bytes'] / 1e6,
+                                                                 st['seconds']))
+
+def _take_buffer(chunk_size):
+    buf = getattr(_thread_buffers, 'buf', None)
+    _thread_buffers.buf = None
+    if buf is None or len(buf) != chunk_size:
+        buf = bytearray(chunk_size)
+    return buf
+
+def _put_buffer(buf):
+    _thread_buffers.buf = buf
+
+def iter_file_chunks(fname, chunk_size=DEFAULT_CHUNK_SIZE, use_mmap=None):
+    """
+    Iterate over the contents of a file as memoryviews, without allocating a new object for each chunk.
+    :param fname: the file to read
+    :param chunk_size: number of bytes per chunk
+    :param use_mmap: True to memory map the file, False to read it into a reused buffer, None (default) to memory
+     map regular files of at least MMAP_THRESHOLD bytes.
+    :return: generator of memoryviews. Each is only valid until the next one is requested.
+    """
+    with open(fname, 'rb') as f:
+        fd = f.fileno()
+        st = os.fstat(fd)
+        if use_mmap is None:
+            use_mmap = stat.S_ISREG(st.st_mode) and st.st_size >= MMAP_THRESHOLD
+        if use_mmap and st.st_size == 0:
+            # Cannot mmap an empty file
+            return
+
+        if use_mmap:
+            mm = mmap.mmap(fd, 0, access=mmap.ACCESS_READ)
+            if hasattr(mm, 'madvise') and hasattr(mmap, 'MADV_SEQUENTIAL'):
+                mm.madvise(mmap.MADV_SEQUENTIAL)
+            view = memoryview(mm)
+            try:
+                for start in range(0, st.st_size, chunk_size):
+                    chunk = view[start:start + chunk_size]
+                    _account_read(len(chunk))
+                    yield chunk
+                    chunk.release()
+            finally:
+                view.release()
+                mm.close()
+        else:
+            if hasattr(os, 'posix_fadvise'):
+                os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_SEQUENTIAL)
+            buf = _take_buffer(chunk_size)
+            try:
+                view = memoryview(buf)
+                n = f.readinto(buf)
+                while n:
+                    _account_read(n)
+                    yield view[:n]
+                    n = f.readinto(buf)
+            finally:
+                _put_buffer(buf)
+
+def compute_hashes(fname, algorithms=('md5',), chunk_size=DEFAULT_CHUNK_SIZE, use_mmap=None):
+    """
+    Compute several hashes of a file while only reading it once.
+    :param fname: the file to hash
+    :param algorithms: sequence of hashlib algorithm names, e.g. ('md5', 'sha256', 'blake2b')
+    :param chunk_size: see iter_file_chunks
+    :param use_mmap: see iter_file_chunks
+    :return: dict mapping each algorithm name to the hex digest
+    """
+    hashers = [hashlib.new(a) for a in algorithms]
+    for chunk in iter_file_chunks(fname, chunk_size=chunk_size, use_mmap=use_mmap):
+        for h in hashers:
+            h.update(chunk)
+    return dict((a, h.hexdigest()) for a, h in zip(algorithms, hashers))
+
+# Whether each algorithm name seen so far can be used by compute_hashes
+_algorithm_available = dict()
+
+def unavailable_algorithms(algorithms):
+    """
+    Find the names that compute_hashes cannot use, because hashlib does not have them or they need a digest length
+    (like shake_128).
+    :param algorithms: iterable of algorithm names, e.g. the keys of a manifest entry. Quick check keys are ignored.
+    :return: sorted list of the unusable names, empty if they are all fine.
+    """
+    bad = []
+    for alg in algorithms:
+        if alg in _quick_keys:
+            continue
+        available = _algorithm_available.get(alg)
+        if available is None:
+            try:
+                hashlib.new(alg).hexdigest()
+                available = True
+            except (ValueError, TypeError):
+                available = False
+            _algorithm_available[alg] = available
+        if not available:
+            bad.append(alg)
+    return sorted(bad)
+
+def md5(fname, chunk_size=DEFAULT_CHUNK_SIZE, use_mmap=None):
+    hash_md5 = hashlib.md5()
+    for chunk in iter_file_chunks(fname, chunk_size=chunk_size, use_mmap=use_mmap):
+        hash_md5.update(chunk)
+    return hash_md5.hexdigest()
+
+def _mtime_ns(st):
+    try:
+        return st.st_mtime_ns
+    except AttributeError:
+        return int(st.st_mtime * 1e9)
+
+class HashCache(object):
+    """
+    Persistent cache of file hashes in an SQLite database, keyed on the device, inode, size, and modification time of
+    each file, so that unchanged files do not need to be read again. Safe to share between the threads of
+    iter_hashes. Note that a file whose contents change without changing its size or mtime (e.g. bit rot) will not
+    be noticed while it is in the cache, which is what the rehash option of cached_compute_hashes is for.
+
+    Can be used as a context manager, otherwise call close() to write out pending changes. Cache hits update the
+    last_used time of their entries in batches of commit_every as well.
+    """
+    def __init__(self, db_file, commit_every=1000):
+        self.db_file = db_file
+        self._conn = sqlite3.connect(db_file, check_same_thread=False)
+        self._lock = threading.Lock()
+        self._commit_every = commit_every
+        self._n_pending = 0
+        # (time, dev, ino) of cache hits whose last_used has not been updated yet
+        self._pending_hits = []
+        with self._lock:
+            self._conn.execute('CREATE TABLE IF NOT EXISTS hashes (dev INTEGER, ino INTEGER, size INTEGER, '
+                               'mtime_ns INTEGER, path TEXT, algorithm TEXT, digest TEXT, last_used REAL, '
+                               'PRIMARY KEY (dev, ino, algorithm))')
+            self._conn.commit()
+
+    def get(self, st, algorithms):
+        """
+        Look up the hashes of a file by its stat result.
+        :return: dict of algorithm to digest if all of the algorithms are cached for this file as it is now,
+         otherwise None.
+        """
+        with self._lock:
+            rows = self._conn.execute('SELECT algorithm, digest FROM hashes WHERE dev = ? AND ino = ? AND size = ? '
+                                      'AND mtime_ns = ?', (st.st_dev, st.st_ino, st.st_size, _mtime_ns(st))).fetchall()
+            cached = dict(rows)
+            if any(a not in cached for a in algorithms):
+                return None
+            self._pending_hits.append((time.time(), st.st_dev, st.st_ino))
+            if len(self._pending_hits) >= self._commit_every:
+                self._flush_hits()
+                self._conn.commit()
+                self._n_pending = 0
+        return dict((a, cached[a]) for a in algorithms)
+
+    def _flush_hits(self):
+        # Must be called with self._lock held
+        self._conn.executemany('UPDATE hashes SET last_used = ? WHERE dev = ? AND ino = ?', self._pending_hits)
+        self._pending_hits = []
+
+    def put(self, fname, st, hashes):
+        with self._lock:
+            self._conn.executemany('INSERT OR REPLACE INTO hashes VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                                   [(st.st_dev, st.st_ino, st.st_size, _mtime_ns(st), os.path.abspath(fname), a, d,
+                                     time.time()) for a, d in hashes.items()])
+            self._n_pending += 1
+            if self._n_pending >= self._commit_every:
+                self._conn.commit()
+                self._n_pending = 0
+
+    def prune(self, max_entries=None):
+        """
+        Remove entries for files that no longer exist or have changed, and then, if max_entries is given, the least
+        recently used (stored or looked up) entries beyond that many.
+        :return: the number of entries removed
+        """
+        with self._lock:
+            self._flush_hits()
+            rows = self._conn.execute('SELECT DISTINCT dev, ino, size, mtime_ns, path FROM hashes').fetchall()
+            stale = []
+            for dev, ino, size, mtime_ns, path in rows:
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    stale.append((dev, ino))
+                    continue
+                if (st.st_dev, st.st_ino, st.st_size, _mtime_ns(st)) != (dev, ino, size, mtime_ns):
+                    stale.append((dev, ino))
+            n_before = self._conn.total_changes
+            self._conn.executemany('DELETE FROM hashes WHERE dev = ? AND ino = ?', stale)
+            if max_entries is not None:
+                self._conn.execute('DELETE FROM hashes WHERE rowid NOT IN (SELECT rowid FROM hashes ORDER BY '
+                                   'last_used DESC LIMIT ?)', (max_entries,))
+            self._conn.commit()
+            self._n_pending = 0
+            return self._conn.total_changes - n_before
+
+    def close(self):
+        with self._lock:
+            self._flush_hits()
+            self._conn.commit()
+            self._conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+def cached_compute_hashes(fname, algorithms=('md5',), cache=None, rehash=False, chunk_size=DEFAULT_CHUNK_SIZE,
+                          use_mmap=None):
+    """
+    Same as compute_hashes, but looks up and stores the hashes in a HashCache.
+    :param cache: a HashCache instance. If None, this is the same as compute_hashes.
+    :param rehash: if True, always read the file (still storing the result in the cache), to re-verify files that
+     the cache says are unchanged.
+    """
+    if cache is None:
+        return compute_hashes(fname, algorithms=algorithms, chunk_size=chunk_size, use_mmap=use_mmap)
+
+    st = os.stat(fname)
+    if not rehash:
+        hashes = cache.get(st, algorithms)
+        if hashes is not None:
+            return hashes
+    hashes = compute_hashes(fname, algorithms=algorithms, chunk_size=chunk_size, use_mmap=use_mmap)
+    cache.put(fname, st, hashes)
+    return hashes
+
+# Quick check: the size of a file plus an MD5 of its first and last blocks and a few blocks evenly spaced in between.
+# These are fixed so that a quick hash in a manifest can always be recomputed the same way.
+QUICK_BLOCK_SIZE = 65536
+QUICK_N_INTERIOR = 4
+# Manifest keys that hold quick check data rather than a hashlib digest
+_quick_keys = ('quick', 'size')
+
+def quick_hash(fname):
+    """
+    Compute the quick check hash of a file: an MD5 of its size, head, tail, and QUICK_N_INTERIOR evenly spaced
+    interior blocks of QUICK_BLOCK_SIZE bytes. Files small enough that the blocks would cover them are hashed whole.
+    :return: the hex digest
+    """
     hash_md5 = hashlib.md5()
-    with open(fname, "rb") as f:
-        for chunk in iter(lambda: f.read(4096), b""):
-            hash_md5.update(chunk)
+    with open(fname, 'rb') as f:
+        size = os.fstat(f.fileno()).st_size
+        hash_md5.update(str(size).encode('ascii') + b'\n')
+        if size <= (QUICK_N_INTERIOR + 2) * QUICK_BLOCK_SIZE:
+            offsets = [0]
+            block_size = size
+        else:
+            last = size - QUICK_BLOCK_SIZE
+            offsets = [0] + [last * i // (QUICK_N_INTERIOR + 1) for i in range(1, QUICK_N_INTERIOR + 1)] + [last]
+            block_size = QUICK_BLOCK_SIZE
+        for offset in offsets:
+            f.seek(offset)
+            block = f.read(block_size)
+            _account_read(len(block))
+            hash_md5.update(block)
     return hash_md5.hexdigest()
 
-def choose_n_files(path, pattern, n):
-    all_files = glob(os.path.join(path, pattern))
-    if len(all_files) <= n:
-        return all_files
+def quick_check_fields(fname):
+    """
+    Returns the quick check data to record in a manifest for fname, as a dict with keys 'size' and 'quick'.
+    """
+    return {'size': str(os.path.getsize(fname)), 'quick': quick_hash(fname)}
+
+def is_rotation_due(fname, rotate, slot=None):
+    """
+    Decide if a file is due for full verification on a rotating schedule that covers every file once every rotate
+    slots (by default, days). Files are assigned to slots by a checksum of their path.
+    :param rotate: number of slots in the rotation. If None or less than 1, no file is ever due.
+    :param slot: the current slot; defaults to the number of days since the epoch.
+    """
+    if rotate is None or rotate < 1:
+        return False
+    if slot is None:
+        slot = int(time.time() // 86400)
+    return zlib.crc32(fname.encode('utf-8')) % rotate == slot % rotate
+
+def verify_file(fname, expected, tiered=False, full=False, cache=None, rehash=False, chunk_size=DEFAULT_CHUNK_SIZE):
+    """
+    Check a file against the hashes listed for it in a manifest.
+    :param fname: the file to check
+    :param expected: dict of expected hashes, as returned by parse_manifest_hashes
+    :param tiered: if True and expected includes quick check data, check the size and quick hash first and only
+     hash the whole file if those do not match.
+    :param full: if True, always hash the whole file even when tiered is True (e.g. because it is due in the
+     rotation)
+    :param cache: HashCache to use for full hashes, passed to cached_compute_hashes along with rehash
+    :return: tuple of (True if the file matches, the tier that decided it, 'quick' or 'full')
+    """
+    full_hashes = dict((a, d) for a, d in expected.items() if a not in _quick_keys)
+    has_quick = all(k in expected for k in _quick_keys)
+    if tiered and has_quick and not full:
+        if os.path.getsize(fname) == int(expected['size']) and quick_hash(fname) == expected['quick']:
+            return True, 'quick'
+
+    if not full_hashes:
+        # Nothing else to check against
+        return quick_check_fields(fname) == dict((k, expected[k]) for k in _quick_keys), 'quick'
+    local_hashes = cached_compute_hashes(fname, algorithms=sorted(full_hashes.keys()), cache=cache, rehash=rehash,
+                                         chunk_size=chunk_size)
+    return local_hashes == full_hashes, 'full'
+
+def format_manifest_entry(fname, hashes):
+    """
+    Format one line of a hash manifest (without the newline).
+    :param fname: the file hashed
+    :param hashes: dict of algorithm name to hex digest, as returned by compute_hashes
+    :return: the line. If MD5 is the only algorithm, this is the original "file: hash" format; otherwise each hash
+     is written as algorithm=hash, separated by spaces, e.g. "file: md5=... sha256=...".
+    """
+    if list(hashes.keys()) == ['md5']:
+        return '{}: {}'.format(fname, hashes['md5'])
+    return '{}: {}'.format(fname, ' '.join('{}={}'.format(a, hashes[a]) for a in sorted(hashes.keys())))
+
+def parse_manifest_hashes(hash_str):
+    """
+    Parse the hash part of a manifest line (everything after the colon).
+    :return: dict of algorithm name to hex digest. A bare hash with no algorithm is taken to be MD5.
+    """
+    hash_str = hash_str.strip()
+    if '=' not in hash_str:
+        return {'md5': hash_str}
+    return dict(h.split('=', 1) for h in hash_str.split())
+
+# Sorted manifests. The first line is SORTED_MANIFEST_HEADER, then one "path<tab>algorithm=hash ..." line per file
+# in sorted order of path, with %, tab, newline, carriage return and # percent-escaped in the path. Then comes an index
+# of "#index<tab>path<tab>byte offset" lines for every SORTED_INDEX_INTERVAL-th entry, and finally a
+# "#end<tab>offset of the index<tab>number of entries" line.
+SORTED_MANIFEST_HEADER = '#hashcheck-manifest 2'
+SORTED_INDEX_INTERVAL = 1024
+_path_escapes = [('%', '%25'), ('\t', '%09'), ('\n', '%0A'), ('\r', '%0D'), ('#', '%23')]
+
+def escape_path(path):
+    for char, esc in _path_escapes:
+        path = path.replace(char, esc)
+    return path
+
+def unescape_path(path):
+    for char, esc in reversed(_path_escapes):
+        path = path.replace(esc, char)
+    return path
+
+def _format_sorted_line(path, hashes):
+    return '{}\t{}\n'.format(escape_path(path), ' '.join('{}={}'.format(a, hashes[a]) for a in sorted(hashes.keys())))
+
+def _parse_sorted_line(line):
+    path, hash_str = line.rstrip('\n').split('\t', 1)
+    return unescape_path(path), parse_manifest_hashes(hash_str)
+
+def _external_sort(entries, max_in_memory=100000):
+    # Sorts (path, hashes) pairs by path, spilling sorted runs to temporary files so that at most max_in_memory
+    # entries are held at once.
+    runs = []
+    buf = []
+    try:
+        for entry in entries:
+            buf.append(entry)
+            if len(buf) >= max_in_memory:
+                buf.sort(key=lambda e: e[0])
+                run = tempfile.TemporaryFile(mode='w+')
+                for path, hashes in buf:
+                    run.write(_format_sorted_line(path, hashes))
+                run.seek(0)
+                runs.append(run)
+                buf = []
+        buf.sort(key=lambda e: e[0])
+        if not runs:
+            for entry in buf:
+                yield entry
+            return
+
+        # Tag each entry with its run number so that equal paths never compare the hash dicts
+        streams = [((p, i, h) for p, h in (_parse_sorted_line(l) for l in run)) for i, run in enumerate(runs)]
+        streams.append((p, len(runs), h) for p, h in buf)
+        for path, _, hashes in heapq.merge(*streams):
+            yield path, hashes
+    finally:
+        for run in runs:
+            run.close()
+
+def write_sorted_manifest(entries, out_file, index_interval=SORTED_INDEX_INTERVAL, max_in_memory=100000):
+    """
+    Write a sorted, indexed manifest.
+    :param entries: iterable of (path, hashes dict) in any order. If they are not already sorted, they are sorted
+     externally with at most max_in_memory held in memory.
+    :param out_file: the manifest to write
+    :param index_interval: write an index entry for every this many entries
+    :return: the number of entries written
+    """
+    index = []
+    n = 0
+    last_path = None
+    with open(out_file, 'wb') as fobj:
+        fobj.write((SORTED_MANIFEST_HEADER + '\n').encode('utf-8'))
+        for path, hashes in _external_sort(entries, max_in_memory=max_in_memory):
+            if path == last_path:
+                # The same file reached twice, e.g. through overlapping directories
+                continue
+            if n % index_interval == 0:
+                index.append((path, fobj.tell()))
+            fobj.write(_format_sorted_line(path, hashes).encode('utf-8'))
+            last_path = path
+            n += 1
+        index_offset = fobj.tell()
+        for path, offset in index:
+            fobj.write('#index\t{}\t{}\n'.format(escape_path(path), offset).encode('utf-8'))
+        fobj.write('#end\t{}\t{}\n'.format(index_offset, n).encode('utf-8'))
+    return n
+
+def count_manifest_entries(manifest_file):
+    """
+    Count the entries in a manifest: read from the end line of a sorted manifest, or by counting lines otherwise.
+    """
+    if is_sorted_manifest(manifest_file):
+        with open(manifest_file, 'rb') as fobj:
+            fobj.seek(0, os.SEEK_END)
+            fobj.seek(max(0, fobj.tell() - 4096))
+            end_line = fobj.read().decode('utf-8').rstrip('\n').split('\n')[-1]
+        return int(end_line.split('\t')[2])
+    with open(manifest_file, 'rb') as fobj:
+        return sum(1 for _ in fobj)
+
+def is_sorted_manifest(manifest_file):
+    with open(manifest_file, 'rb') as fobj:
+        return fobj.readline().decode('utf-8').rstrip('\n') == SORTED_MANIFEST_HEADER
+
+def iter_manifest(manifest_file):
+    """
+    Iterate over the entries of a manifest in either format, in file order.
+    :return: generator of (path, hashes dict) tuples
+    """
+    if is_sorted_manifest(manifest_file):
+        with open(manifest_file, 'rb') as fobj:
+            fobj.readline()
+            for line in fobj:
+                line = line.decode('utf-8')
+                if line.startswith('#'):
+                    break
+                yield _parse_sorted_line(line)
+        return
+
+    with open(manifest_file, 'r') as comp:
+        for line in comp:
+            if line.count(':') != 1:
+                shell_error('The comparison file {} is formatted incorrectly, a line has a number of colons != 1'.format(manifest_file))
+            path, the_hash = line.split(':')
+            try:
+                hashes = parse_manifest_hashes(the_hash)
+            except ValueError:
+                shell_error('The comparison file {} is formatted incorrectly, could not parse the hashes for {}'.format(manifest_file, path))
+            yield path, hashes
+
+def iter_sorted_manifest(manifest_file, max_in_memory=100000):
+    """
+    Iterate over the entries of a manifest in sorted order of path. Sorted manifests are streamed directly, others
+    are sorted externally.
+    """
+    if is_sorted_manifest(manifest_file):
+        return iter_manifest(manifest_file)
+    return _external_sort(iter_manifest(manifest_file), max_in_memory=max_in_memory)
+
+def manifest_lookup(manifest_file, path):
+    """
+    Find one file in a sorted manifest using its index, reading at most one index interval of entries.
+    :return: the hashes dict for path, or None if it is not in the manifest
+    """
+    with open(manifest_file, 'rb') as fobj:
+        fobj.seek(0, os.SEEK_END)
+        size = fobj.tell()
+        fobj.seek(max(0, size - 4096))
+        end_line = fobj.read().decode('utf-8').rstrip('\n').split('\n')[-1]
+        if not end_line.startswith('#end\t'):
+            raise ValueError('{} is not a sorted manifest'.format(manifest_file))
+        index_offset = int(end_line.split('\t')[1])
+
+        fobj.seek(index_offset)
+        index_paths = []
+        index_offsets = []
+        for line in fobj:
+            parts = line.decode('utf-8').rstrip('\n').split('\t')
+            if parts[0] != '#index':
+                break
+            index_paths.append(unescape_path(parts[1]))
+            index_offsets.append(int(parts[2]))
+
+        i = bisect_right(index_paths, path) - 1
+        if i < 0:
+            return None
+        fobj.seek(index_offsets[i])
+        for line in fobj:
+            line = line.decode('utf-8')
+            if line.startswith('#'):
+                break
+            this_path, hashes = _parse_sorted_line(line)
+            if this_path == path:
+                return hashes
+            elif this_path > path:
+                break
+    return None
+
+def merge_join(left, right):
+    """
+    Merge two iterables of (path, value) sorted by path.
+    :return: generator of (path, left value or None, right value or None)
+    """
+    _end = object()
+    left = iter(left)
+    right = iter(right)
+    l = next(left, _end)
+    r = next(right, _end)
+    while l is not _end or r is not _end:
+        if r is _end or (l is not _end and l[0] < r[0]):
+            yield l[0], l[1], None
+            l = next(left, _end)
+        elif l is _end or r[0] < l[0]:
+            yield r[0], None, r[1]
+            r = next(right, _end)
+        else:
+            yield l[0], l[1], r[1]
+            l = next(left, _end)
+            r = next(right, _end)
+
+def diff_manifests(old_manifest, new_manifest):
+    """
+    Compare two manifests (in either format) with a streaming merge join.
+    :return: generator of (path, status) for every path that differs, status being 'ADDED' (only in new_manifest),
+     'REMOVED' (only in old_manifest) or 'CHANGED' (a hash for an algorithm in both differs)
+    """
+    for path, old, new in merge_join(iter_sorted_manifest(old_manifest), iter_sorted_manifest(new_manifest)):
+        if old is None:
+            yield path, 'ADDED'
+        elif new is None:
+            yield path, 'REMOVED'
+        elif any(old[a] != new[a] for a in old if a in new):
+            yield path, 'CHANGED'
+
+def write_manifest_diff(old_manifest, new_manifest, log_file):
+    """
+    Write the differences between two manifests to log_file, one "path: status" line each (with the path escaped as
+    in sorted manifests). Returns 1 if there were any differences, 0 otherwise.
+    """
+    ecode = 0
+    with open(log_file, 'w') as log:
+        for path, status in diff_manifests(old_manifest, new_manifest):
+            log.write('{}: {}\n'.format(escape_path(path), status))
+            ecode = 1
+    return ecode
+
+def benchmark_md5(fname, chunk_sizes=(4096, 65536, DEFAULT_CHUNK_SIZE), repeat=3):
+    """
+    Print the throughput of md5 on fname for each chunk size, with and without mmap. The fastest of repeat runs is
+    reported, so after the first run the file is usually coming from the page cache.
+    :return: list of (chunk_size, use_mmap, MB/s) tuples
+    """
+    size = os.path.getsize(fname)
+    results = []
+    for chunk_size in chunk_sizes:
+        for use_mmap in (False, True):
+            best = None
+            for i in range(repeat):
+                start = time.time()
+                md5(fname, chunk_size=chunk_size, use_mmap=use_mmap)
+                elapsed = time.time() - start
+                best = elapsed if best is None else min(best, elapsed)
+            rate = size / 1e6 / best if best > 0 else float('inf')
+            print('chunk size {:>9}, mmap {!s:>5}: {:10.1f} MB/s'.format(chunk_size, use_mmap, rate))
+            results.append((chunk_size, use_mmap, rate))
+    return results
+
+def _reservoir_sample(iterable, n, rng):
+    # Algorithm R: one pass, keeps at most n items. Returns the sample and the number of items seen.
+    sample = []
+    n_seen = 0
+    for item in iterable:
+        n_seen += 1
+        if len(sample) < n:
+            sample.append(item)
+        else:
+            j = rng.randint(0, n_seen - 1)
+            if j < n:
+                sample[j] = item
+    return sample, n_seen
+
+def _name_matches(name, pattern):
+    # Hidden files only match a pattern that starts with a '.', as in glob
+    if name.startswith('.') and not pattern.startswith('.'):
+        return False
+    return fnmatch(name, pattern)
+
+def _has_dir_part(pattern):
+    return os.path.dirname(pattern) != ''
+
+def _check_name_pattern(pattern):
+    if _has_dir_part(pattern):
+        raise ValueError('Pattern "{}" has a directory part, but can only match file names here'.format(pattern))
+
+def _iter_dir_files(path, pattern):
+    # Like glob(os.path.join(path, pattern)), but as a generator over files only. A directory part of the pattern
+    # (e.g. 'sub*/*.dat') is expanded with glob, which only has to list directories, and then each directory found
+    # is scanned for files matching the rest.
+    dir_pattern, name_pattern = os.path.split(pattern)
+    if dir_pattern:
+        dirs = sorted(d for d in glob(os.path.join(path, dir_pattern)) if os.path.isdir(d))
+    else:
+        dirs = [path]
+    for this_dir in dirs:
+        for entry in scandir(this_dir):
+            if entry.is_file() and _name_matches(entry.name, name_pattern):
+                yield entry.path
+
+def choose_n_files(path, pattern, n, seed=None, stratified=False):
+    """
+    Randomly choose up to n files matching pattern in a directory, in a single pass over the listing so that huge
+    directories need not be held in memory.
+    :param path: the directory
+    :param pattern: glob pattern the file names must match. As with glob, it may have a directory part relative to
+     path (e.g. 'sub/*.dat'), except when stratified is True.
+    :param n: number of files to choose. If there are no more than this, all of them are returned.
+    :param seed: an int to seed the random choice with, so the sample is reproducible for the same directory
+     contents, or a random.Random instance to draw from. If None, the random module's shared generator is used.
+    :param stratified: if True, the n files are spread as evenly as possible over the files directly in path and
+     each of its subdirectories (including their subdirectories), rather than just the files directly in path.
+    :return: list of file paths
+    """
+    if isinstance(seed, random.Random):
+        rng = seed
+    elif seed is not None:
+        rng = random.Random(seed)
+    else:
+        rng = random
+
+    if not stratified:
+        files, _ = _reservoir_sample(_iter_dir_files(path, pattern), n, rng)
+        return files
+
+    # One reservoir per stratum, then share n out between them so that small strata give all their files and the
+    # rest is split evenly between the larger ones.
+    _check_name_pattern(pattern)
+    strata = [_reservoir_sample(_iter_dir_files(path, pattern), n, rng)]
+    subdirs = sorted(e.path for e in scandir(path) if e.is_dir(follow_symlinks=False))
+    for subdir in subdirs:
+        strata.append(_reservoir_sample(iter_tree(subdir, pattern), n, rng))
+    strata = [st for st in strata if st[1] > 0]
+
+    allocation = [0] * len(strata)
+    remaining = n
+    open_strata = list(range(len(strata)))
+    while remaining > 0 and open_strata:
+        share = max(1, remaining // len(open_strata))
+        for i in list(open_strata):
+            if remaining == 0:
+                break
+            take = min(share, len(strata[i][0]) - allocation[i], remaining)
+            allocation[i] += take
+            remaining -= take
+            if allocation[i] == len(strata[i][0]):
+                open_strata.remove(i)
 
     files = []
-    for i in range(n):
-        f = random.choice(all_files)
-        all_files.remove(f)
-        files.append(f)
+    for (sample, _), n_take in zip(strata, allocation):
+        files.extend(rng.sample(sample, n_take))
     return files
 
-def print_hashes(hash_file, pattern, n_files, *dirs):
+def _item_path(item):
+    # Items passed through iter_hashes are file names or tuples starting with one
+    return item if isinstance(item, str) else item[0]
+
+def _monitored(hash_fxn, monitor):
+    # Wraps hash_fxn so that its reads are throttled and counted by monitor, and its time is recorded when it finishes
+    def monitored_fxn(item):
+        _thread_monitor.monitor = monitor
+        monitor.start_file()
+        start = time.time()
+        try:
+            return hash_fxn(item)
+        finally:
+            _thread_monitor.monitor = None
+            monitor.file_done(_item_path(item), time.time() - start)
+    return monitored_fxn
+
+def iter_hashes(items, jobs=1, hash_fxn=md5, window=None, monitor=None, io_concurrency=None):
+    """
+    Hash files concurrently with a pool of threads, yielding results in the same order as the input.
+    :param items: iterable of things to hash, usually file names. Consumed lazily.
+    :param jobs: number of worker threads. With 1 or fewer, everything is hashed in the calling thread.
+    :param hash_fxn: function called on each item in a worker thread, defaults to md5.
+    :param window: maximum number of items in flight at once, defaults to 4 * jobs. This bounds memory use when
+     items is very long.
+    :param monitor: an IOMonitor to throttle and count the reads made by hash_fxn
+    :param io_concurrency: if given, use the asyncio pipeline in hashcheck_async instead (Python 3 only), which
+     stat's, opens, and prefetches this many files at once ahead of the jobs hashing threads. Meant for filesystems
+     with high latency per file. If monitor limits the bandwidth or read rate, files are only stat'ed and opened
+     ahead, not read, so the limits still hold.
+    :return: generator of (item, hash_fxn(item)) tuples. If hash_fxn raises, the exception is raised from here.
+    """
+    if monitor is not None:
+        hash_fxn = _monitored(hash_fxn, monitor)
+
+    if io_concurrency is not None:
+        try:
+            from jllutils import hashcheck_async
+        except ImportError:
+            import hashcheck_async
+        throttled = monitor is not None and (monitor.max_bytes_per_sec or monitor.max_iops)
+        kwargs = {'prefetch_bytes': 0} if throttled else {}
+        for result in hashcheck_async.iter_hashes_async(items, hash_fxn, jobs=jobs, io_concurrency=io_concurrency,
+                                                         window=window, **kwargs):
+            yield result
+        return
+
+    if jobs <= 1:
+        for item in items:
+            yield item, hash_fxn(item)
+        return
+
+    if window is None:
+        window = 4 * jobs
+    pool = ThreadPool(processes=jobs)
+    pending = deque()
+    try:
+        for item in items:
+            pending.append((item, pool.apply_async(hash_fxn, (item,))))
+            if len(pending) >= window:
+                done_item, result = pending.popleft()
+                yield done_item, result.get()
+        while pending:
+            done_item, result = pending.popleft()
+            yield done_item, result.get()
+    finally:
+        pool.terminate()
+        pool.join()
+
+def _sorted_dir_entries(path):
+    # Directory entries in reverse order of the full paths below them: a directory sorts as its name plus a
+    # separator, so that walking depth first yields paths in plain string order.
+    try:
+        entries = list(scandir(path))
+    except OSError as err:
+        shell_msg('Could not list directory {}: {}'.format(path, err))
+        return []
+    keyed = [(e.name + os.sep if e.is_dir(follow_symlinks=False) else e.name, e) for e in entries]
+    keyed.sort(key=lambda k: k[0], reverse=True)
+    return [e for _, e in keyed]
+
+def iter_tree(path, pattern='*'):
+    """
+    Walk a directory tree with os.scandir, yielding files as they are found rather than listing the whole tree first.
+    Only the listings of the directories on the current path are held, so memory use is bounded by the size of the
+    largest directory (times the depth of the tree) rather than by the total number of files. Files are yielded in
+    sorted order of their full paths, so the output is deterministic and can be merged against a sorted manifest.
+    Symbolic links to directories are not followed.
+    :param path: the top directory
+    :param pattern: glob pattern that file names (not directory names) must match. As in glob and choose_n_files,
+     hidden files only match a pattern that starts with a '.'. A pattern with a directory part raises ValueError.
+    :return: generator of file paths, each joined onto path
+    """
+    _check_name_pattern(pattern)
+    stack = [_sorted_dir_entries(path)]
+    while stack:
+        if not stack[-1]:
+            stack.pop()
+            continue
+        entry = stack[-1].pop()
+        if entry.is_dir(follow_symlinks=False):
+            stack.append(_sorted_dir_entries(entry.path))
+        elif entry.is_file() and _name_matches(entry.name, pattern):
+            yield entry.path
+
+def iter_trees(dirs, pattern='*'):
+    """
+    iter_tree over several directories, visiting them in an order that keeps the paths sorted overall
+    """
+    for top in sorted(dirs, key=lambda d: d.rstrip(os.sep) + os.sep):
+        for f in iter_tree(top, pattern):
+            yield f
+
+def print_hashes(hash_file, pattern, n_files, *dirs, **kwargs):
+    jobs = kwargs.get('jobs', 1)
+    chunk_size = kwargs.get('chunk_size', DEFAULT_CHUNK_SIZE)
+    algorithms = kwargs.get('algorithms', ('md5',))
+    cache = kwargs.get('cache', None)
+    rehash = kwargs.get('rehash', False)
+    recursive = kwargs.get('recursive', False)
+    stratified = kwargs.get('stratified', False)
+    seed = kwargs.get('seed', None)
+    quick = kwargs.get('quick', False)
+    sorted_manifest = kwargs.get('sorted_manifest', False)
+    monitor = kwargs.get('monitor', None)
+    io_concurrency = kwargs.get('io_concurrency', None)
+    if recursive:
+        # Full manifest: every matching file under each directory, streamed straight through to the output
+        all_files = iter_trees(dirs, pattern)
+    else:
+        # Use one generator for all directories so that a seed does not make every directory sample the same way
+        rng = random.Random(seed) if seed is not None else None
+        all_files = (f for dir in dirs for f in choose_n_files(dir, pattern, n_files, seed=rng, stratified=stratified))
+    def hash_fxn(f):
+        hashes = cached_compute_hashes(f, algorithms=algorithms, cache=cache, rehash=rehash, chunk_size=chunk_size)
+        if quick:
+            hashes.update(quick_check_fields(f))
+        return hashes
+    if sorted_manifest:
+        write_sorted_manifest(iter_hashes(all_files, jobs=jobs, hash_fxn=hash_fxn, monitor=monitor,
+                                          io_concurrency=io_concurrency), hash_file)
+        return
     with open(hash_file, 'w') as fobj:
-        for dir in dirs:
-            files = choose_n_files(dir, pattern, n_files)
-            for this_file in files:
-                md5_hash = md5(this_file)
-                fobj.write('{}: {}\n'.format(this_file, md5_hash))
+        for this_file, hashes in iter_hashes(all_files, jobs=jobs, hash_fxn=hash_fxn, monitor=monitor,
+                                             io_concurrency=io_concurrency):
+            fobj.write(format_manifest_entry(this_file, hashes) + '\n')
+
+def _iter_comparison_file(comparison_file):
+    for file_to_compare, hashes in iter_manifest(comparison_file):
+        if not os.path.isfile(file_to_compare):
+            shell_msg('File {} does not exist locally'.format(file_to_compare))
+            continue
+        yield file_to_compare, hashes
+
+def _format_unavailable(fname, expected):
+    return '{}: UNKNOWN ALGORITHM {}\n'.format(fname, ', '.join(unavailable_algorithms(expected)))
 
-def compare_hashed(comparison_file, log_file):
+def compare_hashed(comparison_file, log_file, jobs=1, chunk_size=DEFAULT_CHUNK_SIZE, cache=None, rehash=False,
+                   tiered=False, rotate=None, rotate_slot=None, monitor=None, io_concurrency=None):
+    # Each entry is checked with every algorithm the manifest lists for it, all from a single read of the file.
+    # In tiered mode, entries with quick check data are first checked by size and quick hash, and only fully hashed if
+    # that fails or if they are due in the rotation. The log then also says which tier confirmed each file.
+    # Entries listing an algorithm that cannot be computed here are logged as such rather than checked.
     comparison_dict = {True:'Match', False:'DOES NOT MATCH'}
     ecode = 0
-    with open(comparison_file, 'r') as comp:
-        with open(log_file, 'w') as log:
-            for line in comp:
-                if line.count(':') != 1:
-                    shell_error('The comparison file {} is formatted incorrectly, a line has a number of colons != 1'.format(comparison_file))
-                file_to_compare, the_hash = line.split(':')
-                if not os.path.isfile(file_to_compare):
-                    shell_msg('File {} does not exist locally'.format(file_to_compare))
-                    continue
+    def verify(entry):
+        fname, expected = entry
+        if unavailable_algorithms(expected):
+            return None
+        return verify_file(fname, expected, tiered=tiered, full=is_rotation_due(fname, rotate, rotate_slot),
+                           cache=cache, rehash=rehash, chunk_size=chunk_size)
+
+    if monitor is not None:
+        monitor.set_total_files(count_manifest_entries(comparison_file))
+    with open(log_file, 'w') as log:
+        entries = _iter_comparison_file(comparison_file)
+        for (file_to_compare, expected), result in iter_hashes(entries, jobs=jobs, hash_fxn=verify, monitor=monitor,
+                                                               io_concurrency=io_concurrency):
+            if result is None:
+                ecode = 1
+                log.write(_format_unavailable(file_to_compare, expected))
+                continue
+            hash_check, tier = result
+            if not hash_check:
+                ecode = 1
+            if tiered:
+                log.write('{}: {} [{}]\n'.format(file_to_compare, comparison_dict[hash_check], tier))
+            else:
+                log.write('{}: {}\n'.format(file_to_compare, comparison_dict[hash_check]))
+    return ecode
 
-                local_hash = md5(file_to_compare)
-                hash_check = local_hash == the_hash.strip()
+
+
+def compare_hashed_tree(comparison_file, log_file, dirs, pattern='*', jobs=1, chunk_size=DEFAULT_CHUNK_SIZE,
+                        cache=None, rehash=False, tiered=False, rotate=None, rotate_slot=None, monitor=None,
+                        io_concurrency=None):
+    """
+    Compare a manifest against the files now in one or more directory trees with a streaming merge join, so neither
+    side is loaded into memory. Files in both are verified as in compare_hashed. Files only in the manifest are
+    reported to stderr as not existing locally, and files only in the trees are logged as NOT IN MANIFEST. The
+    manifest may be in either format, but an unsorted one must be sorted (externally) first.
+    :return: exit code, 1 if any file did not match, 0 otherwise.
+    """
+    comparison_dict = {True:'Match', False:'DOES NOT MATCH'}
+    ecode = 0
+    def verify(joined):
+        path, expected, local = joined
+        if expected is None or local is None or unavailable_algorithms(expected):
+            return None
+        return verify_file(path, expected, tiered=tiered, full=is_rotation_due(path, rotate, rotate_slot),
+                           cache=cache, rehash=rehash, chunk_size=chunk_size)
+
+    joined = merge_join(iter_sorted_manifest(comparison_file), ((f, True) for f in iter_trees(dirs, pattern)))
+    with open(log_file, 'w') as log:
+        for (path, expected, local), result in iter_hashes(joined, jobs=jobs, hash_fxn=verify, monitor=monitor,
+                                                           io_concurrency=io_concurrency):
+            if local is None:
+                shell_msg('File {} does not exist locally'.format(path))
+            elif expected is None:
+                log.write('{}: NOT IN MANIFEST\n'.format(path))
+            elif result is None:
+                ecode = 1
+                log.write(_format_unavailable(path, expected))
+            else:
+                hash_check, tier = result
                 if not hash_check:
                     ecode = 1
-                log.write('{}: {}\n'.format(file_to_compare, comparison_dict[hash_check]))
+                if tiered:
+                    log.write('{}: {} [{}]\n'.format(path, comparison_dict[hash_check], tier))
+                else:
+                    log.write('{}: {}\n'.format(path, comparison_dict[hash_check]))
     return ecode
 
 
@@ -70,32 +1071,146 @@ def get_args():
                         help='Number of files per directory to hash, default %(default)s')
     parser.add_argument('--pattern', '-p', default='*',
                         help='Glob pattern to filter files chosen, default is %(default)s')
+    parser.add_argument('--sorted', action='store_true', dest='sorted_manifest',
+                        help='Write a manifest sorted by path, with tab separated fields, escaped paths (so they may\n'
+                             'contain colons), and an index at the end. Required for fast comparisons of very large\n'
+                             'manifests, though --compare and --diff accept either format.')
+    parser.add_argument('--diff', nargs=2, default=None, metavar=('OLD', 'NEW'),
+                        help='Compare two manifests instead of hashing anything, writing the files that were added,\n'
+                             'removed, or changed to the output file.')
+    parser.add_argument('--seed', default=None, type=int,
+                        help='Seed for choosing which files to hash, so the same files are chosen each time the\n'
+                             'directories are unchanged.')
+    parser.add_argument('--stratified', action='store_true',
+                        help='Spread the --files-per-dir files chosen from each directory as evenly as possible\n'
+                             'over its own files and each of its subdirectories.')
+    parser.add_argument('--recursive', '-r', action='store_true',
+                        help='Hash every file matching --pattern in the directories and all their subdirectories,\n'
+                             'instead of --files-per-dir files from each directory.')
     parser.add_argument('--compare', '-c', default=None,
                         help='Changes the behavior of this function, will read from the file given to this argument\n'
                              'and compare the hashes listed in that file against those it calculates from local files.\n'
                              'This means the file given as this argument must be the output from running %(prog)s normally\n'
-                             'and that this must be run from a directory with equivalent structure.')
+                             'and that this must be run from a directory with equivalent structure.\n'
+                             'If directories are also given, every file under them matching --pattern is compared\n'
+                             'against the manifest, and files not in it are logged too.')
+    parser.add_argument('--jobs', '-j', default=1, type=int,
+                        help='Number of files to hash at once, default %(default)s. The output is in the same\n'
+                             'order regardless.')
+    parser.add_argument('--io-concurrency', default=None, type=int,
+                        help='Use an asyncio pipeline that stats, opens, and starts reading this many files at once\n'
+                             'ahead of the --jobs hashing threads. Helps on network filesystems, where the latency\n'
+                             'of each file matters more than bandwidth. Requires Python 3.')
+    parser.add_argument('--chunk-size', default=DEFAULT_CHUNK_SIZE, type=int,
+                        help='Number of bytes to read from a file at once, default %(default)s')
+    parser.add_argument('--algorithm', '-a', action='append', dest='algorithms', default=None,
+                        help='Hash algorithm to use, e.g. md5, sha256, or blake2b. May be given multiple times to\n'
+                             'compute several hashes from one read of each file. Default is md5 only, which writes\n'
+                             'the original "file: hash" format; otherwise each hash is written as algorithm=hash.\n'
+                             'Ignored with --compare, which uses whatever algorithms the comparison file lists.')
+    parser.add_argument('--quick-check', '-q', action='store_true', dest='quick',
+                        help='Also record the size and a quick hash of the head, tail, and a few interior blocks\n'
+                             'of each file in the output, for use with --compare --tiered.')
+    parser.add_argument('--tiered', action='store_true',
+                        help='With --compare, first check files by their size and quick hash (if the comparison\n'
+                             'file has them) and only hash the whole file if that fails or the file is due in the\n'
+                             '--rotate schedule. The log says which tier, quick or full, confirmed each file.')
+    parser.add_argument('--rotate', default=None, type=int,
+                        help='With --tiered, fully hash each file once every this many days anyway, spreading\n'
+                             'the files evenly over the days.')
+    parser.add_argument('--rotate-slot', default=None, type=int,
+                        help='Use this slot in the --rotate schedule instead of the number of days since the epoch.')
+    parser.add_argument('--max-bandwidth', default=None, type=_parse_size,
+                        help='Limit reading to this many bytes per second across all jobs. Accepts K, M, G, and T\n'
+                             'suffixes (powers of 1024), e.g. 100M.')
+    parser.add_argument('--max-iops', default=None, type=float,
+                        help='Limit reading to this many read calls per second across all jobs.')
+    parser.add_argument('--progress', default=None, type=float, metavar='SECONDS',
+                        help='Print the throughput (and ETA when comparing) to stderr every SECONDS seconds, and a\n'
+                             'summary with per-directory timing at the end.')
+    parser.add_argument('--summary-json', default=None,
+                        help='Save the end of run summary, including per-directory timing, to this JSON file.')
+    parser.add_argument('--cache', default=None,
+                        help='SQLite database file to cache hashes in between runs. Files whose device, inode, size,\n'
+                             'and modification time are unchanged since they were cached are not read again.')
+    parser.add_argument('--rehash', action='store_true',
+                        help='With --cache, read and hash every file anyway (updating the cache), e.g. to catch\n'
+                             'corruption that did not change the size or modification time.')
+    parser.add_argument('--prune-cache', action='store_true',
+                        help='With --cache, remove entries for files that no longer exist or have changed at the end.')
+    parser.add_argument('--cache-max-entries', default=None, type=int,
+                        help='With --cache, keep at most this many entries, removing the least recently used.')
     parser.add_argument('out_file', help='File to save the list of hashes in')
     parser.add_argument('directories', nargs=argparse.REMAINDER, help='Directories to hash files from. At least one required.')
 
     args = parser.parse_args()
 
-    if args.compare is None and len(args.directories) < 1:
+    if args.compare is None and args.diff is None and len(args.directories) < 1:
         shell_error('At least one directory must be specified')
     else:
         for this_dir in args.directories:
             if not os.path.isdir(this_dir):
                 shell_error('{} is not a valid directory'.format(this_dir))
 
-    return args.directories, args.out_file, args.compare, args.pattern, args.files_per_dir
+    if _has_dir_part(args.pattern) and (args.recursive or args.stratified or
+                                        (args.compare is not None and args.directories)):
+        shell_error('--pattern can only have a directory part ({}) when sampling --files-per-dir files without '
+                    '--stratified; with --recursive, --stratified, or --compare on directories it must only match '
+                    'file names'.format(args.pattern))
+    if args.jobs < 1:
+        shell_error('--jobs must be at least 1')
+    if args.io_concurrency is not None and args.io_concurrency < 1:
+        shell_error('--io-concurrency must be at least 1')
+    if args.chunk_size < 1:
+        shell_error('--chunk-size must be at least 1')
+
+    if args.algorithms is None:
+        args.algorithms = ['md5']
+    for alg in unavailable_algorithms(args.algorithms):
+        shell_error('{} is not a hash algorithm available to hashlib'.format(alg))
+    # Keep the order of the given algorithms but drop duplicates
+    args.algorithms = [a for i, a in enumerate(args.algorithms) if a not in args.algorithms[:i]]
+
+    return args
 
 def main():
-    directories, out_file, comparison_file, pattern, nfiles = get_args()
-    if comparison_file is None:
-        print_hashes(out_file, pattern, nfiles, *directories)
-        ecode = 0
-    else:
-        ecode = compare_hashed(comparison_file, out_file)
+    args = get_args()
+    cache = HashCache(args.cache) if args.cache is not None else None
+    monitor = None
+    if any(x is not None for x in (args.max_bandwidth, args.max_iops, args.progress, args.summary_json)):
+        monitor = IOMonitor(max_bytes_per_sec=args.max_bandwidth, max_iops=args.max_iops,
+                            report_interval=args.progress)
+    try:
+        if args.diff is not None:
+            ecode = write_manifest_diff(args.diff[0], args.diff[1], args.out_file)
+        elif args.compare is not None and len(args.directories) > 0:
+            ecode = compare_hashed_tree(args.compare, args.out_file, args.directories, pattern=args.pattern,
+                                        jobs=args.jobs, chunk_size=args.chunk_size, cache=cache, rehash=args.rehash,
+                                        tiered=args.tiered, rotate=args.rotate, rotate_slot=args.rotate_slot,
+                                        monitor=monitor, io_concurrency=args.io_concurrency)
+        elif args.compare is None:
+            print_hashes(args.out_file, args.pattern, args.files_per_dir, *args.directories, jobs=args.jobs,
+                         chunk_size=args.chunk_size, algorithms=args.algorithms, cache=cache, rehash=args.rehash,
+                         recursive=args.recursive, seed=args.seed, stratified=args.stratified, quick=args.quick,
+                         sorted_manifest=args.sorted_manifest, monitor=monitor,
+                         io_concurrency=args.io_concurrency)
+            ecode = 0
+        else:
+            ecode = compare_hashed(args.compare, args.out_file, jobs=args.jobs, chunk_size=args.chunk_size,
+                                   cache=cache, rehash=args.rehash, tiered=args.tiered, rotate=args.rotate,
+                                   rotate_slot=args.rotate_slot, monitor=monitor,
+                                   io_concurrency=args.io_concurrency)
+        if cache is not None and (args.prune_cache or args.cache_max_entries is not None):
+            cache.prune(max_entries=args.cache_max_entries)
+        if monitor is not None:
+            monitor.finish()
+            if args.progress is not None:
+                monitor.print_summary()
+            if args.summary_json is not None:
+                monitor.write_summary_json(args.summary_json)
+    finally:
+        if cache is not None:
+            cache.close()
 
     exit(ecode)
 
@@ -0,0 +1,116 @@
+"""
+An asyncio pipeline for hashcheck, for filesystems where the latency of each stat, open, and first read matters more
+than bandwidth, e.g. network filesystems. Many files are stat'ed, opened, and have their first blocks requested at
+once, so that by the time a file reaches one of the hashing threads its data is already on the way or cached locally.
+
+This module needs Python 3.6 or later; hashcheck only imports it when asked to use it.
+"""
+import asyncio
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import os
+
+try:
+    from jllutils.hashcheck import _item_path
+except ImportError:
+    from hashcheck import _item_path
+
+DEFAULT_IO_CONCURRENCY = 32
+DEFAULT_PREFETCH_BYTES = 4 * 1024**2
+
+
+def prefetch_file(fname, prefetch_bytes=DEFAULT_PREFETCH_BYTES):
+    """
+    Stat and open a file and ask for its first prefetch_bytes to be read into the OS cache, without waiting for them
+    where posix_fadvise is available (otherwise they are read and discarded). Errors are ignored here, so that the
+    hash function reports them as it would without prefetching.
+    :param fname: the file to prefetch
+    :param prefetch_bytes: how much of the start of the file to request. With 0, the file is only stat'ed and opened.
+    """
+    try:
+        fd = os.open(fname, os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fstat(fd)
+        if prefetch_bytes <= 0:
+            return
+        if hasattr(os, 'posix_fadvise'):
+            os.posix_fadvise(fd, 0, prefetch_bytes, os.POSIX_FADV_WILLNEED)
+        else:
+            remaining = prefetch_bytes
+            while remaining > 0:
+                data = os.read(fd, min(remaining, 1048576))
+                if not data:
+                    break
+                remaining -= len(data)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+
+async def aiter_hashes(items, hash_fxn, jobs=1, io_concurrency=DEFAULT_IO_CONCURRENCY, window=None,
+                       prefetch_bytes=DEFAULT_PREFETCH_BYTES):
+    """
+    Asynchronous counterpart of hashcheck.iter_hashes. Each item is first prefetched by one of io_concurrency I/O
+    threads and then passed to hash_fxn in one of jobs hashing threads. Results are yielded in input order.
+    :param items: iterable of things to hash, usually file names. Consumed lazily.
+    :param hash_fxn: function called on each item in a hashing thread
+    :param jobs: number of hashing threads
+    :param io_concurrency: number of files being stat'ed, opened, and prefetched at once
+    :param window: maximum number of items started but not yet yielded, defaults to io_concurrency + 4 * jobs. No
+     more items are taken from the input until the oldest one is yielded, which bounds memory use and how far the
+     prefetching runs ahead of the hashing.
+    :param prefetch_bytes: see prefetch_file
+    :return: async generator of (item, hash_fxn(item)) tuples. If hash_fxn raises, the exception is raised from here.
+    """
+    if window is None:
+        window = io_concurrency + 4 * jobs
+    loop = asyncio.get_event_loop()
+    io_pool = ThreadPoolExecutor(max_workers=io_concurrency)
+    hash_pool = ThreadPoolExecutor(max_workers=jobs)
+
+    async def process(item):
+        await loop.run_in_executor(io_pool, prefetch_file, _item_path(item), prefetch_bytes)
+        return await loop.run_in_executor(hash_pool, hash_fxn, item)
+
+    pending = deque()
+    try:
+        for item in items:
+            pending.append((item, asyncio.ensure_future(process(item))))
+            if len(pending) >= window:
+                done_item, future = pending.popleft()
+                yield done_item, await future
+        while pending:
+            done_item, future = pending.popleft()
+            yield done_item, await future
+    finally:
+        for _, future in pending:
+            future.cancel()
+        if pending:
+            await asyncio.gather(*[f for _, f in pending], return_exceptions=True)
+        io_pool.shutdown(wait=True)
+        hash_pool.shutdown(wait=True)
+
+
+def iter_hashes_async(items, hash_fxn, jobs=1, io_concurrency=DEFAULT_IO_CONCURRENCY, window=None,
+                      prefetch_bytes=DEFAULT_PREFETCH_BYTES):
+    """
+    Run aiter_hashes in its own event loop, as an ordinary generator that can replace hashcheck.iter_hashes.
+    Arguments are the same as aiter_hashes.
+    """
+    loop = asyncio.new_event_loop()
+    results = aiter_hashes(items, hash_fxn, jobs=jobs, io_concurrency=io_concurrency, window=window,
+                           prefetch_bytes=prefetch_bytes)
+    try:
+        asyncio.set_event_loop(loop)
+        while True:
+            try:
+                yield loop.run_until_complete(results.__anext__())
+            except StopAsyncIteration:
+                break
+    finally:
+        loop.run_until_complete(results.aclose())
+        asyncio.set_event_loop(None)
+        loop.close()
@@ -0,0 +1,342 @@
+#!/usr/bin/env python
+#
+# itunesbench.py - benchmarks for itunesxml on synthetic iTunes libraries. Writes timing, peak memory, and
+#   throughput for parse_itunes_lib, music_diff, and assemble_report to a JSON file, and can compare that against
+#   the results of a previous run to look for regressions.
+from __future__ import print_function
+from __future__ import division
+
+import argparse
+import datetime as dt
+import json
+import multiprocessing
+import os
+import platform
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+try:
+    import resource
+except ImportError:
+    # Not available on Windows, so peak memory will not be recorded
+    resource = None
+
+from jllutils import itunesxml
+
+_genres = ['Rock', 'Pop', 'Jazz', 'Classical', 'Electronic', 'Hip-Hop', 'Folk', 'Soundtrack']
+_kinds = ['MPEG audio file', 'AAC audio file', 'Purchased AAC audio file', 'Apple Lossless audio file']
+
+
+def shell_error(msg, exit_code=2):
+    print(msg, file=sys.stderr)
+    exit(exit_code)
+
+
+def _xml_date(d):
+    return d.strftime('%Y-%m-%dT%H:%M:%SZ')
+
+
+def _write_track(fobj, track_id, i, rng, changed=False):
+    artist = i % 997
+    album = i % 4999
+    date_added = dt.datetime(2010, 1, 1) + dt.timedelta(seconds=rng.randint(0, 2 * 10**8))
+    fobj.write('\t\t<key>{0}</key>\n\t\t<dict>\n'.format(track_id))
+    entries = [('Track ID', 'integer', track_id),
+               ('Name', 'string', 'Track {} of album {}'.format(i % 17 + 1, album)),
+               ('Artist', 'string', 'Artist {}'.format(artist)),
+               ('Album Artist', 'string', 'Artist {}'.format(artist)),
+               ('Composer', 'string', 'Composer {}'.format(i % 311)),
+               ('Album', 'string', 'Album {}'.format(album)),
+               ('Genre', 'string', _genres[album % len(_genres)]),
+               ('Kind', 'string', _kinds[album % len(_kinds)]),
+               ('Size', 'integer', rng.randint(10**6, 2 * 10**7)),
+               ('Total Time', 'integer', rng.randint(60000, 600000)),
+               ('Disc Number', 'integer', 1),
+               ('Disc Count', 'integer', 1),
+               ('Track Number', 'integer', i % 17 + 1),
+               ('Track Count', 'integer', 17),
+               ('Year', 'integer', 1960 + album % 60),
+               ('Date Modified', 'date', _xml_date(date_added + dt.timedelta(days=3))),
+               ('Date Added', 'date', _xml_date(date_added)),
+               ('Bit Rate', 'integer', 256),
+               ('Sample Rate', 'integer', 44100),
+               ('Play Count', 'integer', rng.randint(0, 200)),
+               ('Play Date', 'integer', rng.randint(3 * 10**9, 4 * 10**9)),
+               ('Play Date UTC', 'date', _xml_date(date_added + dt.timedelta(days=30))),
+               ('Rating', 'integer', 20 * rng.randint(0, 5)),
+               ('Persistent ID', 'string', '{:016X}'.format(rng.getrandbits(64))),
+               ('Track Type', 'string', 'File'),
+               ('Location', 'string', 'file:///Users/me/Music/iTunes/Artist%20{}/Album%20{}/{:02}.m4a'
+                .format(artist, album, i % 17 + 1)),
+               ('File Folder Count', 'integer', 5),
+               ('Library Folder Count', 'integer', 1)]
+    if changed:
+        # As if the file had been re-encoded and retagged: same identity (name, artist, album, year), new contents
+        changes = {'Genre': _genres[(album + 1) % len(_genres)], 'Bit Rate': 320,
+                   'Size': entries[8][2] + 4096, 'Date Modified': _xml_date(date_added + dt.timedelta(days=400))}
+        entries = [(key, tag, changes.get(key, val)) for key, tag, val in entries]
+    for key, tag, val in entries:
+        fobj.write('\t\t\t<key>{0}</key><{1}>{2}</{1}>\n'.format(key, tag, val))
+    fobj.write('\t\t\t<key>Compilation</key><{}/>\n'.format('true' if album % 23 == 0 else 'false'))
+    fobj.write('\t\t</dict>\n')
+
+
+def write_synthetic_library(lib_file, n_tracks, n_playlists=None, tracks_per_playlist=50, seed=0, variant=0,
+                            change_fraction=0.01):
+    """
+    Write a synthetic iTunes library XML file.
+    :param lib_file: the file to write
+    :param n_tracks: number of tracks in the base library
+    :param n_playlists: number of playlists besides the "Library" and "Music" catch-all ones. Defaults to one per
+    100 tracks, at least 1.
+    :param tracks_per_playlist: number of tracks in each of those playlists
+    :param seed: random seed, libraries written with the same seed and variant are identical
+    :param variant: 0 writes the base library. Other values write a modified copy of it for diff benchmarks:
+    change_fraction of the tracks removed (and from their playlists), as many new tracks added, another
+    change_fraction of the tracks changed (new genre, size, bit rate, and modified date, same identity), and about
+    one playlist in five with one track swapped for a new one. Everything else is identical to the base library.
+    :param change_fraction: see variant
+    :return: the number of tracks written
+    """
+    if n_playlists is None:
+        n_playlists = max(1, n_tracks // 100)
+
+    # The base library only draws from rng, and the same number of times in every variant, so that the variants
+    # differ from it only by the edits drawn from change_rng
+    rng = random.Random(seed)
+    change_rng = random.Random(seed * 1000003 + variant)
+    removed = set()
+    changed = set()
+    if variant:
+        n_edits = int(n_tracks * change_fraction)
+        edited = change_rng.sample(range(n_tracks), min(2 * n_edits, n_tracks))
+        removed = set(edited[:n_edits])
+        changed = set(edited[n_edits:])
+    n_extra = len(removed)
+
+    track_ids = []
+    with open(lib_file, 'w') as fobj:
+        fobj.write('<?xml version="1.0" encoding="UTF-8"?>\n'
+                   '<!DOCTYPE plist PUBLIC "-//Apple Computer//DTD PLIST 1.0//EN" '
+                   '"http://www.apple.com/DTDs/PropertyList-1.0.dtd">\n'
+                   '<plist version="1.0">\n<dict>\n'
+                   '\t<key>Major Version</key><integer>1</integer>\n'
+                   '\t<key>Minor Version</key><integer>1</integer>\n'
+                   '\t<key>Date</key><date>2017-01-01T00:00:00Z</date>\n'
+                   '\t<key>Application Version</key><string>12.5.4.42</string>\n'
+                   '\t<key>Show Content Ratings</key><true/>\n'
+                   '\t<key>Music Folder</key><string>file:///Users/me/Music/iTunes/iTunes%20Media/</string>\n'
+                   '\t<key>Tracks</key>\n\t<dict>\n')
+        for i in range(n_tracks):
+            track_rng = random.Random(rng.getrandbits(32))
+            if i in removed:
+                continue
+            track_id = 1000 + 2 * i
+            track_ids.append(track_id)
+            _write_track(fobj, track_id, i, track_rng, changed=i in changed)
+        new_ids = []
+        for i in range(n_tracks, n_tracks + n_extra):
+            track_id = 1000 + 2 * i
+            new_ids.append(track_id)
+            _write_track(fobj, track_id, i, random.Random(change_rng.getrandbits(32)))
+        track_ids.extend(new_ids)
+        fobj.write('\t</dict>\n\t<key>Playlists</key>\n\t<array>\n')
+
+        base_ids = [1000 + 2 * i for i in range(n_tracks)]
+        removed_ids = set(1000 + 2 * i for i in removed)
+        playlists = [('Library', track_ids), ('Music', track_ids)]
+        for p in range(n_playlists):
+            members = rng.sample(base_ids, min(tracks_per_playlist, n_tracks))
+            if variant:
+                members = [t for t in members if t not in removed_ids]
+                if new_ids and members and change_rng.random() < 0.2:
+                    members[change_rng.randrange(len(members))] = change_rng.choice(new_ids)
+            playlists.append(('Playlist {}'.format(p), members))
+
+        for p, (name, members) in enumerate(playlists):
+            fobj.write('\t\t<dict>\n\t\t\t<key>Name</key><string>{}</string>\n'
+                       '\t\t\t<key>Playlist ID</key><integer>{}</integer>\n'
+                       '\t\t\t<key>Playlist Persistent ID</key><string>{:016X}</string>\n'
+                       '\t\t\t<key>All Items</key><true/>\n'
+                       '\t\t\t<key>Playlist Items</key>\n\t\t\t<array>\n'.format(name, 10 + p, p))
+            for track_id in members:
+                fobj.write('\t\t\t\t<dict>\n\t\t\t\t\t<key>Track ID</key><integer>{}</integer>\n\t\t\t\t</dict>\n'
+                           .format(track_id))
+            fobj.write('\t\t\t</array>\n\t\t</dict>\n')
+        fobj.write('\t</array>\n</dict>\n</plist>\n')
+
+    return len(track_ids)
+
+
+def _peak_rss_kb():
+    if resource is None:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS and kilobytes elsewhere
+    return rss // 1024 if sys.platform == 'darwin' else rss
+
+
+def _run_benchmark(args):
+    # Runs in a fresh worker process so that the peak RSS belongs to this benchmark alone
+    name, old_file, new_file, work_dir = args
+    if name == 'parse_itunes_lib':
+        start = time.time()
+        itunesxml.parse_itunes_lib(old_file)
+        wall_time = time.time() - start
+    elif name == 'music_diff':
+        old_lib = itunesxml.parse_itunes_lib(old_file)
+        new_lib = itunesxml.parse_itunes_lib(new_file)
+        start = time.time()
+        itunesxml.music_diff(old_lib, new_lib)
+        wall_time = time.time() - start
+    elif name == 'assemble_report':
+        start = time.time()
+        itunesxml.assemble_report(old_file, new_file, log_file=os.path.join(work_dir, 'report.txt'), parallel=False)
+        wall_time = time.time() - start
+    else:
+        raise ValueError('Unknown benchmark {}'.format(name))
+    return wall_time, _peak_rss_kb()
+
+
+def _quiet_worker():
+    # assemble_report prints progress messages, which would clutter the benchmark output
+    sys.stdout = open(os.devnull, 'w')
+
+
+_benchmarks = ('parse_itunes_lib', 'music_diff', 'assemble_report')
+
+
+def run_benchmarks(sizes, work_dir=None, benchmarks=_benchmarks, repeat=1, seed=0):
+    """
+    Generate synthetic libraries of each size and time each benchmark on them.
+    :param sizes: list of track counts
+    :param work_dir: where to write the synthetic libraries. A temporary directory (removed afterwards) is used if
+    this is None. Libraries already in work_dir are reused.
+    :param benchmarks: which of 'parse_itunes_lib', 'music_diff' and 'assemble_report' to run
+    :param repeat: number of times to run each benchmark. The fastest run is recorded.
+    :param seed: random seed for the synthetic libraries
+    :return: list of result dicts with keys benchmark, n_tracks, file_bytes, wall_time, peak_rss_kb, mb_per_s and
+    tracks_per_s. Throughput counts both files for music_diff and assemble_report.
+    """
+    cleanup = work_dir is None
+    if cleanup:
+        work_dir = tempfile.mkdtemp(prefix='itunesbench')
+    elif not os.path.isdir(work_dir):
+        os.makedirs(work_dir)
+
+    results = []
+    try:
+        for n_tracks in sizes:
+            old_file = os.path.join(work_dir, 'lib_{}_{}_old.xml'.format(n_tracks, seed))
+            new_file = os.path.join(work_dir, 'lib_{}_{}_new.xml'.format(n_tracks, seed))
+            if not os.path.isfile(old_file):
+                print('Writing synthetic library with {} tracks...'.format(n_tracks))
+                write_synthetic_library(old_file, n_tracks, seed=seed)
+            if not os.path.isfile(new_file):
+                write_synthetic_library(new_file, n_tracks, seed=seed, variant=1)
+
+            for name in benchmarks:
+                if name == 'parse_itunes_lib':
+                    n_bytes = os.path.getsize(old_file)
+                    n_processed = n_tracks
+                else:
+                    n_bytes = os.path.getsize(old_file) + os.path.getsize(new_file)
+                    n_processed = 2 * n_tracks
+
+                runs = []
+                for _ in range(repeat):
+                    pool = multiprocessing.Pool(processes=1, initializer=_quiet_worker)
+                    try:
+                        runs.append(pool.apply(_run_benchmark, ((name, old_file, new_file, work_dir),)))
+                    finally:
+                        pool.close()
+                        pool.join()
+
+                wall_time = min(r[0] for r in runs)
+                peak_rss = max(r[1] for r in runs) if runs[0][1] is not None else None
+                result = {'benchmark': name, 'n_tracks': n_tracks, 'file_bytes': n_bytes, 'wall_time': wall_time,
+                          'peak_rss_kb': peak_rss, 'mb_per_s': n_bytes / 1e6 / wall_time if wall_time > 0 else None,
+                          'tracks_per_s': n_processed / wall_time if wall_time > 0 else None}
+                print('{benchmark:>16} {n_tracks:>8} tracks: {wall_time:8.3f} s, peak RSS {peak_rss_kb} kB'
+                      .format(**result))
+                results.append(result)
+    finally:
+        if cleanup:
+            shutil.rmtree(work_dir)
+
+    return results
+
+
+def save_results(results, out_file):
+    """
+    Write benchmark results to a JSON file along with some information about the machine they were run on.
+    """
+    output = {'timestamp': dt.datetime.now().isoformat(), 'python': platform.python_version(),
+              'platform': platform.platform(), 'results': results}
+    with open(out_file, 'w') as fobj:
+        json.dump(output, fobj, indent=2, sort_keys=True)
+
+
+def compare_results(old_results_file, results, threshold=0.1):
+    """
+    Compare results against a previous JSON results file and print the ratio of the new to old time for each
+    benchmark and size in both.
+    :param threshold: fractional slowdown above which a benchmark is flagged as a regression
+    :return: list of (benchmark, n_tracks, ratio) for the regressions
+    """
+    with open(old_results_file, 'r') as fobj:
+        old = json.load(fobj)
+    old_times = dict(((r['benchmark'], r['n_tracks']), r['wall_time']) for r in old['results'])
+
+    regressions = []
+    for r in results:
+        key = (r['benchmark'], r['n_tracks'])
+        if key not in old_times or not old_times[key]:
+            continue
+        ratio = r['wall_time'] / old_times[key]
+        flag = ''
+        if ratio > 1 + threshold:
+            flag = '  REGRESSION'
+            regressions.append((r['benchmark'], r['n_tracks'], ratio))
+        print('{:>16} {:>8} tracks: {:6.2f}x previous time{}'.format(key[0], key[1], ratio, flag))
+    return regressions
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Benchmark itunesxml on synthetic iTunes libraries')
+    parser.add_argument('--sizes', '-s', type=int, nargs='+', default=[1000, 10000, 100000],
+                        help='Numbers of tracks in the synthetic libraries, default %(default)s')
+    parser.add_argument('--benchmarks', '-b', nargs='+', default=list(_benchmarks), choices=_benchmarks,
+                        help='Which benchmarks to run, default is all of them')
+    parser.add_argument('--repeat', '-r', type=int, default=1,
+                        help='Run each benchmark this many times and keep the fastest, default %(default)s')
+    parser.add_argument('--work-dir', '-w', default=None,
+                        help='Directory to keep the synthetic libraries in, so they can be reused between runs. '
+                             'By default a temporary directory is used.')
+    parser.add_argument('--compare', '-c', default=None,
+                        help='Previous results file to compare against. The exit status is 1 if any benchmark is '
+                             'slower than it by more than --threshold.')
+    parser.add_argument('--threshold', '-t', type=float, default=0.1,
+                        help='Fractional slowdown counted as a regression with --compare, default %(default)s')
+    parser.add_argument('out_file', help='JSON file to save the results in')
+    args = parser.parse_args()
+    if args.compare is not None and not os.path.isfile(args.compare):
+        shell_error('{} is not a file'.format(args.compare))
+    return args
+
+
+def main():
+    args = parse_args()
+    results = run_benchmarks(args.sizes, work_dir=args.work_dir, benchmarks=args.benchmarks, repeat=args.repeat)
+    save_results(results, args.out_file)
+    ecode = 0
+    if args.compare is not None and compare_results(args.compare, results, threshold=args.threshold):
+        ecode = 1
+    exit(ecode)
+
+
+if __name__ == '__main__':
+    main()
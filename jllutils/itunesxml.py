@@ -1,6 +1,32 @@
 from __future__ import print_function
+from abc import ABCMeta, abstractmethod
+from array import array
+import csv
 import datetime as dt
+import errno
+import hashlib
+import json
+import mmap
+import multiprocessing
+import os
 import re
+import sys
+
+try:
+    intern
+except NameError:
+    from sys import intern
+
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+
+try:
+    _replace_file = os.replace
+except AttributeError:
+    # Python 2 has no os.replace, but rename also atomically replaces an existing file on POSIX
+    _replace_file = os.rename
 
 
 def read_lib_file(fname):
@@ -93,13 +119,699 @@ def iter_elements(data):
         yield el, tag
         ind += nextind
         
-def parse_itunes_lib(lib_file):
+# The streaming engine below reads the library in one forward pass instead of re-scanning nested elements with
+# find_next_element. Lines are stripped just as read_lib_file does, so both engines return identical structures.
+_tag_re = re.compile('<([^>]*)>')
+_leaf_converters = {'integer': int,
+                    'float': float,
+                    'string': None,
+                    'data': None,
+                    'key': None,
+                    'date': lambda s: dt.datetime.strptime(s, '%Y-%m-%dT%H:%M:%SZ')}
+
+
+def iter_lib_tokens(lib_file, chunk_size=1048576):
+    """
+    Incrementally tokenize an iTunes library XML file.
+    :param lib_file: path to the library XML file
+    :param chunk_size: approximate number of characters to accumulate before scanning for tags
+    :return: generator of (kind, value) tuples. kind is 'open', 'close' or 'empty' with the tag name as the value,
+    or 'text' with the text between two tags as the value. XML declarations and doctypes are skipped.
+    """
+    with open(lib_file, 'r') as f:
+        leftover = ''
+        pieces = []
+        n_chars = 0
+        for line in f:
+            line = line.strip()
+            pieces.append(line)
+            n_chars += len(line)
+            if n_chars < chunk_size:
+                continue
+
+            buf = leftover + ''.join(pieces)
+            pieces = []
+            n_chars = 0
+            for token in _scan_tokens(buf):
+                if isinstance(token, int):
+                    leftover = buf[token:]
+                else:
+                    yield token
+
+        buf = leftover + ''.join(pieces)
+        for token in _scan_tokens(buf):
+            if not isinstance(token, int):
+                yield token
+
+
+def _scan_tokens(buf):
+    # Yields tokens for every complete tag in buf, then the index where the incomplete remainder starts so that
+    # the caller can carry it over into the next chunk. Text is only emitted once its closing tag has been seen.
+    ind = 0
+    for m in _tag_re.finditer(buf):
+        if m.start() > ind:
+            yield 'text', buf[ind:m.start()]
+        ind = m.end()
+
+        inner = m.group(1)
+        if inner.startswith('?') or inner.startswith('!'):
+            continue
+        elif inner.startswith('/'):
+            yield 'close', inner[1:].strip()
+        elif inner.endswith('/'):
+            yield 'empty', inner[:-1].strip()
+        else:
+            yield 'open', inner.split(None, 1)[0] if inner else inner
+    yield ind
+
+
+def _parse_stream_value(tokens, kind, name):
+    if kind == 'empty':
+        # iTunes lib XML seems to use <true/> and <false/> as single tag elements
+        if name == 'true':
+            return True
+        elif name == 'false':
+            return False
+        else:
+            return '<{}/>'.format(name)
+    elif kind != 'open':
+        raise ValueError('Expected an element, got {} token "{}"'.format(kind, name))
+    elif name == 'dict':
+        return _parse_stream_dict(tokens)
+    elif name == 'array':
+        return _parse_stream_array(tokens)
+    else:
+        return _parse_stream_leaf(tokens, name)
+
+
+def _parse_stream_leaf(tokens, name):
+    if name not in _leaf_converters:
+        raise NotImplementedError('Cannot parse element with tag <{}>'.format(name))
+
+    text = []
+    for kind, val in tokens:
+        if kind == 'text':
+            text.append(val)
+        elif kind == 'close' and val == name:
+            break
+        else:
+            raise ValueError('Unexpected {} token "{}" inside <{}>'.format(kind, val, name))
+    else:
+        raise RuntimeError('Did not close tag <{}>'.format(name))
+
+    text = ''.join(text)
+    converter = _leaf_converters[name]
+    return text if converter is None else converter(text)
+
+
+def _parse_stream_array(tokens):
+    aout = []
+    for kind, val in tokens:
+        if kind == 'text':
+            continue
+        elif kind == 'close':
+            if val != 'array':
+                raise ValueError('Mismatched closing tag </{}> inside <array>'.format(val))
+            return aout
+        aout.append(_parse_stream_value(tokens, kind, val))
+
+    raise RuntimeError('Did not close tag <array>')
+
+
+def _iter_stream_dict(tokens):
+    # Yields (key, kind, name) for each entry of a dict whose opening tag has already been consumed. The caller must
+    # consume the value (e.g. with _parse_stream_value) before asking for the next entry.
+    for kind, val in tokens:
+        if kind == 'text':
+            continue
+        elif kind == 'close':
+            if val != 'dict':
+                raise ValueError('Mismatched closing tag </{}> inside <dict>'.format(val))
+            return
+        elif kind != 'open' or val != 'key':
+            raise ValueError('Did not find a key when I expected to')
+
+        # Keys repeat in every track, so interning them saves one string object per key per track
+        key = intern(_parse_stream_leaf(tokens, 'key'))
+        kind, val = _next_element_token(tokens)
+        yield key, kind, val
+
+    raise RuntimeError('Did not close tag <dict>')
+
+
+def _parse_stream_dict(tokens):
+    dout = dict()
+    for key, kind, val in _iter_stream_dict(tokens):
+        dout[key] = _parse_stream_value(tokens, kind, val)
+    return dout
+
+
+def _next_element_token(tokens):
+    for kind, val in tokens:
+        if kind != 'text':
+            return kind, val
+    raise RuntimeError('Unexpected end of file')
+
+
+def _open_main_dict(lib_file):
+    tokens = iter_lib_tokens(lib_file)
+    for kind, val in tokens:
+        if kind == 'open' and val == 'dict':
+            return tokens
+    raise RuntimeError('Expecting to start with a dict')
+
+
+def iter_lib_section(lib_file, section, compact=False):
+    """
+    Iterate over the items of one top level section of an iTunes library without building the rest of it.
+    :param lib_file: path to the library XML file
+    :param section: the top level key to iterate over, e.g. 'Tracks' or 'Playlists'
+    :param compact: if true and section is 'Tracks', tracks are yielded as Track instances rather than dicts.
+    :return: generator. For a dict section (like 'Tracks') it yields (key, value) pairs, for an array section
+    (like 'Playlists') it yields the values.
+    """
+    tokens = _open_main_dict(lib_file)
+    for key, kind, val in _iter_stream_dict(tokens):
+        if key != section:
+            # Still have to consume the value to keep the token stream aligned
+            _parse_stream_value(tokens, kind, val)
+            continue
+
+        if kind == 'open' and val == 'dict':
+            for subkey, subkind, subval in _iter_stream_dict(tokens):
+                value = _parse_stream_value(tokens, subkind, subval)
+                if compact and section == 'Tracks':
+                    value = Track(value)
+                yield subkey, value
+        elif kind == 'open' and val == 'array':
+            for subkind, subval in tokens:
+                if subkind == 'text':
+                    continue
+                elif subkind == 'close':
+                    break
+                yield _parse_stream_value(tokens, subkind, subval)
+        else:
+            raise ValueError('Section {} is not a dict or array'.format(section))
+        return
+
+
+def iter_itunes_tracks(lib_file, compact=False):
+    """
+    Iterate over the tracks in an iTunes library one at a time, in file order.
+    :param lib_file: path to the library XML file
+    :param compact: if True, yield Track instances instead of dicts
+    :return: generator of track dicts, the same as the values of parse_itunes_lib(lib_file)['Tracks']
+    """
+    for _, track in iter_lib_section(lib_file, 'Tracks', compact=compact):
+        yield track
+
+
+def parse_itunes_lib(lib_file, engine='stream', compact=False):
+    """
+    Parse an iTunes library XML file into nested dicts, lists, and values.
+    :param lib_file: path to the library XML file
+    :param engine: 'stream' (default) uses the single pass tokenizer, 'regex' uses the original find_next_element
+    based parser.
+    :param compact: if True, the values of the 'Tracks' dict are Track instances instead of dicts. If 'table', the
+    'Tracks' dict is replaced by a TrackTable, which uses much less memory again. Either way each track is converted
+    as soon as it is parsed, so the full dict representation is never held in memory.
+    :return: dict representing the top level dict of the library
+    """
+    if engine == 'stream':
+        tokens = _open_main_dict(lib_file)
+        lib = dict()
+        for key, kind, val in _iter_stream_dict(tokens):
+            if compact and key == 'Tracks' and kind == 'open' and val == 'dict':
+                tracks = ((k, _parse_stream_value(tokens, tkind, tval)) for k, tkind, tval in _iter_stream_dict(tokens))
+                lib[key] = _compact_tracks(tracks, compact)
+            else:
+                lib[key] = _parse_stream_value(tokens, kind, val)
+        return lib
+    elif engine != 'regex':
+        raise ValueError('engine must be "stream" or "regex"')
+
     lib_str = read_lib_file(lib_file)
     sind = lib_str.index('<dict>')
     main_dict, tag, _ = find_next_element(lib_str[sind:])
     if tag != '<dict>':
         raise RuntimeError('Expecting to start with a dict')
-    return parse_dict(main_dict)
+    lib = parse_dict(main_dict)
+    if compact:
+        lib['Tracks'] = _compact_tracks(lib['Tracks'].items(), compact)
+    return lib
+
+
+def _compact_tracks(tracks, compact):
+    # tracks is an iterable of (key, track dict) pairs
+    if compact == 'table':
+        table = TrackTable()
+        for k, t in tracks:
+            table.append(k, t)
+        return table
+    return dict((k, Track(t)) for k, t in tracks)
+
+
+# Track attribute names for the keys iTunes commonly writes for each track. Anything else goes in an overflow dict.
+_track_fields = (('Track ID', 'track_id'), ('Name', 'name'), ('Artist', 'artist'), ('Album Artist', 'album_artist'),
+                 ('Composer', 'composer'), ('Album', 'album'), ('Genre', 'genre'), ('Kind', 'kind'),
+                 ('Size', 'size'), ('Total Time', 'total_time'), ('Disc Number', 'disc_number'),
+                 ('Disc Count', 'disc_count'), ('Track Number', 'track_number'), ('Track Count', 'track_count'),
+                 ('Year', 'year'), ('Date Modified', 'date_modified'), ('Date Added', 'date_added'),
+                 ('Bit Rate', 'bit_rate'), ('Sample Rate', 'sample_rate'), ('Play Count', 'play_count'),
+                 ('Play Date', 'play_date'), ('Play Date UTC', 'play_date_utc'), ('Skip Count', 'skip_count'),
+                 ('Skip Date', 'skip_date'), ('Rating', 'rating'), ('Album Rating', 'album_rating'),
+                 ('Album Rating Computed', 'album_rating_computed'), ('Loved', 'loved'),
+                 ('Compilation', 'compilation'), ('Artwork Count', 'artwork_count'),
+                 ('Persistent ID', 'persistent_id'), ('Track Type', 'track_type'), ('Location', 'location'),
+                 ('File Folder Count', 'file_folder_count'), ('Library Folder Count', 'library_folder_count'),
+                 ('Sort Name', 'sort_name'), ('Sort Album', 'sort_album'), ('Sort Artist', 'sort_artist'),
+                 ('Comments', 'comments'))
+_track_attrs = dict(_track_fields)
+# String values that are shared between many tracks and so are worth interning
+_interned_track_keys = frozenset(['Artist', 'Album Artist', 'Composer', 'Album', 'Genre', 'Kind', 'Track Type',
+                                  'Sort Artist', 'Sort Album'])
+
+
+class _TrackMapping(object):
+    """
+    The read-only parts of the dict interface for the compact track classes, built on their get() and items()
+    """
+    __slots__ = ()
+
+    def __getitem__(self, key):
+        val = self.get(key, _MISSING)
+        if val is _MISSING:
+            raise KeyError(key)
+        return val
+
+    def __contains__(self, key):
+        return self.get(key, _MISSING) is not _MISSING
+
+    def keys(self):
+        return [k for k, _ in self.items()]
+
+    def values(self):
+        return [v for _, v in self.items()]
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __len__(self):
+        return len(self.items())
+
+    def to_dict(self):
+        return dict(self.items())
+
+    def __eq__(self, other):
+        if isinstance(other, _TrackMapping):
+            other = other.to_dict()
+        return self.to_dict() == other
+
+    def __ne__(self, other):
+        return not self == other
+
+    __hash__ = None
+
+    def __repr__(self):
+        return '{}({!r})'.format(type(self).__name__, self.to_dict())
+
+
+class Track(_TrackMapping):
+    """
+    Compact representation of one track from an iTunes library. The common keys are stored in __slots__ and any
+    others in a small overflow dict. Supports the read-only parts of the dict interface (t['Name'], t.get('Year'),
+    'Album' in t, t.keys(), ...) so that it can be used anywhere a track dict is.
+    """
+    __slots__ = tuple(a for _, a in _track_fields) + ('_extra',)
+
+    def __init__(self, track_dict=None):
+        self._extra = None
+        if track_dict is None:
+            return
+        for k, v in track_dict.items():
+            if k in _interned_track_keys and isinstance(v, str):
+                v = intern(v)
+            attr = _track_attrs.get(k)
+            if attr is not None:
+                setattr(self, attr, v)
+            else:
+                if self._extra is None:
+                    self._extra = dict()
+                self._extra[k] = v
+
+    def get(self, key, default=None):
+        attr = _track_attrs.get(key)
+        if attr is not None:
+            return getattr(self, attr, default)
+        elif self._extra is not None:
+            return self._extra.get(key, default)
+        else:
+            return default
+
+    def items(self):
+        items = [(k, getattr(self, a)) for k, a in _track_fields if hasattr(self, a)]
+        if self._extra is not None:
+            items.extend(self._extra.items())
+        return items
+
+    def __getstate__(self):
+        return self.to_dict()
+
+    def __setstate__(self, state):
+        self.__init__(state)
+
+
+try:
+    _int_types = (int, long)
+except NameError:
+    _int_types = (int,)
+
+# Column kinds for TrackTable, as (array typecode, marker for a missing value). Dates are stored as whole seconds
+# since _table_epoch. 'obj' columns are plain lists and hold any other value.
+_table_kinds = {'int': ('q', -2 ** 63), 'date': ('q', -2 ** 63), 'bool': ('b', -1), 'obj': (None, None)}
+_table_epoch = dt.datetime(1970, 1, 1)
+
+
+def _table_column_kind(value):
+    if type(value) in _int_types:
+        return 'int'
+    elif type(value) is dt.datetime:
+        return 'date'
+    elif type(value) is bool:
+        return 'bool'
+    else:
+        return 'obj'
+
+
+class TrackTable(object):
+    """
+    Columnar store for the 'Tracks' dict of a parsed iTunes library. Each track key gets one column: integers, dates
+    and booleans are kept in typed arrays instead of as one Python object per value, other values (mostly strings,
+    with the repeated ones interned) in lists. A value that does not fit the type of its column goes in an overflow
+    dict for its track.
+
+    Behaves as a read-only dict of Track ID strings to tracks, like the dict parse_itunes_lib makes. The tracks are
+    TableTrack views, created on access, with the same read-only dict interface as Track.
+    """
+    def __init__(self):
+        self._keys = []
+        self._column_keys = []
+        self._columns = dict()
+        self._extra = dict()
+        self._rows = None
+
+    def append(self, key, track_dict):
+        """
+        Add a track to the end of the table.
+        :param key: the key of the track in the Tracks dict, i.e. its Track ID as a string
+        :param track_dict: the track as a dict of its keys and values
+        """
+        row = len(self._keys)
+        for k, v in track_dict.items():
+            if not self._store(row, k, v):
+                self._extra.setdefault(row, dict())[k] = v
+        self._keys.append(key)
+        if self._rows is not None:
+            self._rows[key] = row
+
+    def _store(self, row, key, value):
+        column = self._columns.get(key)
+        if column is None:
+            kind = _table_column_kind(value)
+            typecode = _table_kinds[kind][0]
+            column = (kind, [] if typecode is None else array(typecode))
+            self._columns[key] = column
+            self._column_keys.append(key)
+
+        kind, values = column
+        if kind != _table_column_kind(value):
+            return False
+        elif kind == 'int':
+            if not _table_kinds['int'][1] < value < 2 ** 63:
+                return False
+        elif kind == 'date':
+            if value.tzinfo is not None or value.microsecond != 0:
+                return False
+            delta = value - _table_epoch
+            value = delta.days * 86400 + delta.seconds
+        elif kind == 'obj':
+            if value is None:
+                return False
+            if key in _interned_track_keys and isinstance(value, str):
+                value = intern(value)
+
+        if len(values) < row:
+            values.extend([_table_kinds[kind][1]] * (row - len(values)))
+        values.append(value)
+        return True
+
+    def _get(self, row, key, default):
+        column = self._columns.get(key)
+        if column is not None:
+            kind, values = column
+            if row < len(values):
+                value = values[row]
+                if value != _table_kinds[kind][1]:
+                    if kind == 'date':
+                        return _table_epoch + dt.timedelta(seconds=value)
+                    elif kind == 'bool':
+                        return bool(value)
+                    else:
+                        return value
+        extra = self._extra.get(row)
+        if extra is not None:
+            return extra.get(key, default)
+        return default
+
+    def _items(self, row):
+        items = []
+        for key in self._column_keys:
+            value = self._get(row, key, _MISSING)
+            if value is not _MISSING:
+                items.append((key, value))
+        # Overflow values were already found by _get through their column
+        return items
+
+    def _row(self, key):
+        if self._rows is None:
+            self._rows = dict((k, i) for i, k in enumerate(self._keys))
+        return self._rows[key]
+
+    def __len__(self):
+        return len(self._keys)
+
+    def __getitem__(self, key):
+        return TableTrack(self, self._row(key))
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def __contains__(self, key):
+        try:
+            self._row(key)
+        except KeyError:
+            return False
+        return True
+
+    def __iter__(self):
+        return iter(self._keys)
+
+    def keys(self):
+        return list(self._keys)
+
+    def values(self):
+        return [TableTrack(self, i) for i in range(len(self._keys))]
+
+    def items(self):
+        return [(k, TableTrack(self, i)) for i, k in enumerate(self._keys)]
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_rows'] = None
+        return state
+
+
+class TableTrack(_TrackMapping):
+    """
+    One track of a TrackTable. Pickles as a standalone Track.
+    """
+    __slots__ = ('_table', '_row')
+
+    def __init__(self, table, row):
+        self._table = table
+        self._row = row
+
+    def get(self, key, default=None):
+        return self._table._get(self._row, key, default)
+
+    def items(self):
+        return self._table._items(self._row)
+
+    def __reduce__(self):
+        return Track, (self.to_dict(),)
+
+# Parsed library cache. Each snapshot file holds two pickles: a small header describing the XML file it was made
+# from, then the parsed library itself, so validity can be checked without loading the library.
+_cache_version = 1
+_cache_ext = '.libcache'
+
+
+def _lib_cache_file(lib_file, cache_dir=None):
+    lib_file = os.path.abspath(lib_file)
+    if cache_dir is None:
+        return lib_file + _cache_ext
+    path_hash = hashlib.md5(lib_file.encode('utf-8')).hexdigest()
+    return os.path.join(cache_dir, path_hash + _cache_ext)
+
+
+def lib_fingerprint(lib_file, blocksize=1048576):
+    """
+    Returns the MD5 hex digest of the contents of lib_file, used to check if a cached parse is still valid.
+    """
+    hash_md5 = hashlib.md5()
+    with open(lib_file, 'rb') as f:
+        for chunk in iter(lambda: f.read(blocksize), b''):
+            hash_md5.update(chunk)
+    return hash_md5.hexdigest()
+
+
+def _read_cache_header(cache_file):
+    try:
+        with open(cache_file, 'rb') as f:
+            return pickle.load(f)
+    except (IOError, OSError, EOFError, pickle.UnpicklingError):
+        return None
+
+
+def _is_cache_valid(header, lib_file, compact):
+    if header is None or header.get('version') != _cache_version or header.get('compact') != compact:
+        return False
+    elif header['path'] != os.path.abspath(lib_file):
+        return False
+
+    st = os.stat(lib_file)
+    if st.st_size != header['size']:
+        return False
+    elif st.st_mtime == header['mtime']:
+        return True
+    else:
+        # Modified time changed (e.g. the file was copied or touched), so fall back on the contents
+        return lib_fingerprint(lib_file) == header['fingerprint']
+
+
+def _read_lib_cache(cache_file):
+    # Returns (lib, pickled lib) from a snapshot, or None if it cannot be read, e.g. because another process removed
+    # it after its header was checked
+    try:
+        with open(cache_file, 'rb') as f:
+            pickle.load(f)
+            lib_pickle = f.read()
+        return pickle.loads(lib_pickle), lib_pickle
+    except (IOError, OSError, EOFError, pickle.UnpicklingError):
+        return None
+
+
+def _write_lib_cache(cache_file, header, lib_pickle):
+    # Write to a temporary file and move it into place, so there is always a complete snapshot (old or new)
+    tmp_file = cache_file + '.tmp{}'.format(os.getpid())
+    with open(tmp_file, 'wb') as f:
+        pickle.dump(header, f, pickle.HIGHEST_PROTOCOL)
+        f.write(lib_pickle)
+    _replace_file(tmp_file, cache_file)
+
+
+def cached_parse_itunes_lib(lib_file, cache_dir=None, compact='table', max_cache_bytes=None):
+    """
+    Parse an iTunes library, reusing a snapshot of a previous parse if the file has not changed.
+    :param lib_file: path to the library XML file
+    :param cache_dir: directory to store snapshots in. If None, the snapshot is written next to lib_file with the
+    extension .libcache added.
+    :param compact: passed through to parse_itunes_lib. Snapshots made with a different value are not reused.
+    :param max_cache_bytes: if given, after writing a new snapshot the least recently used snapshots in the same
+    directory (cache_dir, or the directory of lib_file) are removed until their total size is under this limit.
+    :return: the parsed library, as parse_itunes_lib would return it.
+    """
+    cache_file = _lib_cache_file(lib_file, cache_dir)
+    header = _read_cache_header(cache_file)
+    cached = _read_lib_cache(cache_file) if _is_cache_valid(header, lib_file, compact) else None
+    if cached is not None:
+        lib, lib_pickle = cached
+        st = os.stat(lib_file)
+        try:
+            if st.st_mtime != header['mtime']:
+                # Only the modified time changed. Record the new one so later runs do not fingerprint the file again.
+                header['mtime'] = st.st_mtime
+                _write_lib_cache(cache_file, header, lib_pickle)
+            else:
+                # Mark as recently used for the eviction policy
+                os.utime(cache_file, None)
+        except (IOError, OSError):
+            # The snapshot was evicted meanwhile; the library itself was already loaded
+            pass
+        return lib
+
+    st = os.stat(lib_file)
+    lib = parse_itunes_lib(lib_file, compact=compact)
+    header = {'version': _cache_version, 'path': os.path.abspath(lib_file), 'size': st.st_size,
+              'mtime': st.st_mtime, 'fingerprint': lib_fingerprint(lib_file), 'compact': compact}
+
+    if cache_dir is not None and not os.path.isdir(cache_dir):
+        os.makedirs(cache_dir)
+    _write_lib_cache(cache_file, header, pickle.dumps(lib, pickle.HIGHEST_PROTOCOL))
+
+    if max_cache_bytes is not None:
+        evict_lib_cache(os.path.dirname(cache_file), max_cache_bytes)
+    return lib
+
+
+def invalidate_lib_cache(lib_file, cache_dir=None):
+    """
+    Remove the cached snapshot for lib_file, if there is one. Returns True if a snapshot was removed.
+    """
+    cache_file = _lib_cache_file(lib_file, cache_dir)
+    if os.path.isfile(cache_file):
+        os.remove(cache_file)
+        return True
+    return False
+
+
+def evict_lib_cache(cache_dir, max_cache_bytes):
+    """
+    Remove the least recently used snapshots from cache_dir until their total size is at most max_cache_bytes.
+    :return: list of the snapshot files removed
+    """
+    # Other processes (e.g. the parse_libs workers) may be evicting from the same directory at the same time, so
+    # snapshots can disappear between listing, stat'ing and removing them.
+    snapshots = []
+    for fname in os.listdir(cache_dir):
+        if fname.endswith(_cache_ext):
+            full_name = os.path.join(cache_dir, fname)
+            try:
+                st = os.stat(full_name)
+            except OSError:
+                continue
+            snapshots.append((st.st_mtime, st.st_size, full_name))
+
+    snapshots.sort()
+    total = sum(s[1] for s in snapshots)
+    removed = []
+    for _, size, full_name in snapshots:
+        if total <= max_cache_bytes:
+            break
+        try:
+            os.remove(full_name)
+        except OSError as err:
+            if err.errno == errno.ENOENT:
+                # Already removed by someone else, which frees the space all the same
+                total -= size
+            continue
+        removed.append(full_name)
+        total -= size
+    return removed
+
 
 # Yes the next two methods should really be done via OOP... I'm in a hurry
 def track_in_list(t,l):
@@ -113,27 +825,64 @@ def are_tracks_eq(t1, t2):
     #test_keys = ['Album', 'Artist', 'Name', 'Size', 'Total Time', 'Year']
     test_keys = ['Album', 'Artist', 'Name', 'Year']
     for k in test_keys:
-        if k in t1.keys() and k in t2.keys():
+        if k in t1 and k in t2:
             if t1[k] != t2[k]:
                 return False
-        elif k in t1.keys() and k not in t2.keys():
+        elif k in t1 and k not in t2:
             return False
-        elif k not in t1.keys() and k in t2.keys():
+        elif k not in t1 and k in t2:
             return False
 
     
     return True
     
+# Marker for a missing identity key, so that a track without e.g. 'Year' never matches one with a Year of None
+_MISSING = object()
+_identity_keys = ('Album', 'Artist', 'Name', 'Year')
+
+
+def track_key(t):
+    """
+    Returns the identity of a track as a hashable tuple. Two tracks have equal keys exactly when are_tracks_eq
+    considers them equal.
+    """
+    return tuple(t.get(k, _MISSING) for k in _identity_keys)
+
+
+def index_tracks(tracks):
+    """
+    Build an identity index of an iterable of tracks.
+    :param tracks: iterable of track dicts
+    :return: dict mapping track_key values to lists of the tracks with that key, in iteration order
+    """
+    idx = dict()
+    for t in tracks:
+        idx.setdefault(track_key(t), []).append(t)
+    return idx
+
+
+def tracks_not_in(tracks, other_index):
+    """
+    Returns the tracks (in order, duplicates included) whose identity does not appear in other_index, which may be
+    any container of track keys (e.g. the output of index_tracks or a set of track_key values).
+    """
+    return list(iter_tracks_not_in(tracks, other_index))
+
+
+def iter_tracks_not_in(tracks, other_index):
+    """
+    Generator version of tracks_not_in
+    """
+    for t in tracks:
+        if track_key(t) not in other_index:
+            yield t
+
+
 def music_diff(d1, d2):
-    in_d1_not_d2 = []
-    in_d2_not_d1 = []
-    for t in d1['Tracks'].values():
-        if not track_in_list(t, d2['Tracks'].values()):
-            in_d1_not_d2.append(t)
-    for t in d2['Tracks'].values():
-        if not track_in_list(t, d1['Tracks'].values()):
-            in_d2_not_d1.append(t)
-            
+    idx1 = index_tracks(d1['Tracks'].values())
+    idx2 = index_tracks(d2['Tracks'].values())
+    in_d1_not_d2 = tracks_not_in(d1['Tracks'].values(), idx2)
+    in_d2_not_d1 = tracks_not_in(d2['Tracks'].values(), idx1)
     return in_d1_not_d2, in_d2_not_d1
     
 def assemble_playlist(plist, tracks):
@@ -155,83 +904,715 @@ def match_playlists(plist, plists_to_match):
     return matched
     
 def format_track(track):
-    artist = track['Artist'] if 'Artist' in track.keys() else ''
-    album = track['Album'] if 'Album' in track.keys() else ''
-    year = track['Year'] if 'Year' in track.keys() else ''
-    name = track['Name'] if 'Name' in track.keys() else ''
+    artist = track.get('Artist', '')
+    album = track.get('Album', '')
+    year = track.get('Year', '')
+    name = track.get('Name', '')
         
     return '{} in {} ({}): "{}"'.format(artist, album, year, name)
     
-def assemble_report(old_lib_file, new_lib_file, log_file=None):  
-    # First we need to parse the two files
-    print('Parsing old lib file...')
-    old_lib = parse_itunes_lib(old_lib_file)
-    print('Parsing new lib file...')
-    new_lib = parse_itunes_lib(new_lib_file)
-    
-    # Next let's figure out what tracks are missing overall
-    print('Comparing libraries as a whole...')
-    not_in_new, not_in_old = music_diff(old_lib, new_lib)
-    
-    # And finally look at the playlists
-    print('Comparing individual playlists...')
-    old_plists = dict()
-    new_plists = dict()
-    for plist in old_lib['Playlists']:
-        matched_plists = match_playlists(plist, new_lib['Playlists'])
-        old_plists[plist['Name']] = {'mine':plist, 'matched':matched_plists}
-    for plist in new_lib['Playlists']:
-        matched_plists = match_playlists(plist, old_lib['Playlists'])
-        new_plists[plist['Name']] = {'mine':plist, 'matched':matched_plists}
-        
-    if log_file is not None:
-        logf = open(log_file, 'w')
-        write_fxn = lambda s: logf.write(s+'\n')
+class ITunesLibrary(object):
+    """
+    Wraps a parsed iTunes library (the output of parse_itunes_lib) with indexes for fast playlist work:
+        - a Track ID -> position index into an array of tracks
+        - a name -> playlists multimap
+        - playlist membership as integer arrays of track positions, computed once per playlist on first use
+        - track identity keys (see track_key), computed once per track on first use
+    """
+    def __init__(self, lib):
+        self.lib = lib
+        self.tracks = lib['Tracks']
+        self.playlists = lib.get('Playlists', [])
+
+        self._track_array = []
+        self._pos_by_id = dict()
+        for t in self.tracks.values():
+            self._pos_by_id[t['Track ID']] = len(self._track_array)
+            self._track_array.append(t)
+
+        self._playlists_by_name = dict()
+        for i, p in enumerate(self.playlists):
+            self._playlists_by_name.setdefault(p['Name'], []).append(i)
+
+        self._members = [None] * len(self.playlists)
+        self._track_keys = None
+
+    @classmethod
+    def from_file(cls, lib_file, **kwargs):
+        """
+        Parse lib_file with parse_itunes_lib (passing any keyword arguments through) and wrap the result.
+        """
+        return cls(parse_itunes_lib(lib_file, **kwargs))
+
+    def __len__(self):
+        return len(self._track_array)
+
+    def track_by_id(self, track_id):
+        return self._track_array[self._pos_by_id[track_id]]
+
+    def playlist_names(self):
+        return list(self._playlists_by_name.keys())
+
+    def playlists_named(self, name):
+        """
+        Returns the list of playlists with the given name, in library order. Empty if there are none.
+        """
+        return [self.playlists[i] for i in self._playlists_by_name.get(name, [])]
+
+    def playlist_indices(self, name):
+        return list(self._playlists_by_name.get(name, []))
+
+    def playlist_members(self, index):
+        """
+        Returns the track positions of the playlist at index in self.playlists as an integer array.
+        Raises KeyError if the playlist refers to a Track ID that is not in the library.
+        """
+        members = self._members[index]
+        if members is None:
+            pos_by_id = self._pos_by_id
+            items = self.playlists[index].get('Playlist Items', [])
+            members = array('l', [pos_by_id[t['Track ID']] for t in items])
+            self._members[index] = members
+        return members
+
+    def playlist_tracks(self, index):
+        track_array = self._track_array
+        return [track_array[i] for i in self.playlist_members(index)]
+
+    def track_keys(self):
+        """
+        Returns a list of track_key values aligned with the track positions used by playlist_members.
+        """
+        if self._track_keys is None:
+            self._track_keys = [track_key(t) for t in self._track_array]
+        return self._track_keys
+
+    def playlist_keys(self, index):
+        keys = self.track_keys()
+        return set(keys[i] for i in self.playlist_members(index))
+
+
+_lazy_tracks_re = re.compile(br'<key>Tracks</key>\s*<dict>')
+_lazy_track_entry_re = re.compile(br'\s*(?:<key>([^<]*)</key>\s*<dict>|</dict>)')
+_lazy_playlists_re = re.compile(br'<key>Playlists</key>\s*<array>')
+_lazy_playlist_entry_re = re.compile(br'\s*(?:<dict>|</array>)')
+_lazy_playlist_name_re = re.compile(br'<key>Name</key>\s*<string>([^<]*)</string>')
+_lazy_dict_tag_re = re.compile(br'<(/?)dict>')
+
+
+class LazyITunesLibrary(object):
+    """
+    Read-only view of an iTunes library XML file that memory maps the file and only parses the tracks and playlists
+    that are asked for. Opening it makes one scan over the file to record where each track and playlist element
+    starts and ends; elements are parsed on first access and cached after that.
+
+    Can be used as a context manager, otherwise call close() when done.
+    """
+    def __init__(self, lib_file, compact=False):
+        self.lib_file = lib_file
+        self.compact = compact
+        self._fobj = open(lib_file, 'rb')
+        self._mm = mmap.mmap(self._fobj.fileno(), 0, access=mmap.ACCESS_READ)
+
+        self._track_pos = dict()
+        self._track_starts = array('l')
+        self._track_ends = array('l')
+        self._playlists_by_name = dict()
+        self._playlist_starts = array('l')
+        self._playlist_ends = array('l')
+        self._track_cache = dict()
+        self._playlist_cache = dict()
+        self._index()
+
+    def _index(self):
+        mm = self._mm
+        pos = 0
+        m = _lazy_tracks_re.search(mm)
+        if m is not None:
+            pos = m.end()
+            while True:
+                m = _lazy_track_entry_re.match(mm, pos)
+                if m is None:
+                    raise ValueError('Could not find the next track after byte {} in {}'.format(pos, self.lib_file))
+                elif m.group(1) is None:
+                    pos = m.end()
+                    break
+                end = self._element_end(m.end())
+                self._track_pos[int(m.group(1))] = len(self._track_starts)
+                self._track_starts.append(m.end() - len(b'<dict>'))
+                self._track_ends.append(end)
+                pos = end
+
+        m = _lazy_playlists_re.search(mm, pos)
+        if m is not None:
+            pos = m.end()
+            while True:
+                m = _lazy_playlist_entry_re.match(mm, pos)
+                if m is None:
+                    raise ValueError('Could not find the next playlist after byte {} in {}'.format(pos, self.lib_file))
+                elif m.group().strip() == b'</array>':
+                    break
+                end = self._element_end(m.end())
+                name_match = _lazy_playlist_name_re.search(mm, m.end(), end)
+                name = name_match.group(1).decode('utf-8') if name_match is not None else None
+                self._playlists_by_name.setdefault(name, []).append(len(self._playlist_starts))
+                self._playlist_starts.append(m.end() - len(b'<dict>'))
+                self._playlist_ends.append(end)
+                pos = end
+
+    def _element_end(self, pos):
+        # pos is just after an opening <dict>, returns the index just after its matching </dict>
+        mm = self._mm
+        end = mm.find(b'</dict>', pos)
+        if end < 0:
+            raise RuntimeError('Did not close tag <dict> starting before byte {}'.format(pos))
+        elif mm.find(b'<dict>', pos, end) < 0:
+            # Fast path: no nested dicts, true of all tracks
+            return end + len(b'</dict>')
+
+        depth = 1
+        for m in _lazy_dict_tag_re.finditer(mm, pos):
+            depth += -1 if m.group(1) else 1
+            if depth == 0:
+                return m.end()
+        raise RuntimeError('Did not close tag <dict> starting before byte {}'.format(pos))
+
+    def _parse_range(self, start, end):
+        # Strip lines the same way read_lib_file does so the values match parse_itunes_lib
+        text = self._mm[start:end].decode('utf-8')
+        text = ''.join(l.strip() for l in text.splitlines())
+        tokens = (t for t in _scan_tokens(text) if not isinstance(t, int))
+        kind, val = _next_element_token(tokens)
+        return _parse_stream_value(tokens, kind, val)
+
+    def __len__(self):
+        return len(self._track_starts)
+
+    def __contains__(self, track_id):
+        return track_id in self._track_pos
+
+    def track_ids(self):
+        return list(self._track_pos.keys())
+
+    def track(self, track_id):
+        """
+        Returns the track with the given (integer) Track ID, parsing it if this is the first access.
+        Raises KeyError if there is no such track.
+        """
+        t = self._track_cache.get(track_id)
+        if t is None:
+            i = self._track_pos[track_id]
+            t = self._parse_range(self._track_starts[i], self._track_ends[i])
+            if self.compact:
+                t = Track(t)
+            self._track_cache[track_id] = t
+        return t
+
+    def playlist_names(self):
+        return list(self._playlists_by_name.keys())
+
+    def playlist(self, index):
+        """
+        Returns the playlist at position index in the library's Playlists array
+        """
+        p = self._playlist_cache.get(index)
+        if p is None:
+            p = self._parse_range(self._playlist_starts[index], self._playlist_ends[index])
+            self._playlist_cache[index] = p
+        return p
+
+    def playlists_named(self, name):
+        """
+        Returns a list of all playlists with the given name, empty if there are none
+        """
+        return [self.playlist(i) for i in self._playlists_by_name.get(name, [])]
+
+    def playlist_tracks(self, plist):
+        """
+        Returns the tracks in plist (one of the playlists returned by playlist() or playlists_named()), the same as
+        assemble_playlist would. Only those tracks are parsed.
+        """
+        return [self.track(t['Track ID']) for t in plist.get('Playlist Items', [])]
+
+    def close(self):
+        self._mm.close()
+        self._fobj.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+# Playlists left out of the playlist comparison because they are very long catch-all lists
+_report_skip_lists = ('Library', 'Music', 'Genius')
+
+
+# Report writers. assemble_report and assemble_incremental_report hand each line of the report to one of these as
+# soon as it is computed, so the diff is never held in memory. The writers buffer their output.
+_report_track_sections = {'missing_from_new': 'Tracks missing from the new library:',
+                          'missing_from_old': 'Tracks missing from the old library:',
+                          'changed': 'Tracks changed since the old library:'}
+_report_fields = ('section', 'playlist', 'status', 'track', 'artist', 'album', 'year', 'name', 'library', 'count')
+
+
+# Abstract base class that works with both Python 2 and 3 metaclass syntax
+_ABC = ABCMeta('_ABC', (object,), {})
+
+
+class _ReportWriter(_ABC):
+    def __init__(self, log_file=None, buffer_size=1048576):
+        if log_file is None:
+            self._fobj = sys.stdout
+            self._close_fobj = False
+        else:
+            self._fobj = open(log_file, 'w', buffer_size)
+            self._close_fobj = True
+
+    @abstractmethod
+    def summary(self, old_lib_name, n_old, new_lib_name, n_new):
+        pass
+
+    @abstractmethod
+    def start_tracks(self, section):
+        pass
+
+    @abstractmethod
+    def track(self, section, track):
+        pass
+
+    @abstractmethod
+    def start_playlists(self):
+        pass
+
+    @abstractmethod
+    def playlist_mismatch(self, name, n_matched):
+        pass
+
+    @abstractmethod
+    def start_playlist(self, name):
+        pass
+
+    @abstractmethod
+    def playlist_track(self, name, status, track):
+        pass
+
+    @abstractmethod
+    def end_playlist(self, name, all_tracks):
+        pass
+
+    def close(self):
+        if self._close_fobj:
+            self._fobj.close()
+        else:
+            self._fobj.flush()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+class _TextReportWriter(_ReportWriter):
+    _sec_sep = '\n##########################\n'
+
+    def __init__(self, *args, **kwargs):
+        super(_TextReportWriter, self).__init__(*args, **kwargs)
+        self._in_tracks = False
+
+    def _write(self, s):
+        self._fobj.write(s + '\n')
+
+    def summary(self, old_lib_name, n_old, new_lib_name, n_new):
+        self._write('Summary:')
+        self._write('Tracks in the old library, {}: {}'.format(old_lib_name, n_old))
+        self._write('Tracks in the new library, {}: {}'.format(new_lib_name, n_new))
+
+    def start_tracks(self, section):
+        self._write('\n' if self._in_tracks else self._sec_sep)
+        self._write(_report_track_sections[section])
+        self._in_tracks = True
+
+    def track(self, section, track):
+        self._write('   {}'.format(_track_display(track)))
+
+    def start_playlists(self):
+        self._write(self._sec_sep)
+        self._write('Comparing playlists found in the old library:')
+
+    def playlist_mismatch(self, name, n_matched):
+        self._write('   Playlist {} matches {} playlists in the new library'.format(name, n_matched))
+
+    def start_playlist(self, name):
+        self._write('   Playlist {}:'.format(name))
+
+    def playlist_track(self, name, status, track):
+        self._write('      {} {} new playlist'.format(_track_display(track), 'missing from' if status == 'missing'
+                                                                                    else 'added to'))
+
+    def end_playlist(self, name, all_tracks):
+        if all_tracks:
+            self._write('      All tracks accounted for')
+
+
+class _RecordReportWriter(_ReportWriter):
+    # Writes one record per report line, with the keys in _report_fields
+    @abstractmethod
+    def _write_record(self, record):
+        pass
+
+    def _track_record(self, record, track):
+        record['track'] = _track_display(track)
+        if not isinstance(track, str):
+            record['artist'] = track.get('Artist')
+            record['album'] = track.get('Album')
+            record['year'] = track.get('Year')
+            record['name'] = track.get('Name')
+        self._write_record(record)
+
+    def summary(self, old_lib_name, n_old, new_lib_name, n_new):
+        self._write_record({'section': 'summary', 'status': 'old', 'library': old_lib_name, 'count': n_old})
+        self._write_record({'section': 'summary', 'status': 'new', 'library': new_lib_name, 'count': n_new})
+
+    def start_tracks(self, section):
+        pass
+
+    def track(self, section, track):
+        self._track_record({'section': section}, track)
+
+    def start_playlists(self):
+        pass
+
+    def playlist_mismatch(self, name, n_matched):
+        self._write_record({'section': 'playlists', 'playlist': name, 'status': 'unmatched', 'count': n_matched})
+
+    def start_playlist(self, name):
+        pass
+
+    def playlist_track(self, name, status, track):
+        self._track_record({'section': 'playlists', 'playlist': name, 'status': status}, track)
+
+    def end_playlist(self, name, all_tracks):
+        if all_tracks:
+            self._write_record({'section': 'playlists', 'playlist': name, 'status': 'complete'})
+
+
+class _JsonLinesReportWriter(_RecordReportWriter):
+    def _write_record(self, record):
+        self._fobj.write(json.dumps(record, default=str, sort_keys=True) + '\n')
+
+
+class _CsvReportWriter(_RecordReportWriter):
+    def __init__(self, *args, **kwargs):
+        super(_CsvReportWriter, self).__init__(*args, **kwargs)
+        self._csv = csv.writer(self._fobj, lineterminator='\n')
+        self._csv.writerow(_report_fields)
+
+    def _write_record(self, record):
+        self._csv.writerow(['' if record.get(k) is None else record[k] for k in _report_fields])
+
+
+_report_writers = {'text': _TextReportWriter, 'jsonl': _JsonLinesReportWriter, 'csv': _CsvReportWriter}
+
+
+def open_report_writer(log_file=None, report_format='text', buffer_size=1048576):
+    """
+    Open a report writer for assemble_report or assemble_incremental_report.
+    :param log_file: file to write to. If None, writes to stdout.
+    :param report_format: 'text' (the human readable report), 'jsonl' (one JSON object per line) or 'csv'. The
+    machine readable formats have one record per track, playlist or summary line, with the fields section, playlist,
+    status, track, artist, album, year, name, library and count.
+    :param buffer_size: size of the output buffer in bytes
+    :return: the report writer, which should be closed when done (it may be used as a context manager)
+    """
+    try:
+        writer_class = _report_writers[report_format]
+    except KeyError:
+        raise ValueError('report_format must be one of: {}'.format(', '.join(sorted(_report_writers.keys()))))
+    return writer_class(log_file, buffer_size=buffer_size)
+
+
+def _track_display(track):
+    # Fingerprint tables only store the formatted string for each track
+    return track if isinstance(track, str) else format_track(track)
+
+
+def _parse_lib_worker(args):
+    # Top level so that it can be sent to a process pool
+    lib_file, compact, use_cache, cache_dir, max_cache_bytes = args
+    if use_cache:
+        return cached_parse_itunes_lib(lib_file, cache_dir=cache_dir, compact=compact,
+                                       max_cache_bytes=max_cache_bytes)
     else:
-        write_fxn = lambda s: print(s)
-    
-    sec_sep = '\n##########################\n'
-    
-    # Now write the report
-    write_fxn('Summary:')
-    write_fxn('Tracks in the old library, {}: {}'.format(old_lib_file, len(old_lib['Tracks'])))
-    write_fxn('Tracks in the new library, {}: {}'.format(new_lib_file, len(new_lib['Tracks'])))
-    
-    write_fxn(sec_sep)
-    write_fxn('Tracks missing from the new library:')
-    for track in not_in_new:
-        write_fxn('   {}'.format(format_track(track)))
-    write_fxn('\n')
-    write_fxn('Tracks missing from the old library:')   
-    for track in not_in_old:
-        write_fxn('   {}'.format(format_track(track)))
-        
-    write_fxn(sec_sep)
-    write_fxn('Comparing playlists found in the old library:')
-    
-    skip_lists = ['Library', 'Music', 'Genius']
-    
-    lists_alphabetical = old_plists.keys()
-    lists_alphabetical.sort()
-    for k in lists_alphabetical:
-        if k in skip_lists:
-            # avoid the very long catch-all lists
-            continue
-        if len(old_plists[k]['matched']) != 1:
-            write_fxn('   Playlist {} matches {} playlists in the new library'.format(k, len(old_plists[k]['matched'])))
+        return parse_itunes_lib(lib_file, compact=compact)
+
+
+def parse_libs(lib_files, compact='table', use_cache=False, cache_dir=None, parallel=True, max_cache_bytes=None):
+    """
+    Parse several iTunes libraries, by default concurrently in a process pool.
+    :param lib_files: list of paths to library XML files
+    :param compact: passed through to parse_itunes_lib
+    :param use_cache: if True, use cached_parse_itunes_lib with cache_dir instead of parse_itunes_lib
+    :param cache_dir: see cached_parse_itunes_lib
+    :param max_cache_bytes: see cached_parse_itunes_lib
+    :param parallel: if False, or if there is only one file or one CPU, parse the files one after another in this
+    process.
+    :return: list of parsed libraries in the same order as lib_files
+    """
+    job_args = [(f, compact, use_cache, cache_dir, max_cache_bytes) for f in lib_files]
+    n_procs = min(len(job_args), multiprocessing.cpu_count())
+    if not parallel or n_procs < 2:
+        return [_parse_lib_worker(a) for a in job_args]
+
+    pool = multiprocessing.Pool(processes=n_procs)
+    try:
+        return pool.map(_parse_lib_worker, job_args)
+    finally:
+        pool.close()
+        pool.join()
+
+
+def assemble_report(old_lib_file, new_lib_file, log_file=None, compact='table', use_cache=False, cache_dir=None,
+                    parallel=True, report_format='text', max_cache_bytes=None):
+    # First we need to parse the two files. A compact track table cuts memory use a lot and gives the same report.
+    # With use_cache, unchanged files (e.g. a frozen old library) are loaded from a snapshot instead. The two
+    # parses are independent so by default they run in separate processes; parallel=False parses serially.
+    # max_cache_bytes limits the total size of the snapshots, see cached_parse_itunes_lib.
+    print('Parsing old and new lib files...', file=sys.stderr)
+    old_lib, new_lib = parse_libs([old_lib_file, new_lib_file], compact=compact, use_cache=use_cache,
+                                  cache_dir=cache_dir, parallel=parallel, max_cache_bytes=max_cache_bytes)
+
+    # The rest of the report is written as it is computed, see open_report_writer for the formats
+    with open_report_writer(log_file, report_format) as writer:
+        writer.summary(old_lib_file, len(old_lib['Tracks']), new_lib_file, len(new_lib['Tracks']))
+
+        # Next let's figure out what tracks are missing overall
+        print('Comparing libraries as a whole...', file=sys.stderr)
+        old_tracks = old_lib['Tracks'].values()
+        new_tracks = new_lib['Tracks'].values()
+        writer.start_tracks('missing_from_new')
+        for track in iter_tracks_not_in(old_tracks, index_tracks(new_tracks)):
+            writer.track('missing_from_new', track)
+        writer.start_tracks('missing_from_old')
+        for track in iter_tracks_not_in(new_tracks, index_tracks(old_tracks)):
+            writer.track('missing_from_old', track)
+
+        # And finally look at the playlists. Only the last old playlist of any given name is compared, as before.
+        print('Comparing individual playlists...', file=sys.stderr)
+        writer.start_playlists()
+        old_index = ITunesLibrary(old_lib)
+        new_index = ITunesLibrary(new_lib)
+        for k in sorted(old_index.playlist_names()):
+            if k in _report_skip_lists:
+                # avoid the very long catch-all lists
+                continue
+            matched = new_index.playlist_indices(k)
+            if len(matched) != 1:
+                writer.playlist_mismatch(k, len(matched))
+                continue
+
+            old_ptracks = old_index.playlist_tracks(old_index.playlist_indices(k)[-1])
+            new_pkeys = new_index.playlist_keys(matched[0])
+            writer.start_playlist(k)
+            all_tracks = True
+            for t in iter_tracks_not_in(old_ptracks, new_pkeys):
+                writer.playlist_track(k, 'missing', t)
+                all_tracks = False
+            writer.end_playlist(k, all_tracks)
+
+
+# Incremental diffs. Rather than keeping the old library around, each run can save a small fingerprint table of the
+# library (a hash of the identity keys and of the rest of the contents of each track, plus playlist membership as
+# identity hashes) and the next run diffs the new library against that.
+_fingerprint_version = 3
+# Keys that change just by listening to the library, so are ignored when deciding if a track changed
+_volatile_track_keys = frozenset(['Play Count', 'Play Date', 'Play Date UTC', 'Skip Count', 'Skip Date',
+                                  'Date Modified'])
+# Keys iTunes may assign afresh each time it exports the library, so are ignored as well
+_per_export_track_keys = frozenset(['Track ID', 'Persistent ID'])
+_unhashed_track_keys = _volatile_track_keys | _per_export_track_keys
+
+
+def _hash_values(values):
+    parts = []
+    for v in values:
+        if v is _MISSING:
+            parts.append('\x00')
         else:
-            old_ptracks = assemble_playlist(old_plists[k]['mine'], old_lib['Tracks'])
-            new_ptracks = assemble_playlist(old_plists[k]['matched'][0], new_lib['Tracks'])
-            write_fxn('   Playlist {}:'.format(k))
+            parts.append('{}:{}'.format(type(v).__name__, v))
+    digest = hashlib.md5('\x1f'.join(parts).encode('utf-8')).hexdigest()
+    return int(digest[:16], 16)
+
+
+def track_identity_hash(t):
+    """
+    Returns a 64 bit integer hash of track_key(t)
+    """
+    return _hash_values(track_key(t))
+
+
+def track_content_hash(t):
+    """
+    Returns a 64 bit integer hash of all the keys and values of track t except the volatile ones (play counts, etc.)
+    and the ones that are renumbered between exports (Track ID, Persistent ID)
+    """
+    values = []
+    for k in sorted(t.keys()):
+        if k not in _unhashed_track_keys:
+            values.append(k)
+            values.append(t[k])
+    return _hash_values(values)
+
+
+def build_lib_fingerprints(lib_file):
+    """
+    Build the fingerprint table for an iTunes library in one streaming pass over the file. The full library is never
+    held in memory.
+    :param lib_file: path to the library XML file
+    :return: dict with keys 'version', 'source', 'n_tracks', 'tracks' (identity hash -> list of (content hash,
+    format_track string) tuples), 'order' (the identity hashes in 'tracks', sorted by their format_track string), and
+    'playlists' (name -> dict with 'count', the number of playlists with that name, and 'members', the identity
+    hashes of the tracks in the last playlist with that name, or None for the catch-all lists that the report skips).
+    """
+    tracks = dict()
+    ident_by_id = dict()
+    playlists = dict()
+    n_tracks = 0
+
+    tokens = _open_main_dict(lib_file)
+    for key, kind, val in _iter_stream_dict(tokens):
+        if key == 'Tracks' and kind == 'open' and val == 'dict':
+            for _, tkind, tval in _iter_stream_dict(tokens):
+                t = _parse_stream_value(tokens, tkind, tval)
+                ident = track_identity_hash(t)
+                ident_by_id[t['Track ID']] = ident
+                tracks.setdefault(ident, []).append((track_content_hash(t), format_track(t)))
+                n_tracks += 1
+        elif key == 'Playlists' and kind == 'open' and val == 'array':
+            for pkind, pval in tokens:
+                if pkind == 'text':
+                    continue
+                elif pkind == 'close':
+                    break
+                plist = _parse_stream_value(tokens, pkind, pval)
+                name = plist['Name']
+                entry = playlists.setdefault(name, {'count': 0, 'members': None})
+                entry['count'] += 1
+                if name not in _report_skip_lists:
+                    entry['members'] = [ident_by_id[t['Track ID']] for t in plist.get('Playlist Items', [])]
+        else:
+            _parse_stream_value(tokens, kind, val)
+
+    # All the tracks with one identity have the same format_track string, so this is the order they are reported in
+    order = sorted(tracks, key=lambda ident: (tracks[ident][0][1], ident))
+    return {'version': _fingerprint_version, 'source': os.path.abspath(lib_file), 'n_tracks': n_tracks,
+            'tracks': tracks, 'order': order, 'playlists': playlists}
+
+
+def save_lib_fingerprints(fingerprints, baseline_file):
+    """
+    Write a fingerprint table from build_lib_fingerprints to baseline_file.
+    """
+    tmp_file = baseline_file + '.tmp{}'.format(os.getpid())
+    with open(tmp_file, 'wb') as f:
+        pickle.dump(fingerprints, f, pickle.HIGHEST_PROTOCOL)
+    _replace_file(tmp_file, baseline_file)
+
+
+def load_lib_fingerprints(baseline_file):
+    with open(baseline_file, 'rb') as f:
+        fingerprints = pickle.load(f)
+    if fingerprints.get('version') != _fingerprint_version:
+        raise ValueError('Baseline {} has unsupported version {}, delete it to start a new baseline'
+                         .format(baseline_file, fingerprints.get('version')))
+    return fingerprints
+
+
+def _iter_fingerprint_section(fp, other_fp, changed):
+    tracks = fp['tracks']
+    other_tracks = other_fp['tracks']
+    for ident in fp['order']:
+        entries = tracks[ident]
+        other_entries = other_tracks.get(ident)
+        if changed:
+            if other_entries is None or sorted(e[0] for e in entries) == sorted(e[0] for e in other_entries):
+                continue
+        elif other_entries is not None:
+            continue
+        for _, disp in entries:
+            yield disp
+
+
+def fingerprint_diff(old_fp, new_fp):
+    """
+    Compare two fingerprint tables. Each section is a generator that walks the saved sort order of one of the tables,
+    so the sections come out sorted without being collected first.
+    :return: three iterators of format_track strings, in sorted order: tracks removed (identity only in old_fp),
+    tracks added (identity only in new_fp) and tracks changed (same identity, different contents). Duplicates are kept.
+    """
+    return (_iter_fingerprint_section(old_fp, new_fp, False), _iter_fingerprint_section(new_fp, old_fp, False),
+            _iter_fingerprint_section(new_fp, old_fp, True))
+
+
+def assemble_incremental_report(baseline_file, new_lib_file, log_file=None, update_baseline=True,
+                                report_format='text'):
+    """
+    Write the same report as assemble_report, but compare new_lib_file against a fingerprint baseline saved by a
+    previous run instead of against the old library XML. Also reports tracks whose contents changed.
+    :param baseline_file: path to the baseline fingerprint file. If it does not exist, every track is reported as
+    added.
+    :param new_lib_file: path to the current library XML file
+    :param log_file: file to write the report to. If None, it is printed.
+    :param update_baseline: if True, baseline_file is overwritten with the fingerprints of new_lib_file afterwards.
+    :param report_format: see open_report_writer
+    """
+    print('Fingerprinting new lib file...', file=sys.stderr)
+    new_fp = build_lib_fingerprints(new_lib_file)
+    if os.path.isfile(baseline_file):
+        old_fp = load_lib_fingerprints(baseline_file)
+    else:
+        print('No baseline found at {}, treating it as empty'.format(baseline_file), file=sys.stderr)
+        old_fp = {'source': baseline_file, 'n_tracks': 0, 'tracks': dict(), 'order': [], 'playlists': dict()}
+
+    old_tracks = old_fp['tracks']
+    new_tracks = new_fp['tracks']
+    with open_report_writer(log_file, report_format) as writer:
+        writer.summary(old_fp['source'], old_fp['n_tracks'], new_lib_file, new_fp['n_tracks'])
+
+        print('Comparing libraries as a whole...', file=sys.stderr)
+        removed, added, changed = fingerprint_diff(old_fp, new_fp)
+        for section, tracks in (('missing_from_new', removed), ('missing_from_old', added), ('changed', changed)):
+            writer.start_tracks(section)
+            for disp in tracks:
+                writer.track(section, disp)
+
+        print('Comparing individual playlists...', file=sys.stderr)
+        writer.start_playlists()
+        for k in sorted(old_fp['playlists'].keys()):
+            if k in _report_skip_lists:
+                continue
+            n_matched = new_fp['playlists'][k]['count'] if k in new_fp['playlists'] else 0
+            if n_matched != 1:
+                writer.playlist_mismatch(k, n_matched)
+                continue
+
+            old_members = old_fp['playlists'][k]['members']
+            new_members = new_fp['playlists'][k]['members']
+            new_member_set = set(new_members)
+            old_member_set = set(old_members)
+            writer.start_playlist(k)
             all_tracks = True
-            for t in old_ptracks:
-                if not track_in_list(t, new_ptracks):
-                    write_fxn('      {} missing from new playlist'.format(format_track(t)))
+            for ident in old_members:
+                if ident not in new_member_set:
+                    writer.playlist_track(k, 'missing', old_tracks[ident][0][1])
                     all_tracks = False
-            if all_tracks:
-                write_fxn('      All tracks accounted for')
-    
-        
-    if log_file is not None:
-        logf.close()
-    
\ No newline at end of file
+            for ident in new_members:
+                if ident not in old_member_set:
+                    writer.playlist_track(k, 'added', new_tracks[ident][0][1])
+                    all_tracks = False
+            writer.end_playlist(k, all_tracks)
+
+    if update_baseline:
+        save_lib_fingerprints(new_fp, baseline_file)
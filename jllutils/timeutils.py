@@ -3,16 +3,70 @@ JLLUtils.timeutils: module contains convenience functions for working with dates
 Includes:
     str2date: converts a string into a datetime.date or datetime.datetime object
     date2str: converts a datetime.date or datetime.datetime object into a string
+    str2date_array: converts a sequence or array of strings in one format into a numpy datetime64 array
+    date2str_array: converts a datetime64 array or a sequence of dates into strings in one format
+    convert_date_columns: rewrites date columns of a large delimited text file from one format to another
+    compile_format: analyzes a format string once for repeated use by str2date and date2str
 """
 from __future__ import print_function
 from __future__ import division
 
 __author__ = 'Josh'
 
+from collections import deque
 import datetime as dt
+import io
+import multiprocessing
 import re
+import sys
+import time
 import pdb
 
+try:
+    import numpy as np
+except ImportError:
+    # Only needed for the *_array functions
+    np = None
+
+try:
+    from functools import lru_cache
+except ImportError:
+    # Python 2 has no lru_cache; this stand in simply forgets everything once the cache is full
+    def lru_cache(maxsize=128):
+        def decorator(fxn):
+            cache = dict()
+            def wrapper(arg):
+                try:
+                    return cache[arg]
+                except KeyError:
+                    if len(cache) >= maxsize:
+                        cache.clear()
+                    val = cache[arg] = fxn(arg)
+                    return val
+            wrapper.cache_clear = cache.clear
+            return wrapper
+        return decorator
+
+_ampm_re = re.compile("[aApP][mM]")
+_month_abbrevs = ("jan", "feb", "mar", "apr", "may", "jun", "jul", "aug", "sep", "oct", "nov", "dec")
+_month_numbers = dict((abbrev, i+1) for i, abbrev in enumerate(_month_abbrevs))
+_month_names = tuple(abbrev.capitalize() for abbrev in _month_abbrevs)
+
+# Placeholders used while compiling output formats. They must not be characters that can be part of a format token.
+_out_fields = (("yyyy", "\x01", "{0:04}"), ("yy", "\x02", "{1:02}"), ("mmm", "\x03", "{2}"), ("mm", "\x04", "{3:02}"),
+               ("dd", "\x05", "{4:02}"), ("ampm", "\x06", "{5}"), ("HH", "\x07", "{6:02}"), ("MM", "\x0e", "{7:02}"),
+               ("SS", "\x0f", "{8:02}"))
+_out_placeholders = dict((token, ph) for token, ph, _ in _out_fields)
+# Width of each field, and for the array functions, the code points of the month names and AM/PM
+_out_widths = (4, 2, 3, 2, 2, 2, 2, 2, 2)
+if np is not None:
+    _month_name_codes = np.array([[ord(c) for c in name] for name in _month_names], dtype=np.uint32)
+    _ampm_codes = np.array([[ord(c) for c in name] for name in ("AM", "PM")], dtype=np.uint32)
+    _two_digit_codes = np.array([[ord(c) for c in "{:02}".format(i)] for i in range(100)], dtype=np.uint32)
+
+# The current year, for two digit years, and the time after which it must be looked up again
+_year_cache = [None, 0.0]
+
 # TODO: implement pivot year for two number years
 
 def str2date(str_in, format_in="yyyy-mm-dd", typeout=None):
@@ -59,86 +113,614 @@ def str2date(str_in, format_in="yyyy-mm-dd", typeout=None):
     if typeout is not dt.date and typeout is not dt.datetime and typeout is not None:
         raise TypeError("typeout must be datetime.date, datetime.datetime, or None")
 
-    # Parse the parts of the date (year, month, day, hour, minute, second)
-    # Three letter month (Jan, Feb, etc) and two number years need special
-    # handling
+    return compile_format(format_in).parse(str_in, typeout)
 
-    # First check if the string AM or PM is present in the input date time string,
-    # this will indicate that the hour needs to be adjusted
-    ampm_match = re.search("[aApP][mM]", str_in)
-    if ampm_match is None:
-        hr24_bool = True
+def date2str(date_in, format_in="yyyy-mm-dd"):
+    if type(date_in) is not dt.date and type(date_in) is not dt.datetime:
+        raise TypeError("date_in must be a datetime.date or datetime.datetime")
+    if type(format_in) is not str:
+        raise TypeError("format_in must be a str")
+
+    return compile_format(format_in).format(date_in)
+
+def str2date_array(strs_in, format_in="yyyy-mm-dd"):
+    """
+    Converts many strings in the same format to dates at once, returning a numpy datetime64 array. Each part of the
+    date is cut out of all the strings at once and converted with array arithmetic, so this is much faster than
+    calling str2date on each string. Requires numpy.
+    :param strs_in: the strings to convert, as a sequence or numpy array (str, bytes, or object). Any shape.
+    :param format_in: the format of the strings, see str2date. Two number years, AM/PM, and the defaults for
+     omitted parts are all handled as str2date does.
+    :return: two arrays the same shape as strs_in. The first is the dates as datetime64, with a unit of seconds if
+     the format includes the hour, minute, or second and days otherwise. The second is a boolean mask that is True
+     where the string could not be converted (for which str2date would raise an error); those dates are NaT.
+    Strings whose numbers are not plain digits in exactly the positions given by the format (e.g. a string shorter
+    than the format) are converted one by one with str2date, so the result is the same as str2date's for every
+    string, just not as fast.
+    Example:
+        str2date_array(['10/12/16', '13/12/16'], 'mm/dd/yy') returns
+        (array(['2016-10-12', 'NaT'], dtype='datetime64[D]'), array([False,  True]))
+    """
+    if np is None:
+        raise ImportError("str2date_array requires numpy")
+    if type(format_in) is not str:
+        raise TypeError("format_in must be a str")
+
+    fmt = compile_format(format_in)
+    strs = np.asarray(strs_in)
+    shape = strs.shape
+    strs = strs.ravel()
+    if strs.dtype.kind != "U":
+        strs = strs.astype(str)
+    n = strs.size
+    unit = "s" if any(slc is not None for slc in (fmt._HH, fmt._MM, fmt._SS)) else "D"
+    if n == 0:
+        return np.zeros(shape, dtype="datetime64[{}]".format(unit)), np.zeros(shape, dtype=bool)
+    slices = [fmt._yyyy, fmt._yy, fmt._mmm, fmt._mm, fmt._dd, fmt._HH, fmt._MM, fmt._SS]
+    width = max([strs.dtype.itemsize // 4] + [slc.stop for slc in slices if slc is not None])
+    strs = np.ascontiguousarray(strs, dtype="U{}".format(max(width, 2)))
+    # Each row is the unicode code points of one string, padded with zeros
+    codes = strs.view(np.uint32).reshape(n, -1)
+
+    # Rows where something is not as the fast path expects are redone with str2date at the end
+    retry = np.zeros(n, dtype=bool)
+    def field(slc, default=0):
+        if slc is None:
+            return np.full(n, default, dtype=np.int64)
+        val = np.zeros(n, dtype=np.int64)
+        for j in range(slc.start, slc.stop):
+            # Anything but a digit wraps around to a large number
+            digit = codes[:, j] - np.uint32(48)
+            retry[:] |= digit > 9
+            val *= 10
+            val += digit
+        return val
+
+    # AM/PM anywhere in the string, as in str2date: the first letter a or p followed by m. Or'ing with 32 lower
+    # cases letters, and only A, a, P, p, M, and m give a, p, or m after it.
+    lower = codes | np.uint32(32)
+    ampm_pos = ((lower[:, :-1] == ord("a")) | (lower[:, :-1] == ord("p"))) & (lower[:, 1:] == ord("m"))
+    has_ampm = ampm_pos.any(axis=1)
+    is_pm = has_ampm & (lower[np.arange(n), ampm_pos.argmax(axis=1)] == ord("p"))
+
+    # A four number year of 0 falls back on the two number year, as in str2date
+    yr = field(fmt._yyyy)
+    if fmt._yy is None:
+        yr = np.where(yr == 0, _current_year(), yr)
+    else:
+        curr_yr_tmp = _current_year()
+        curr_yr = curr_yr_tmp % 100
+        curr_century = curr_yr_tmp - curr_yr
+        yr2 = field(fmt._yy)
+        yr2 = np.where(yr2 <= curr_yr, yr2 + curr_century, yr2 + curr_century - 100)
+        yr = np.where(yr == 0, yr2, yr)
+
+    if fmt._mmm is not None:
+        chars = lower[:, fmt._mmm]
+        retry |= (chars > 255).any(axis=1)
+        keys = (chars[:, 0] << 16) | (chars[:, 1] << 8) | chars[:, 2]
+        abbrev_keys = np.array([(ord(a[0]) << 16) | (ord(a[1]) << 8) | ord(a[2]) for a in _month_abbrevs])
+        order = np.argsort(abbrev_keys)
+        idx = np.clip(np.searchsorted(abbrev_keys[order], keys), 0, 11)
+        mn = order[idx] + 1
+        invalid = abbrev_keys[order][idx] != keys
+    else:
+        mn = field(fmt._mm)
+        mn[mn == 0] = 1
+        invalid = np.zeros(n, dtype=bool)
+    dy = field(fmt._dd)
+    dy[dy == 0] = 1
+
+    hour = field(fmt._HH)
+    invalid |= has_ampm & ((hour < 1) | (hour > 12))
+    hour = np.where(has_ampm & is_pm & (hour != 12), hour + 12, hour)
+    hour = np.where(has_ampm & ~is_pm & (hour == 12), 0, hour)
+    minute = field(fmt._MM)
+    second = field(fmt._SS)
+
+    # Anything datetime.datetime would not accept
+    leap = (yr % 4 == 0) & ((yr % 100 != 0) | (yr % 400 == 0))
+    month_days = np.array([0, 31, 28, 31, 30, 31, 30, 31, 31, 30, 31, 30, 31])
+    invalid |= (yr < 1) | (yr > 9999) | (mn < 1) | (mn > 12)
+    invalid |= (dy > month_days[np.clip(mn, 0, 12)] + (leap & (mn == 2))) | (hour > 23) | (minute > 59) | (second > 59)
+    invalid &= ~retry
+
+    bad = invalid | retry
+    yr[bad] = 1970
+    mn[bad] = 1
+    dy[bad] = 1
+    dates = ((yr - 1970).astype("datetime64[Y]").astype("datetime64[M]") + (mn - 1)).astype("datetime64[D]") + (dy - 1)
+    if unit == "s":
+        dates = dates.astype("datetime64[s]") + (hour * 3600 + minute * 60 + second)
+
+    for i in np.flatnonzero(retry):
+        try:
+            dates[i] = np.datetime64(fmt.parse(str(strs[i]), dt.datetime), unit)
+        except (ValueError, TypeError, IndexError, OverflowError):
+            invalid[i] = True
+    dates[invalid] = np.datetime64("NaT")
+    return dates.reshape(shape), invalid.reshape(shape)
+
+def date2str_array(dates_in, format_in="yyyy-mm-dd", sep=None):
+    """
+    Converts many dates to strings in the same format at once. Every field in the format has a fixed width, so all
+    the strings are written together into one array of characters with array arithmetic, which is much faster than
+    calling date2str on each date. Requires numpy.
+    :param dates_in: a numpy datetime64 array, or a sequence of datetime.date and/or datetime.datetime objects (as
+     for date2str, other types raise a TypeError). Any shape. datetime64 arrays with a unit of days or longer are
+     formatted like datetime.date objects, so any hour, minute, second, or AM/PM identifiers are left as they are,
+     and those with shorter units like datetime.datetime objects. Time zones are ignored, as date2str does.
+    :param format_in: the format for the strings, see str2date for the identifiers
+    :param sep: if given, return all the strings joined into one str with this separator between them instead
+    :return: a numpy str array the same shape as dates_in, or a str if sep was given. NaT or dates that
+     datetime.date could not represent give empty strings.
+    Example:
+        date2str_array(np.array(['2016-10-12T13:04'], dtype='datetime64[m]'), 'dd mmm yyyy HH:MM PM') returns
+        array(['12 Oct 2016 01:04 PM'], dtype='<U20')
+    """
+    if np is None:
+        raise ImportError("date2str_array requires numpy")
+    if type(format_in) is not str:
+        raise TypeError("format_in must be a str")
+    fmt = compile_format(format_in)
+
+    if isinstance(dates_in, np.ndarray) and dates_in.dtype.kind == "M":
+        shape = dates_in.shape
+        dates = dates_in.ravel()
+        unit = np.datetime_data(dates.dtype)[0]
+        is_datetime = np.full(dates.size, unit not in ("Y", "M", "W", "D"), dtype=bool)
+    else:
+        values = np.asarray(dates_in, dtype=object)
+        shape = values.shape
+        values = values.ravel()
+        is_datetime = np.zeros(values.size, dtype=bool)
+        # Seconds since 1970 from each date's own fields, which ignores any time zone as date2str does
+        seconds = []
+        epoch = dt.date(1970, 1, 1).toordinal()
+        for i, value in enumerate(values):
+            if type(value) is dt.datetime:
+                is_datetime[i] = True
+                seconds.append((value.toordinal() - epoch) * 86400 + value.hour * 3600 + value.minute * 60
+                               + value.second)
+            elif type(value) is dt.date:
+                seconds.append((value.toordinal() - epoch) * 86400)
+            else:
+                raise TypeError("dates_in must contain only datetime.date or datetime.datetime objects")
+        dates = np.array(seconds, dtype=np.int64).astype("datetime64[s]")
+
+    days = dates.astype("datetime64[D]")
+    months = days.astype("datetime64[M]")
+    year = months.astype(np.int64) // 12 + 1970
+    invalid = np.isnat(dates) | (year < 1) | (year > 9999)
+
+    if fmt._date_parts is None:
+        # The format can only be done by date2str's one by one replacements
+        valid_dates = dates[~invalid]
+        as_datetimes = valid_dates.astype("datetime64[s]").astype(dt.datetime)
+        as_dates = valid_dates.astype("datetime64[D]").astype(dt.date)
+        strs = np.array([""] + [_date2str_replace(dtm if is_dt else d, format_in)
+                                for dtm, d, is_dt in zip(as_datetimes, as_dates, is_datetime[~invalid])])
+        strs = strs[np.where(invalid, 0, np.cumsum(~invalid))]
     else:
-        hr24_bool = False
-        ampm_str = ampm_match.group(0).lower()
+        seconds = (dates.astype("datetime64[s]") - days).astype(np.int64)
+        fields = {0: year, 1: year % 100, 3: months.astype(np.int64) % 12 + 1,
+                  4: (days - months).astype(np.int64) + 1, 6: seconds // 3600, 7: seconds // 60 % 60, 8: seconds % 60}
+        fields[2] = fields[3]
+        fields[5] = fields[6] >= 12
+        if fmt._ampm:
+            fields[6] = np.where(fields[6] % 12 == 0, 12, fields[6] % 12)
 
+        date_strs = _render_parts(fmt._date_parts, fields, ~is_datetime & ~invalid)
+        datetime_strs = _render_parts(fmt._datetime_parts, fields, is_datetime & ~invalid)
+        width = max(date_strs.dtype.itemsize, datetime_strs.dtype.itemsize) // 4
+        strs = np.zeros(dates.size, dtype="U{}".format(max(width, 1)))
+        strs[~is_datetime & ~invalid] = date_strs
+        strs[is_datetime & ~invalid] = datetime_strs
 
-    # Try finding four number year first (because 'yy' will match 'yyyy' too)
-    # If there isn't even a two letter year, set the year to the current one
-    yr = __substr_to_int(str_in, format_in, "yyyy")
-    if yr == 0:
-        yr = __substr_to_int(str_in, format_in, "yy", def_val=None)  # must use None because 00 is a legitimate year
-        if yr is None:
-            yr = dt.date.today().year
+    if sep is not None:
+        return sep.join(strs.tolist())
+    return strs.reshape(shape)
+
+
+def _render_parts(parts, fields, rows):
+    # Writes the strings for the selected rows as a matrix of code points, one column per character, then views it
+    # as a str array. (np.take is used since it is much faster than fancy indexing here.)
+    n = int(rows.sum())
+    widths = [len(p) if isinstance(p, str) else _out_widths[p] for p in parts]
+    codes = np.empty((n, sum(widths)), dtype=np.uint32)
+    all_rows = n == rows.size
+    col = 0
+    for part, width in zip(parts, widths):
+        if isinstance(part, str):
+            codes[:, col:col+width] = [ord(c) for c in part]
         else:
-            curr_yr_tmp = dt.date.today().year
-            curr_yr = curr_yr_tmp % 100
-            curr_century = curr_yr_tmp - curr_yr
-            if yr <= curr_yr:
-                yr = yr + curr_century
+            val = fields[part] if all_rows else fields[part][rows]
+            if part == 2:
+                codes[:, col:col+width] = np.take(_month_name_codes, val - 1, axis=0)
+            elif part == 5:
+                codes[:, col:col+width] = np.take(_ampm_codes, val.astype(np.int64), axis=0)
+            elif width == 4:
+                codes[:, col:col+2] = np.take(_two_digit_codes, val // 100, axis=0)
+                codes[:, col+2:col+4] = np.take(_two_digit_codes, val % 100, axis=0)
             else:
-                yr = yr + curr_century - 100
-
-    # Similar approach for months, except that for three letter months, we
-    # need to convert from name to number. Default to Jan if no month given
-    mn = __substr_to_month(str_in, format_in) # always searches for "mmm"
-    if mn is None:
-        mn = __substr_to_int(str_in, format_in, "mm")
-        if mn == 0:
-            mn = 1
-
-    # Similar again for day, except that it can only ever be specified as "dd"
-    dy = __substr_to_int(str_in, format_in, "dd")
-    if dy == 0:
-        dy = 1
-
-    # Hour, minute, and second are easier because they can be 0...
-    hour = __substr_to_int(str_in, format_in, "HH")
-    # ... but hour needs to handle AM/PM. Afternoon needs 12 hours added
-    # (1:00 PM = 1300 hr, 8:00 = 2000 hr, etc) but noon should stay 12 and
-    # midnight (12 AM) should become hour = 0
-    if not hr24_bool:
-        if hour < 1 or hour > 12:
-            raise ValueError("If using AM/PM format, hour must be between 1 and 12")
-        elif hour != 12 and ampm_str == "pm":
-            hour += 12
-        elif hour == 12 and ampm_str == "am":
-            hour = 0
-    minute = __substr_to_int(str_in, format_in, "MM")
-    second = __substr_to_int(str_in, format_in, "SS")
-
-    # If no type out specified, it will be date only if hour, minute, and second
-    # are all 0
-    if typeout is None:
-        if hour == 0 and minute == 0 and second == 0:
-            typeout = dt.date
+                codes[:, col:col+width] = np.take(_two_digit_codes, val, axis=0)
+        col += width
+    if codes.shape[1] == 0:
+        return np.zeros(n, dtype="U1")
+    return codes.view("U{}".format(codes.shape[1])).reshape(n)
+
+def convert_date_columns(in_file, out_file, columns, format_in, format_out="yyyy-mm-dd", delimiter=",", header=False,
+                         errors="strict", processes=1, chunk_size=16*1024**2, encoding="utf-8"):
+    """
+    Converts the dates in some columns of a delimited text file (e.g. CSV or TSV) from one format to another,
+    streaming through the file a chunk of lines at a time so that files of any size can be converted. Everything
+    but the converted dates is written out exactly as read.
+    :param in_file: path to the file to read, or "-" for stdin
+    :param out_file: path to the file to write, or "-" for stdout
+    :param columns: the columns to convert, as 0-based indices or, if header is True, column names
+    :param format_in: the format of the dates in the file, see str2date. If it includes the hour, minute, or second,
+     every date is read as a datetime.datetime, otherwise as a datetime.date.
+    :param format_out: the format to write the dates in, see date2str
+    :param delimiter: the string between fields. Lines are simply split on it, quoting is not interpreted, except
+     that a date field in double quotes keeps them.
+    :param header: if True, the first line is copied unchanged and may be used to give columns by name
+    :param errors: what to do with a date that cannot be converted: "strict" raises a ValueError, "keep" writes it
+     unchanged, and "blank" writes an empty field. Empty fields are always left empty, and lines without enough
+     fields are written unchanged.
+    :param processes: number of processes to convert chunks in. The file is still read and written by this process,
+     in order, split into chunks at line boundaries.
+    :param chunk_size: approximate number of characters per chunk
+    :param encoding: the text encoding of both files
+    :return: the number of lines read, including the header
+    Conversion uses str2date_array and date2str_array a whole chunk at a time if numpy is available, otherwise
+    str2date and date2str with the format analyzed once.
+    """
+    if errors not in ("strict", "keep", "blank"):
+        raise ValueError('errors must be "strict", "keep", or "blank"')
+    if not header and not all(isinstance(c, int) for c in columns):
+        raise ValueError("columns can only be given by name if header is True")
+
+    fin = io.open(sys.stdin.fileno() if in_file == "-" else in_file, "r", encoding=encoding, newline="",
+                  closefd=in_file != "-")
+    fout = io.open(sys.stdout.fileno() if out_file == "-" else out_file, "w", encoding=encoding, newline="",
+                   closefd=out_file != "-")
+    pool = multiprocessing.Pool(processes) if processes > 1 else None
+    n_lines = 0
+    try:
+        chunks = _iter_line_chunks(fin, chunk_size)
+        if header:
+            first_chunk = next(chunks, "")
+            header_line, newline, first_chunk = first_chunk.partition("\n")
+            names = header_line.rstrip("\r").split(delimiter)
+            try:
+                columns = [c if isinstance(c, int) else names.index(c) for c in columns]
+            except ValueError:
+                raise ValueError("Not all of the columns {0} are in the header".format(columns))
+            fout.write(header_line + newline)
+            n_lines += 1 if header_line or newline else 0
+            chunks = _chain_chunk(first_chunk, chunks)
+        args = (tuple(columns), format_in, format_out, delimiter, errors)
+
+        if pool is None:
+            results = (_convert_chunk(chunk, *args) for chunk in chunks)
         else:
-            typeout = dt.datetime
+            results = _ordered_pool_results(pool, _convert_chunk, chunks, args, window=2*processes)
+        for text, n in results:
+            fout.write(text)
+            n_lines += n
+    finally:
+        if pool is not None:
+            pool.terminate()
+            pool.join()
+        fin.close()
+        fout.close()
+    return n_lines
 
-    if typeout is dt.date:
-        return dt.date(yr, mn, dy)
-    elif typeout is dt.datetime:
-        return dt.datetime(yr, mn, dy, hour, minute, second)
-    else:
-        raise RuntimeError("Not implemented: typeout other than datetime.date or datetime.datetime")
 
-def date2str(date_in, format_in="yyyy-mm-dd"):
-    if type(date_in) is not dt.date and type(date_in) is not dt.datetime:
-        raise TypeError("date_in must be a datetime.date or datetime.datetime")
-    if type(format_in) is not str:
-        raise TypeError("format_in must be a str")
+def _iter_line_chunks(fobj, chunk_size):
+    # Chunks of about chunk_size characters that each end with a newline (except perhaps the last)
+    remainder = ""
+    while True:
+        data = fobj.read(chunk_size)
+        if not data:
+            break
+        data = remainder + data
+        cut = data.rfind("\n") + 1
+        remainder = data[cut:]
+        if cut:
+            yield data[:cut]
+    if remainder:
+        yield remainder
 
-    ampm_match = re.search("[aApP][mM]", format_in)
+def _chain_chunk(first, chunks):
+    if first:
+        yield first
+    for chunk in chunks:
+        yield chunk
+
+def _ordered_pool_results(pool, fxn, items, args, window):
+    # Like pool.imap, but only takes window items ahead from items, so a large file is not all read into memory
+    pending = deque()
+    for item in items:
+        pending.append(pool.apply_async(fxn, (item,) + args))
+        if len(pending) >= window:
+            yield pending.popleft().get()
+    while pending:
+        yield pending.popleft().get()
+
+def _convert_chunk(text, columns, format_in, format_out, delimiter, errors):
+    # Converts the date columns in a chunk of lines, returning the new text and the number of lines
+    lines = text.split("\n")
+    last = lines.pop()  # Empty if the chunk ends with a newline
+    if last:
+        lines.append(last)
+    # Windows line endings are taken off while the line is split up and put back after
+    crs = [line.endswith("\r") for line in lines]
+    rows = [(line[:-1] if cr else line).split(delimiter) for line, cr in zip(lines, crs)]
+
+    n_fields = max(columns) + 1
+    is_datetime = any(token in format_in for token in ("HH", "MM", "SS"))
+    for col in columns:
+        # Rows with this column, whose value is not empty, and whether it is quoted
+        targets = []
+        values = []
+        for i, row in enumerate(rows):
+            if len(row) < n_fields or not row[col]:
+                continue
+            value = row[col]
+            quoted = len(value) >= 2 and value[0] == '"' and value[-1] == '"'
+            targets.append((i, quoted))
+            values.append(value[1:-1] if quoted else value)
+        if not values:
+            continue
+
+        if np is not None:
+            dates, invalid = str2date_array(values, format_in)
+            new_values = date2str_array(dates, format_out).tolist()
+            invalid = invalid.tolist()
+        else:
+            fmt_in = compile_format(format_in)
+            fmt_out = compile_format(format_out)
+            typeout = dt.datetime if is_datetime else dt.date
+            new_values = []
+            invalid = []
+            for value in values:
+                try:
+                    new_values.append(fmt_out.format(fmt_in.parse(value, typeout)))
+                    invalid.append(False)
+                except (ValueError, TypeError, IndexError):
+                    new_values.append("")
+                    invalid.append(True)
+
+        for (i, quoted), value, new_value, bad in zip(targets, values, new_values, invalid):
+            if bad:
+                if errors == "strict":
+                    raise ValueError("Could not convert {0!r} in column {1} to a date with format {2!r}".format(
+                        value, col, format_in))
+                elif errors == "keep":
+                    continue
+            rows[i][col] = '"' + new_value + '"' if quoted else new_value
+
+    text = "\n".join(delimiter.join(row) + "\r" if cr else delimiter.join(row) for row, cr in zip(rows, crs))
+    if not last:
+        text += "\n"
+    return text, len(rows)
+
+
+@lru_cache(maxsize=256)
+def compile_format(format_in):
+    """
+    Analyzes a format string in the mini-language used by str2date and date2str once, so that converting many
+    dates with the same format does not repeat that work. str2date and date2str call this themselves, and the
+    result is cached for the most recently used formats, so there is usually no need to call it directly.
+    :param format_in: the format string, see str2date for the identifiers
+    :return: a DateFormat instance
+    """
+    return DateFormat(format_in)
+
+
+class DateFormat(object):
+    """
+    A format string analyzed for repeated use. For input, it holds where in the string each part of the date is;
+    for output, a template that fills in every part in one pass. Use its parse() and format() methods, which behave
+    exactly as str2date and date2str (without the argument type checks), or get one with compile_format.
+    """
+    def __init__(self, format_in):
+        self.format_in = format_in
+
+        # Input: the slice of the string holding each part. Like str2date always has, only the first occurrence
+        # of each identifier is used, and "yy" is looked for even if "yyyy" is present, for years given as 0000.
+        def find_slice(substr):
+            i = format_in.find(substr)
+            return slice(i, i+len(substr)) if i >= 0 else None
+        self._yyyy = find_slice("yyyy")
+        self._yy = find_slice("yy")
+        self._mmm = find_slice("mmm")
+        self._mm = find_slice("mm")
+        self._dd = find_slice("dd")
+        self._HH = find_slice("HH")
+        self._MM = find_slice("MM")
+        self._SS = find_slice("SS")
+
+        # Output: str.format templates for date2str, and lists of literal text and field numbers for date2str_array
+        date_fmt, datetime_fmt, self._ampm = self.__compile_output(format_in)
+        self._date_template = _placeholders_to_template(date_fmt)
+        self._datetime_template = _placeholders_to_template(datetime_fmt)
+        self._date_parts = _placeholders_to_parts(date_fmt)
+        self._datetime_parts = _placeholders_to_parts(datetime_fmt)
+
+    @staticmethod
+    def __compile_output(format_in):
+        # Make the same replacements date2str always has, in the same order, but with placeholders instead of values.
+        # Returns the result for dates and for datetimes, or None for both if the format cannot be done this way.
+        ampm_match = _ampm_re.search(format_in)
+        fmt = format_in
+        if fmt.find("yyyy") >= 0:
+            fmt = fmt.replace("yyyy", _out_placeholders["yyyy"])
+        else:
+            fmt = fmt.replace("yy", _out_placeholders["yy"])
+        if fmt.find("mmm") >= 0:
+            fmt = fmt.replace("mmm", _out_placeholders["mmm"])
+        else:
+            fmt = fmt.replace("mm", _out_placeholders["mm"])
+        date_fmt = fmt.replace("dd", _out_placeholders["dd"])
+        fmt = date_fmt
+        if ampm_match is not None:
+            fmt = fmt.replace(ampm_match.group(0), _out_placeholders["ampm"])
+        for token in ("HH", "MM", "SS"):
+            fmt = fmt.replace(token, _out_placeholders[token])
+        datetime_fmt = fmt
+
+        if any(ph in format_in for _, ph, _ in _out_fields):
+            # The format itself contains a placeholder character, so always do the replacements one by one
+            return None, None, ampm_match is not None
+        templates = (_placeholders_to_template(date_fmt), _placeholders_to_template(datetime_fmt),
+                     ampm_match is not None)
+
+        # A month abbreviation or AM/PM written into the string might combine with the characters next to it into
+        # another identifier (e.g. "Mmmm" in May), which the one by one replacements would then replace too. Check
+        # every month and AM and PM, and if the template gives anything different, do not use it.
+        probes = [dt.date(2016, m, 15) for m in range(1, 13)]
+        probes += [dt.datetime(2016, m, 15, h, 30, 45) for m in range(1, 13) for h in (1, 13)]
+        for probe in probes:
+            if DateFormat.__format_with_templates(probe, *templates) != _date2str_replace(probe, format_in):
+                return None, None, ampm_match is not None
+        return date_fmt, datetime_fmt, ampm_match is not None
+
+    @staticmethod
+    def __format_with_templates(date_in, date_template, datetime_template, ampm):
+        if type(date_in) is dt.datetime:
+            hour = date_in.hour
+            ampm_str = None
+            if ampm:
+                ampm_str = "PM" if hour >= 12 else "AM"
+                hour = hour % 12 or 12
+            return datetime_template.format(date_in.year, date_in.year % 100, _month_names[date_in.month-1],
+                                            date_in.month, date_in.day, ampm_str, hour, date_in.minute,
+                                            date_in.second)
+        else:
+            return date_template.format(date_in.year, date_in.year % 100, _month_names[date_in.month-1],
+                                        date_in.month, date_in.day)
+
+    def format(self, date_in):
+        """
+        Convert a datetime.date or datetime.datetime to a string in this format, see date2str
+        """
+        if self._date_template is None:
+            return _date2str_replace(date_in, self.format_in)
+        return self.__format_with_templates(date_in, self._date_template, self._datetime_template, self._ampm)
+
+    def parse(self, str_in, typeout=None):
+        """
+        Convert a string in this format to a datetime.date or datetime.datetime, see str2date
+        """
+        if typeout is not dt.date and typeout is not dt.datetime and typeout is not None:
+            raise TypeError("typeout must be datetime.date, datetime.datetime, or None")
+
+        # First check if the string AM or PM is present in the input date time string,
+        # this will indicate that the hour needs to be adjusted
+        ampm_match = _ampm_re.search(str_in)
+
+        # A four number year of 0 is treated as missing, and then the first two numbers of it as a two number year.
+        # If there isn't even a two number year, use the current one.
+        yr = int(str_in[self._yyyy]) if self._yyyy is not None else 0
+        if yr == 0:
+            if self._yy is None:
+                yr = _current_year()
+            else:
+                yr = _pivot_two_digit_year(int(str_in[self._yy]))
+
+        # Three letter months need converted from name to number. Default to Jan if no month given
+        if self._mmm is not None:
+            mn_str = str_in[self._mmm]
+            try:
+                mn = _month_numbers[mn_str.lower()]
+            except KeyError:
+                raise ValueError("Month abbreviation {0} not recognized".format(mn_str))
+        else:
+            mn = int(str_in[self._mm]) if self._mm is not None else 0
+            if mn == 0:
+                mn = 1
+
+        dy = int(str_in[self._dd]) if self._dd is not None else 0
+        if dy == 0:
+            dy = 1
+
+        # Hour needs to handle AM/PM. Afternoon needs 12 hours added (1:00 PM = 1300 hr) but noon should stay 12 and
+        # midnight (12 AM) should become hour = 0
+        hour = int(str_in[self._HH]) if self._HH is not None else 0
+        if ampm_match is not None:
+            ampm_str = ampm_match.group(0).lower()
+            if hour < 1 or hour > 12:
+                raise ValueError("If using AM/PM format, hour must be between 1 and 12")
+            elif hour != 12 and ampm_str == "pm":
+                hour += 12
+            elif hour == 12 and ampm_str == "am":
+                hour = 0
+        minute = int(str_in[self._MM]) if self._MM is not None else 0
+        second = int(str_in[self._SS]) if self._SS is not None else 0
+
+        # If no type out specified, it will be date only if hour, minute, and second are all 0
+        if typeout is None:
+            if hour == 0 and minute == 0 and second == 0:
+                typeout = dt.date
+            else:
+                typeout = dt.datetime
+
+        if typeout is dt.date:
+            return dt.date(yr, mn, dy)
+        else:
+            return dt.datetime(yr, mn, dy, hour, minute, second)
+
+
+def _placeholders_to_template(fmt):
+    if fmt is None:
+        return None
+    fmt = fmt.replace("{", "{{").replace("}", "}}")
+    for _, placeholder, field in _out_fields:
+        fmt = fmt.replace(placeholder, field)
+    return fmt
+
+def _placeholders_to_parts(fmt):
+    # A list of literal strings and the numbers of the fields (as in the str.format templates) between them
+    if fmt is None:
+        return None
+    field_numbers = dict((ph, i) for i, (_, ph, _) in enumerate(_out_fields))
+    parts = []
+    literal = ""
+    for char in fmt:
+        if char in field_numbers:
+            if literal:
+                parts.append(literal)
+                literal = ""
+            parts.append(field_numbers[char])
+        else:
+            literal += char
+    if literal:
+        parts.append(literal)
+    return parts
+
+def _current_year():
+    # dt.date.today() is only called again once the year may have changed
+    if time.time() >= _year_cache[1]:
+        this_year = dt.date.today().year
+        _year_cache[0] = this_year
+        _year_cache[1] = time.mktime(dt.date(this_year+1, 1, 1).timetuple())
+    return _year_cache[0]
+
+def _pivot_two_digit_year(yr):
+    # Two number years are assumed to be in the last 100 years
+    curr_yr_tmp = _current_year()
+    curr_yr = curr_yr_tmp % 100
+    curr_century = curr_yr_tmp - curr_yr
+    if yr <= curr_yr:
+        return yr + curr_century
+    else:
+        return yr + curr_century - 100
+
+def _date2str_replace(date_in, format_in):
+    # date2str by replacing each identifier in turn, used for formats that DateFormat cannot make a template for
+    ampm_match = _ampm_re.search(format_in)
     if ampm_match is None:
         ampm_bool = False
     else:
@@ -184,24 +766,6 @@ def date2str(date_in, format_in="yyyy-mm-dd"):
     return format_in
 
 
-def __substr_to_int(fullstr, date_format, substr, def_val=0):
-    m = re.search(substr, date_format)
-    if m is None:
-        val = def_val
-    else:
-        val = int(fullstr[m.start():m.end()])
-
-    return val
-
-def __substr_to_month(fullstr, date_format):
-    m = re.search("mmm", date_format)
-    if m is None:
-        val = None
-    else:
-        val = __month_abbrev(fullstr[m.start():m.end()])
-
-    return val
-
 def __month_abbrev(month_in):
     abbrevs = ["jan", "feb", "mar", "apr", "may", "jun", "jul", "aug", "sep", "oct", "nov", "dec"]
     if type(month_in) is str:
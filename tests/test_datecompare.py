@@ -0,0 +1,50 @@
+from __future__ import print_function
+import os
+import subprocess
+import sys
+import unittest
+
+from jllutils import datecompare
+
+_script = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'jllutils', 'datecompare.py')
+
+
+def _run_batch(lines, *args):
+    proc = subprocess.Popen([sys.executable, _script, '--batch', '-'] + list(args), stdin=subprocess.PIPE,
+                            stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True)
+    out, err = proc.communicate(''.join(line + '\n' for line in lines))
+    return proc.returncode, out.splitlines(), err.splitlines()
+
+
+class TestBatch(unittest.TestCase):
+    def test_all_true(self):
+        ecode, out, _ = _run_batch(['2017-01-01 lt 2017-01-02', '2017-01-02 +1d eq 2017-01-03'])
+        self.assertEqual((ecode, out), (0, ['true', 'true']))
+
+    def test_false(self):
+        ecode, out, _ = _run_batch(['2017-01-01 lt 2017-01-02', '2017-01-03 lt 2017-01-02'], '--results', 'code')
+        self.assertEqual((ecode, out), (1, ['0', '1']))
+
+    def test_error_lines(self):
+        # Bad lines, including dates modified out of range, are reported and do not stop the rest
+        lines = ['9999-12-31 +1d lt 2017-01-01', 'bogus lt 2017-01-01', '2017-01-01 2017-01-02',
+                 '2017-01-01 +1x lt 2017-01-02', '2017-01-01 -5000000d gt 2017-01-01', '2017-01-01 lt 2017-01-02']
+        ecode, out, err = _run_batch(lines)
+        self.assertEqual(ecode, 2)
+        self.assertEqual(out, ['error'] * 5 + ['true'])
+        self.assertEqual([e.split(':')[0] for e in err], ['Line {}'.format(i) for i in range(1, 6)])
+
+    def test_blank_lines_skipped(self):
+        ecode, out, err = _run_batch(['', '2017-01-01 lt 2017-01-02', '   ', 'bogus lt 2017-01-01'])
+        self.assertEqual((ecode, out), (2, ['true', 'error']))
+        self.assertEqual(len(err), 1)
+        self.assertTrue(err[0].startswith('Line 4:'))
+
+    def test_template(self):
+        results = list(datecompare.iter_batch_results(['2017-01-01', '2016-12-31'], '%Y-%m-%d',
+                                                      ['{}', 'lt', '2017-01-01']))
+        self.assertEqual(results, [(1, False, None), (2, True, None)])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,151 @@
+from __future__ import print_function
+import hashlib
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+from jllutils import hashcheck
+
+
+class HashcheckTestCase(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def make_file(self, relpath, data):
+        fname = os.path.join(self.tmp_dir, relpath)
+        if not os.path.isdir(os.path.dirname(fname)):
+            os.makedirs(os.path.dirname(fname))
+        with open(fname, 'wb') as f:
+            f.write(data)
+        return fname
+
+
+class TestIterFileChunks(HashcheckTestCase):
+    def test_interleaved_generators(self):
+        # Two generators read on the same thread must not overwrite each other's chunks
+        data1 = bytes(bytearray(range(256))) * 1000
+        data2 = b'z' * 300000
+        g1 = hashcheck.iter_file_chunks(self.make_file('a', data1), chunk_size=4096, use_mmap=False)
+        g2 = hashcheck.iter_file_chunks(self.make_file('b', data2), chunk_size=4096, use_mmap=False)
+        h1, h2 = hashlib.md5(), hashlib.md5()
+        for chunk1 in g1:
+            chunk2 = next(g2, None)
+            h1.update(chunk1)
+            if chunk2 is not None:
+                h2.update(chunk2)
+        for chunk2 in g2:
+            h2.update(chunk2)
+        self.assertEqual(h1.hexdigest(), hashlib.md5(data1).hexdigest())
+        self.assertEqual(h2.hexdigest(), hashlib.md5(data2).hexdigest())
+
+
+class TestCompareHashed(HashcheckTestCase):
+    def test_unknown_algorithm_reported_per_entry(self):
+        good = self.make_file('good', b'aaa')
+        bad = self.make_file('bad', b'bbb')
+        manifest = os.path.join(self.tmp_dir, 'manifest.txt')
+        with open(manifest, 'w') as f:
+            f.write('{}: md5={}\n'.format(good, hashlib.md5(b'aaa').hexdigest()))
+            f.write('{}: md5={} nosuch=abc\n'.format(bad, hashlib.md5(b'bbb').hexdigest()))
+        log_file = os.path.join(self.tmp_dir, 'log.txt')
+        for jobs in (1, 2):
+            ecode = hashcheck.compare_hashed(manifest, log_file, jobs=jobs)
+            with open(log_file) as f:
+                log = f.read().splitlines()
+            self.assertEqual(ecode, 1)
+            self.assertEqual(log, ['{}: Match'.format(good), '{}: UNKNOWN ALGORITHM nosuch'.format(bad)])
+
+    def test_unavailable_algorithms(self):
+        self.assertEqual(hashcheck.unavailable_algorithms(['md5', 'sha256', 'size', 'quick']), [])
+        self.assertEqual(hashcheck.unavailable_algorithms(['nosuch', 'md5', 'shake_128']), ['nosuch', 'shake_128'])
+
+
+class TestHashCache(HashcheckTestCase):
+    def test_prune_keeps_recently_used(self):
+        fnames = [self.make_file(name, name.encode('ascii')) for name in ('f1', 'f2', 'f3')]
+        with hashcheck.HashCache(os.path.join(self.tmp_dir, 'cache.db')) as cache:
+            for fname in fnames:
+                hashcheck.cached_compute_hashes(fname, cache=cache)
+                time.sleep(0.01)
+            # A hit on the oldest entry makes it the most recently used
+            self.assertIsNotNone(cache.get(os.stat(fnames[0]), ['md5']))
+            cache.prune(max_entries=2)
+            self.assertIsNotNone(cache.get(os.stat(fnames[0]), ['md5']))
+            self.assertIsNone(cache.get(os.stat(fnames[1]), ['md5']))
+            self.assertIsNotNone(cache.get(os.stat(fnames[2]), ['md5']))
+
+
+class TestDirectoryWalk(HashcheckTestCase):
+    def test_hidden_files_rule(self):
+        for relpath in ('a.dat', '.hidden.dat', os.path.join('sub', 'b.dat'), os.path.join('sub', '.c.dat')):
+            self.make_file(relpath, b'x')
+        tree = [os.path.relpath(f, self.tmp_dir) for f in hashcheck.iter_tree(self.tmp_dir, '*.dat')]
+        self.assertEqual(tree, ['a.dat', os.path.join('sub', 'b.dat')])
+        tree = [os.path.relpath(f, self.tmp_dir) for f in hashcheck.iter_tree(self.tmp_dir, '.*')]
+        self.assertEqual(tree, ['.hidden.dat', os.path.join('sub', '.c.dat')])
+        chosen = [os.path.relpath(f, self.tmp_dir) for f in hashcheck.choose_n_files(self.tmp_dir, '*.dat', 10)]
+        self.assertEqual(chosen, ['a.dat'])
+
+    def test_pattern_with_directory_part(self):
+        for relpath in ('a.dat', os.path.join('sub', 'b.dat'), os.path.join('sub', 'c.txt'),
+                        os.path.join('sub2', 'd.dat')):
+            self.make_file(relpath, b'x')
+        chosen = hashcheck.choose_n_files(self.tmp_dir, os.path.join('sub', '*.dat'), 10)
+        self.assertEqual(chosen, [os.path.join(self.tmp_dir, 'sub', 'b.dat')])
+        chosen = hashcheck.choose_n_files(self.tmp_dir, os.path.join('sub*', '*.dat'), 10)
+        self.assertEqual(sorted(chosen), [os.path.join(self.tmp_dir, 'sub', 'b.dat'),
+                                          os.path.join(self.tmp_dir, 'sub2', 'd.dat')])
+        with self.assertRaises(ValueError):
+            list(hashcheck.iter_tree(self.tmp_dir, os.path.join('sub', '*.dat')))
+        with self.assertRaises(ValueError):
+            hashcheck.choose_n_files(self.tmp_dir, os.path.join('sub', '*.dat'), 10, stratified=True)
+
+
+# Paths with every character the sorted manifest escapes, escapes that are already in the path, and a leading '#'
+_manifest_paths = ['/d/plain', '/d/tab\there', '/d/new\nline', '/d/car\rriage', '#/d/hash', '/d/per%cent',
+                   '/d/already%09escaped', '/d/colon: and space', u'/d/caf\u00e9', '/d/%23']
+
+
+class TestSortedManifest(HashcheckTestCase):
+    def make_entries(self, paths):
+        return [(p, {'md5': hashlib.md5(p.encode('utf-8')).hexdigest(),
+                     'sha1': hashlib.sha1(p.encode('utf-8')).hexdigest()}) for p in paths]
+
+    def test_round_trip(self):
+        entries = self.make_entries(_manifest_paths)
+        manifest = os.path.join(self.tmp_dir, 'sorted.man')
+        # Unsorted input with a duplicate, spilled to several sorted runs
+        n = hashcheck.write_sorted_manifest(list(reversed(entries)) + entries[:1], manifest, index_interval=3,
+                                            max_in_memory=4)
+        self.assertEqual(n, len(entries))
+        self.assertTrue(hashcheck.is_sorted_manifest(manifest))
+        self.assertEqual(hashcheck.count_manifest_entries(manifest), len(entries))
+        self.assertEqual(list(hashcheck.iter_manifest(manifest)), sorted(entries))
+        for path, hashes in entries:
+            self.assertEqual(hashcheck.manifest_lookup(manifest, path), hashes)
+        self.assertIsNone(hashcheck.manifest_lookup(manifest, '/d/missing'))
+        self.assertIsNone(hashcheck.manifest_lookup(manifest, ''))
+        for path in _manifest_paths:
+            self.assertEqual(hashcheck.unescape_path(hashcheck.escape_path(path)), path)
+            for char in '\t\n\r#':
+                self.assertNotIn(char, hashcheck.escape_path(path))
+
+    def test_diff(self):
+        old_entries = self.make_entries(_manifest_paths)
+        new_entries = self.make_entries(_manifest_paths[1:] + ['/d/added'])
+        new_entries[0] = (new_entries[0][0], {'md5': 'changed'})
+        old_manifest = os.path.join(self.tmp_dir, 'old.man')
+        new_manifest = os.path.join(self.tmp_dir, 'new.man')
+        hashcheck.write_sorted_manifest(old_entries, old_manifest)
+        hashcheck.write_sorted_manifest(new_entries, new_manifest)
+        self.assertEqual(list(hashcheck.diff_manifests(old_manifest, new_manifest)),
+                         [('/d/added', 'ADDED'), ('/d/plain', 'REMOVED'), (_manifest_paths[1], 'CHANGED')])
+
+
+if __name__ == '__main__':
+    unittest.main()
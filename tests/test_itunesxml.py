@@ -0,0 +1,268 @@
+from __future__ import print_function
+import datetime as dt
+import io
+import json
+import os
+import pickle
+import re
+import shutil
+import subprocess
+import sys
+import tempfile
+import unittest
+
+from jllutils import itunesbench, itunesxml
+
+_repo_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# A small library with the awkward cases: entities (left as written by both parsers), empty strings and arrays,
+# <true/> and <false/>, negative numbers, and a tab inside a value
+_lib_xml = (
+    u'<?xml version="1.0" encoding="UTF-8"?>\n'
+    '<!DOCTYPE plist PUBLIC "-//Apple Computer//DTD PLIST 1.0//EN" '
+    '"http://www.apple.com/DTDs/PropertyList-1.0.dtd">\n'
+    '<plist version="1.0">\n'
+    '<dict>\n'
+    '\t<key>Major Version</key><integer>1</integer>\n'
+    '\t<key>Date</key><date>2016-10-12T13:04:05Z</date>\n'
+    '\t<key>Show Content Ratings</key><true/>\n'
+    '\t<key>Music Folder</key><string>file:///Users/me/Music/iTunes/iTunes%20Media/</string>\n'
+    '\t<key>Tracks</key>\n'
+    '\t<dict>\n'
+    '\t\t<key>101</key>\n'
+    '\t\t<dict>\n'
+    '\t\t\t<key>Track ID</key><integer>101</integer>\n'
+    '\t\t\t<key>Name</key><string>Rock &#38; Roll</string>\n'
+    '\t\t\t<key>Artist</key><string>AC/DC</string>\n'
+    '\t\t\t<key>Album</key><string>Caf&#233;</string>\n'
+    '\t\t\t<key>Year</key><integer>1975</integer>\n'
+    '\t\t\t<key>Comments</key><string></string>\n'
+    '\t\t\t<key>Disabled</key><false/>\n'
+    '\t\t\t<key>Volume Adjustment</key><integer>-25</integer>\n'
+    '\t\t</dict>\n'
+    '\t\t<key>102</key>\n'
+    '\t\t<dict>\n'
+    '\t\t\t<key>Track ID</key><integer>102</integer>\n'
+    '\t\t\t<key>Name</key><string>Tab\tinside</string>\n'
+    '\t\t\t<key>Date Added</key><date>2001-01-01T00:00:00Z</date>\n'
+    '\t\t</dict>\n'
+    '\t</dict>\n'
+    '\t<key>Playlists</key>\n'
+    '\t<array>\n'
+    '\t\t<dict>\n'
+    '\t\t\t<key>Name</key><string>Library</string>\n'
+    '\t\t\t<key>Master</key><true/>\n'
+    '\t\t\t<key>Playlist Items</key>\n'
+    '\t\t\t<array>\n'
+    '\t\t\t\t<dict>\n'
+    '\t\t\t\t\t<key>Track ID</key><integer>101</integer>\n'
+    '\t\t\t\t</dict>\n'
+    '\t\t\t\t<dict>\n'
+    '\t\t\t\t\t<key>Track ID</key><integer>102</integer>\n'
+    '\t\t\t\t</dict>\n'
+    '\t\t\t</array>\n'
+    '\t\t</dict>\n'
+    '\t\t<dict>\n'
+    '\t\t\t<key>Name</key><string>Empty</string>\n'
+    '\t\t\t<key>Playlist Items</key>\n'
+    '\t\t\t<array>\n'
+    '\t\t\t</array>\n'
+    '\t\t</dict>\n'
+    '\t</array>\n'
+    '\t<key>Library Persistent ID</key><string>0123456789ABCDEF</string>\n'
+    '</dict>\n'
+    '</plist>\n'
+)
+
+
+class ITunesTestCase(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.lib_file = os.path.join(self.tmp_dir, 'lib.xml')
+        with io.open(self.lib_file, 'w', encoding='utf-8', newline='') as f:
+            f.write(_lib_xml)
+        self.crlf_lib_file = os.path.join(self.tmp_dir, 'lib_crlf.xml')
+        with io.open(self.crlf_lib_file, 'w', encoding='utf-8', newline='') as f:
+            f.write(_lib_xml.replace(u'\n', u'\r\n'))
+        self.synthetic_lib_file = os.path.join(self.tmp_dir, 'synthetic.xml')
+        itunesbench.write_synthetic_library(self.synthetic_lib_file, 200)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def lib_files(self):
+        return [self.lib_file, self.crlf_lib_file, self.synthetic_lib_file]
+
+
+class TestStreamParser(ITunesTestCase):
+    def test_matches_regex_parser(self):
+        for lib_file in self.lib_files():
+            stream_lib = itunesxml.parse_itunes_lib(lib_file, engine='stream')
+            regex_lib = itunesxml.parse_itunes_lib(lib_file, engine='regex')
+            self.assertEqual(stream_lib, regex_lib, lib_file)
+        self.assertEqual(itunesxml.parse_itunes_lib(self.lib_file)['Tracks']['101']['Name'], 'Rock &#38; Roll')
+
+    def test_chunk_size(self):
+        # Tags and text split across chunks give the same tokens
+        for lib_file in self.lib_files():
+            tokens = list(itunesxml.iter_lib_tokens(lib_file))
+            for chunk_size in (1, 7, 100):
+                self.assertEqual(list(itunesxml.iter_lib_tokens(lib_file, chunk_size=chunk_size)), tokens)
+
+    def test_sections(self):
+        for lib_file in self.lib_files():
+            lib = itunesxml.parse_itunes_lib(lib_file, engine='regex')
+            self.assertEqual(list(itunesxml.iter_itunes_tracks(lib_file)), list(lib['Tracks'].values()))
+            self.assertEqual(list(itunesxml.iter_lib_section(lib_file, 'Playlists')), lib['Playlists'])
+
+
+class TestCompactTracks(ITunesTestCase):
+    def test_same_as_dicts(self):
+        for lib_file in self.lib_files():
+            tracks = itunesxml.parse_itunes_lib(lib_file)['Tracks']
+            for compact in (True, 'table'):
+                compact_tracks = itunesxml.parse_itunes_lib(lib_file, compact=compact)['Tracks']
+                self.assertEqual(list(compact_tracks.keys()), list(tracks.keys()))
+                for key, track in tracks.items():
+                    compact_track = compact_tracks[key]
+                    self.assertEqual(compact_track, track)
+                    self.assertEqual(sorted(compact_track.keys()), sorted(track.keys()))
+                    for k, v in track.items():
+                        self.assertIs(type(compact_track[k]), type(v))
+
+    def test_table_overflow(self):
+        # Values that do not fit the type of their column are kept as they are
+        table = itunesxml.TrackTable()
+        tracks = [{'Track ID': 1, 'Size': 5, 'Date Added': dt.datetime(2000, 1, 1, 0, 0, 0, 5), 'Loved': True},
+                  {'Track ID': 2, 'Size': 'big', 'Date Added': dt.datetime(1960, 5, 1), 'Loved': 1,
+                   'Huge': 2 ** 70},
+                  {'Track ID': 3}]
+        for track in tracks:
+            table.append(str(track['Track ID']), track)
+        self.assertEqual([t.to_dict() for t in table.values()], tracks)
+        self.assertEqual(len(table), 3)
+        self.assertIn('3', table)
+        self.assertNotIn('4', table)
+        self.assertIsNone(table.get('4'))
+        with self.assertRaises(KeyError):
+            table['1']['Name']
+
+    def test_table_pickle(self):
+        table = itunesxml.parse_itunes_lib(self.synthetic_lib_file, compact='table')['Tracks']
+        copy = pickle.loads(pickle.dumps(table, 2))
+        self.assertEqual([t.to_dict() for t in copy.values()], [t.to_dict() for t in table.values()])
+        track = pickle.loads(pickle.dumps(table['1000'], 2))
+        self.assertIsInstance(track, itunesxml.Track)
+        self.assertEqual(track, table['1000'])
+
+    def test_report_independent_of_compact(self):
+        new_lib_file = os.path.join(self.tmp_dir, 'synthetic_new.xml')
+        itunesbench.write_synthetic_library(new_lib_file, 200, variant=1, change_fraction=0.05)
+        reports = []
+        for compact in (False, True, 'table'):
+            report_file = os.path.join(self.tmp_dir, 'report.txt')
+            itunesxml.assemble_report(self.synthetic_lib_file, new_lib_file, log_file=report_file, compact=compact,
+                                      parallel=False)
+            with open(report_file) as f:
+                reports.append(f.read())
+        self.assertEqual(reports[1], reports[0])
+        self.assertEqual(reports[2], reports[0])
+        self.assertIn('missing', reports[0])
+
+
+class TestLibCache(ITunesTestCase):
+    def test_snapshot_removed_after_check(self):
+        # A snapshot evicted by another process between the header check and loading it is a cache miss
+        cache_dir = os.path.join(self.tmp_dir, 'cache')
+        lib = itunesxml.cached_parse_itunes_lib(self.lib_file, cache_dir=cache_dir)
+        cache_file = itunesxml._lib_cache_file(self.lib_file, cache_dir)
+        is_cache_valid = itunesxml._is_cache_valid
+
+        def is_valid_then_evicted(*args):
+            valid = is_cache_valid(*args)
+            os.remove(cache_file)
+            return valid
+
+        itunesxml._is_cache_valid = is_valid_then_evicted
+        try:
+            self.assertEqual(itunesxml.cached_parse_itunes_lib(self.lib_file, cache_dir=cache_dir)['Tracks'].items(),
+                             lib['Tracks'].items())
+        finally:
+            itunesxml._is_cache_valid = is_cache_valid
+        self.assertTrue(os.path.isfile(cache_file))
+
+    def test_evict_skips_vanished_snapshots(self):
+        cache_dir = os.path.join(self.tmp_dir, 'cache')
+        for lib_file in self.lib_files():
+            itunesxml.cached_parse_itunes_lib(lib_file, cache_dir=cache_dir)
+        listdir = itunesxml.os.listdir
+        # Listed, but removed by another process before it could be stat'ed
+        itunesxml.os.listdir = lambda path: listdir(path) + ['gone' + itunesxml._cache_ext]
+        try:
+            removed = itunesxml.evict_lib_cache(cache_dir, 0)
+        finally:
+            itunesxml.os.listdir = listdir
+        self.assertEqual(len(removed), 3)
+        self.assertEqual(os.listdir(cache_dir), [])
+
+
+class TestFingerprints(ITunesTestCase):
+    def test_renumbered_export(self):
+        # Re-exporting an unchanged library can give every track a new Track ID and Persistent ID
+        with io.open(self.synthetic_lib_file, encoding='utf-8', newline='') as f:
+            xml = f.read()
+        xml = re.sub(u'(<key>Track ID</key><integer>|\t\t<key>)(\\d+)(?=<)',
+                     lambda m: m.group(1) + str(int(m.group(2)) + 5000), xml)
+        xml = re.sub(u'(<key>Persistent ID</key><string>)(\\w+)', lambda m: m.group(1) + m.group(2)[::-1], xml)
+        renumbered_lib_file = os.path.join(self.tmp_dir, 'renumbered.xml')
+        with io.open(renumbered_lib_file, 'w', encoding='utf-8', newline='') as f:
+            f.write(xml)
+        old_fp = itunesxml.build_lib_fingerprints(self.synthetic_lib_file)
+        new_fp = itunesxml.build_lib_fingerprints(renumbered_lib_file)
+        self.assertNotIn(u'<key>1000</key>', xml)
+        self.assertEqual([list(section) for section in itunesxml.fingerprint_diff(old_fp, new_fp)], [[], [], []])
+
+    def test_diff_sections_sorted(self):
+        new_lib_file = os.path.join(self.tmp_dir, 'synthetic_new.xml')
+        itunesbench.write_synthetic_library(new_lib_file, 200, variant=1, change_fraction=0.05)
+        old_fp = itunesxml.build_lib_fingerprints(self.synthetic_lib_file)
+        new_fp = itunesxml.build_lib_fingerprints(new_lib_file)
+        old_disps = [disp for entries in old_fp['tracks'].values() for _, disp in entries]
+        new_disps = [disp for entries in new_fp['tracks'].values() for _, disp in entries]
+        removed, added, changed = [list(section) for section in itunesxml.fingerprint_diff(old_fp, new_fp)]
+        self.assertEqual(removed, sorted(d for d in old_disps if d not in new_disps))
+        self.assertEqual(added, sorted(d for d in new_disps if d not in old_disps))
+        self.assertEqual(changed, sorted(changed))
+        self.assertTrue(removed and added and changed)
+        self.assertFalse(set(changed) & (set(removed) | set(added)))
+
+
+class TestReportOutput(ITunesTestCase):
+    def run_report(self, code):
+        # Run in a separate process so that everything the report functions print to stdout is captured
+        env = dict(os.environ, PYTHONPATH=_repo_dir)
+        proc = subprocess.Popen([sys.executable, '-c', 'from jllutils import itunesxml; ' + code], env=env,
+                                stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True)
+        out, err = proc.communicate()
+        self.assertEqual(proc.returncode, 0, err)
+        return out.splitlines(), err.splitlines()
+
+    def test_jsonl_to_stdout(self):
+        # Progress messages go to stderr, so a report written to stdout is nothing but JSON records
+        new_lib_file = os.path.join(self.tmp_dir, 'synthetic_new.xml')
+        itunesbench.write_synthetic_library(new_lib_file, 200, variant=1, change_fraction=0.05)
+        baseline_file = os.path.join(self.tmp_dir, 'baseline.fp')
+        itunesxml.save_lib_fingerprints(itunesxml.build_lib_fingerprints(self.synthetic_lib_file), baseline_file)
+        report_calls = [('assemble_report({!r}, {!r}, parallel=False, report_format="jsonl")'
+                         .format(self.synthetic_lib_file, new_lib_file), 'missing_from_new'),
+                        ('assemble_incremental_report({!r}, {!r}, report_format="jsonl")'
+                         .format(baseline_file, new_lib_file), 'changed')]
+        for call, section in report_calls:
+            out, err = self.run_report('itunesxml.' + call)
+            records = [json.loads(line) for line in out]
+            self.assertIn(section, set(r['section'] for r in records))
+            self.assertIn('Comparing individual playlists...', err)
+
+
+if __name__ == '__main__':
+    unittest.main()
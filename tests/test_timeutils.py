@@ -0,0 +1,151 @@
+from __future__ import print_function
+import datetime as dt
+import io
+import os
+import shutil
+import tempfile
+import unittest
+
+from jllutils import timeutils
+
+np = timeutils.np
+
+# Strings for each format, including ones str2date rejects and ones the fast path has to hand back to str2date
+_str2date_cases = [
+    ('yyyy-mm-dd', ['2016-10-12', '1999-01-31', '2016-02-30', '2016-1-2', 'abc', '', '0000-03-04', '2016-10-12x']),
+    ('mm/dd/yy', ['10/12/16', '13/12/16', '01/01/99', '12/31/00']),
+    ('dd mmm yyyy HH:MM', ['12 Oct 2016 01:04 PM', '12 oct 2016 13:04', '01 JAN 2000 12:00 am', '12 Xyz 2016 00:00',
+                           '12 Oct 2016 25:00']),
+    ('yyyymmddHHMMSS', ['20161012130405', '20161012236000', '2016101213040']),
+]
+
+
+def _scalar_str2date(strs, format_in):
+    # The dates and error mask str2date_array should give, computed with str2date
+    dates, failed = [], []
+    for s in strs:
+        try:
+            dates.append(timeutils.str2date(s, format_in))
+            failed.append(False)
+        except ValueError:
+            dates.append(None)
+            failed.append(True)
+    return dates, failed
+
+
+@unittest.skipIf(np is None, 'numpy is not installed')
+class TestStr2DateArray(unittest.TestCase):
+    def test_matches_str2date(self):
+        for format_in, strs in _str2date_cases:
+            dates, failed = timeutils.str2date_array(strs, format_in)
+            expected_dates, expected_failed = _scalar_str2date(strs, format_in)
+            unit = np.datetime_data(dates.dtype)[0]
+            self.assertEqual(failed.tolist(), expected_failed, format_in)
+            for s, date, expected in zip(strs, dates, expected_dates):
+                if expected is None:
+                    self.assertTrue(np.isnat(date), s)
+                else:
+                    self.assertEqual(date, np.datetime64(expected, unit), s)
+
+    def test_shape(self):
+        dates, failed = timeutils.str2date_array(np.array([['2016-10-12', 'x'], ['2017-01-01', '2018-12-31']]))
+        self.assertEqual(dates.shape, (2, 2))
+        self.assertEqual(failed.tolist(), [[False, True], [False, False]])
+
+    def test_empty(self):
+        dates, failed = timeutils.str2date_array([], 'yyyy-mm-dd')
+        self.assertEqual(dates.dtype, np.dtype('datetime64[D]'))
+        self.assertEqual((dates.shape, failed.shape), ((0,), (0,)))
+        dates, failed = timeutils.str2date_array(np.zeros((0, 3), dtype=str), 'yyyy-mm-dd HH:MM')
+        self.assertEqual(dates.dtype, np.dtype('datetime64[s]'))
+        self.assertEqual((dates.shape, failed.shape), ((0, 3), (0, 3)))
+
+
+_date2str_formats = ['yyyy-mm-dd', 'mm/dd/yy', 'dd mmm yyyy', 'yyyy-mm-dd HH:MM:SS', 'dd mmm yyyy HH:MM PM',
+                     'yyyymmdd HHMM am', 'mmm']
+_dates = [dt.datetime(2016, 10, 12, 13, 4, 5), dt.datetime(1999, 1, 1, 0, 0, 0), dt.datetime(2000, 12, 31, 12, 30),
+          dt.datetime(1, 1, 1), dt.datetime(9999, 12, 31, 23, 59, 59)]
+
+
+@unittest.skipIf(np is None, 'numpy is not installed')
+class TestDate2StrArray(unittest.TestCase):
+    def test_matches_date2str(self):
+        for format_in in _date2str_formats:
+            for as_date in (False, True):
+                dates = [d.date() if as_date else d for d in _dates]
+                expected = [timeutils.date2str(d, format_in) for d in dates]
+                self.assertEqual(timeutils.date2str_array(dates, format_in).tolist(), expected, format_in)
+                unit = 'D' if as_date else 's'
+                dates64 = np.array(dates, dtype='datetime64[{}]'.format(unit))
+                self.assertEqual(timeutils.date2str_array(dates64, format_in).tolist(), expected, format_in)
+                self.assertEqual(timeutils.date2str_array(dates64, format_in, sep='\n'), '\n'.join(expected))
+
+    def test_mixed_and_nat(self):
+        dates = [dt.date(2016, 10, 12), dt.datetime(2016, 10, 12, 13, 4)]
+        self.assertEqual(timeutils.date2str_array(dates, 'yyyy-mm-dd HH:MM').tolist(),
+                         [timeutils.date2str(d, 'yyyy-mm-dd HH:MM') for d in dates])
+        strs = timeutils.date2str_array(np.array(['2016-10-12', 'NaT'], dtype='datetime64[D]'))
+        self.assertEqual(strs.tolist(), ['2016-10-12', ''])
+
+    def test_empty(self):
+        strs = timeutils.date2str_array(np.zeros((2, 0), dtype='datetime64[s]'), 'yyyy-mm-dd')
+        self.assertEqual(strs.shape, (2, 0))
+        self.assertEqual(timeutils.date2str_array([], 'yyyy-mm-dd').shape, (0,))
+        self.assertEqual(timeutils.date2str_array([], 'yyyy-mm-dd', sep=','), '')
+
+
+_csv_in = (u'id,when,note,other\r\n'
+           u'1,10/12/16,a,01/02/99\r\n'
+           u'2,"01/31/17",b,\r\n'
+           u'3,,c,12/31/00\r\n'
+           u'4\r\n'
+           u'5,13/45/16,d,01/01/01')
+_csv_keep = (u'id,when,note,other\r\n'
+             u'1,2016-10-12,a,1999-01-02\r\n'
+             u'2,"2017-01-31",b,\r\n'
+             u'3,,c,2000-12-31\r\n'
+             u'4\r\n'
+             u'5,13/45/16,d,2001-01-01')
+
+
+class TestConvertDateColumns(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.in_file = os.path.join(self.tmp_dir, 'in.csv')
+        self.out_file = os.path.join(self.tmp_dir, 'out.csv')
+        with io.open(self.in_file, 'w', encoding='utf-8', newline='') as f:
+            f.write(_csv_in)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def convert(self, **kwargs):
+        n = timeutils.convert_date_columns(self.in_file, self.out_file, ['when', 'other'], 'mm/dd/yy', header=True,
+                                           **kwargs)
+        self.assertEqual(n, 6)
+        with io.open(self.out_file, 'r', encoding='utf-8', newline='') as f:
+            return f.read()
+
+    def test_convert(self):
+        self.assertEqual(self.convert(errors='keep'), _csv_keep)
+        self.assertEqual(self.convert(errors='blank'), _csv_keep.replace(u'13/45/16', u''))
+        with self.assertRaises(ValueError):
+            self.convert(errors='strict')
+
+    def test_chunks_and_processes(self):
+        # Chunk boundaries fall inside lines, and chunks converted in other processes come back in order
+        for chunk_size in (1, 7, 30):
+            self.assertEqual(self.convert(errors='keep', chunk_size=chunk_size), _csv_keep)
+        self.assertEqual(self.convert(errors='keep', chunk_size=7, processes=2), _csv_keep)
+
+    def test_without_numpy(self):
+        saved_np = timeutils.np
+        timeutils.np = None
+        try:
+            self.assertEqual(self.convert(errors='keep', chunk_size=30), _csv_keep)
+        finally:
+            timeutils.np = saved_np
+
+
+if __name__ == '__main__':
+    unittest.main()